@@ -1,12 +1,22 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import time
+from datetime import datetime
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from shared import (
-    query_ollama, get_chats, npc_manager, 
+    _run_sync, aquery_ollama, astream_ollama, get_chats, npc_manager, 
     get_conversation_history, get_user_conversations,
-    delete_conversation, get_conversation_stats
+    delete_conversation, get_conversation_stats, get_activity_timeseries, search_messages
 )
 from typing import Dict, List, Optional
+from ollama_client import ollama
+from scheduler import SchedulerQueueFull, llm_scheduler
+from database import chat_db
+from maintenance import MAINTENANCE_INTERVAL, run_maintenance
+from metrics import REQUEST_LATENCY, render_metrics
 
 app = FastAPI()
 
@@ -18,6 +28,74 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def measure_request_latency(request: Request, call_next):
+    """Misura la durata di ogni richiesta, raggruppando per route (non per URL).
+    
+    La misura si chiude dopo l'ultimo blocco del corpo, non all'invio degli
+    header: per lo streaming copre l'intera risposta.
+    """
+    started = time.perf_counter()
+    
+    def observe(status: int):
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method, route.path if route else "unmatched", str(status)
+        ).observe(time.perf_counter() - started)
+    
+    try:
+        response = await call_next(request)
+    except BaseException:
+        observe(500)
+        raise
+    
+    body = response.body_iterator
+    
+    async def timed_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            observe(response.status_code)
+    
+    response.body_iterator = timed_body()
+    return response
+
+async def run_maintenance_periodically():
+    """Esegue periodicamente la manutenzione del database in un thread"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            report = await loop.run_in_executor(None, run_maintenance)
+            if any(report.get("old_conversations", {}).values()) or any(report["orphans"].values()):
+                print(f"🧹 Manutenzione del database: {report}")
+        except Exception as e:
+            print(f"⚠️  Manutenzione del database fallita: {e}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+@app.on_event("startup")
+async def start_maintenance():
+    """Avvia la manutenzione periodica del database"""
+    app.state.maintenance = None
+    if MAINTENANCE_INTERVAL > 0:
+        app.state.maintenance = asyncio.create_task(run_maintenance_periodically())
+
+@app.on_event("shutdown")
+async def stop_maintenance():
+    """Ferma la manutenzione periodica del database"""
+    if app.state.maintenance:
+        app.state.maintenance.cancel()
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    """Chiude il pool di connessioni verso Ollama"""
+    await ollama.aclose()
+
+@app.on_event("shutdown")
+def flush_database_writes():
+    """Conferma le scritture ancora in coda prima dello spegnimento"""
+    chat_db.flush()
+
 class UserInput(BaseModel):
     message: str
     user_id: str = "default_user"
@@ -34,32 +112,80 @@ class NPCData(BaseModel):
     lastMessageTime: str = ""
     unread: int = 0
 
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Indica se If-None-Match contiene `etag`.
+    
+    Il confronto è debole, come richiesto per If-None-Match: `W/"x"` equivale a
+    `"x"` (proxy e CDN possono rendere deboli gli ETag quando comprimono).
+    """
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == etag:
+            return True
+    return False
+
 # Endpoint per ottenere la lista delle chat
 @app.get("/api/chats")
-def get_chats_endpoint():
-    """Ottiene la lista di tutte le chat disponibili"""
-    return get_chats()
+def get_chats_endpoint(request: Request):
+    """Ottiene la lista di tutte le chat disponibili (304 se non è cambiata)"""
+    chats = get_chats()
+    etag = f'"chats-{chats["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=chats, headers=headers)
 
 # Endpoint per parlare con un NPC specifico
 @app.post("/api/{npc_id}")
-def talk_to_npc(npc_id: str, data: UserInput):
+async def talk_to_npc(npc_id: str, data: UserInput):
     """Parla con un NPC specifico con supporto per lo storico"""
     try:
-        reply = query_ollama(
+        reply = await aquery_ollama(
             data.message, 
             npc_id, 
             data.user_id, 
             data.include_history
         )
         return {"reply": reply}
+    except SchedulerQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore nella comunicazione con l'NPC: {str(e)}")
 
+# Endpoint per parlare con un NPC ricevendo la risposta in streaming (SSE)
+@app.post("/api/{npc_id}/stream")
+async def talk_to_npc_stream(npc_id: str, data: UserInput):
+    """Parla con un NPC ricevendo i token della risposta come Server-Sent Events"""
+    # get_npc può leggere dal database: non va eseguito nell'event loop
+    if not await _run_sync(npc_manager.get_npc, npc_id):
+        raise HTTPException(status_code=404, detail="NPC non trovato")
+    
+    # Rifiuta subito se la coda è piena, prima di aprire lo stream
+    try:
+        llm_scheduler.check_capacity(data.user_id)
+    except SchedulerQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    
+    async def event_stream():
+        async for event in astream_ollama(data.message, npc_id, data.user_id, data.include_history):
+            payload = json.dumps(event, ensure_ascii=False)
+            yield f"event: {event['type']}\ndata: {payload}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Endpoint legacy per compatibilità
 @app.post("/api/aedryan")
-def talk_to_king(data: UserInput):
+async def talk_to_king(data: UserInput):
     """Endpoint legacy per Re Aedryan"""
-    return talk_to_npc("aedryan", data)
+    return await talk_to_npc("aedryan", data)
 
 # Endpoint per ottenere un NPC specifico
 @app.get("/api/npc/{npc_id}")
@@ -109,7 +235,7 @@ def get_all_npcs():
         return {
             "npcs": npcs,
             "total": len(npcs),
-            "timestamp": get_chats()["timestamp"]
+            "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore nel recupero degli NPC: {str(e)}")
@@ -119,16 +245,27 @@ def get_all_npcs():
 def get_conversation_history_endpoint(
     npc_id: str, 
     user_id: str = "default_user", 
-    limit: int = 50
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[int] = None,
+    after: Optional[int] = None
 ):
-    """Ottiene lo storico di una conversazione specifica"""
+    """Ottiene lo storico di una conversazione, una pagina alla volta.
+    
+    Senza cursori restituisce gli ultimi messaggi; `before` (id del messaggio)
+    pagina verso i più vecchi, `after` verso i più recenti.
+    """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Usa before oppure after, non entrambi")
     try:
-        history = get_conversation_history(npc_id, user_id, limit)
+        page = get_conversation_history(npc_id, user_id, limit, before, after)
         return {
             "npc_id": npc_id,
             "user_id": user_id,
-            "history": history,
-            "total_messages": len(history)
+            "history": page["messages"],
+            "total_messages": len(page["messages"]),
+            "has_more": page["has_more"],
+            "next_before": page["next_before"],
+            "next_after": page["next_after"]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore nel recupero dello storico: {str(e)}")
@@ -173,11 +310,42 @@ def get_conversation_stats_endpoint(npc_id: str = None):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore nel recupero delle statistiche: {str(e)}")
 
+# Endpoint per la serie temporale dei messaggi
+@app.get("/api/stats/timeseries")
+def get_activity_timeseries_endpoint(bucket: str = "hour", npc_id: str = None, user_id: str = None,
+                                     start: str = None, end: str = None):
+    """Messaggi per minuto/ora/giorno, per NPC, per utente o in totale"""
+    try:
+        return get_activity_timeseries(bucket, npc_id, user_id, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Endpoint per la ricerca nei messaggi
+@app.get("/api/search")
+def search_messages_endpoint(
+    q: str,
+    npc_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=10000)
+):
+    """Cerca nel testo dei messaggi, dal risultato più pertinente.
+    
+    Tutte le parole devono comparire; le frasi vanno tra virgolette e
+    `parola*` cerca per prefisso.
+    """
+    if not chat_db.search_enabled:
+        raise HTTPException(status_code=503, detail="Ricerca non disponibile: SQLite non include FTS5")
+    try:
+        return search_messages(q, npc_id, user_id, limit, offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # Endpoint per ottenere statistiche
 @app.get("/api/stats")
 def get_stats():
     """Ottiene statistiche sugli NPC e conversazioni"""
-    npcs = npc_manager.get_all_npcs()
+    npcs, _ = npc_manager.get_npc_summaries()
     online_count = sum(1 for npc in npcs if npc.get("status") == "online")
     total_unread = sum(npc.get("unread", 0) for npc in npcs)
     
@@ -192,15 +360,23 @@ def get_stats():
             "total_unread": total_unread
         },
         "conversations": conv_stats,
-        "timestamp": get_chats()["timestamp"]
+        "llm_queue": llm_scheduler.stats(),
+        "timestamp": datetime.now().isoformat()
     }
 
+# Endpoint per le metriche in formato Prometheus
+@app.get("/metrics")
+def metrics_endpoint():
+    """Metriche per Prometheus (latenze, database, coda e generazioni)"""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 # Endpoint di health check
 @app.get("/api/health")
 def health_check():
     """Health check dell'API"""
     return {
         "status": "healthy",
-        "npcs_loaded": len(npc_manager.get_all_npcs()),
-        "timestamp": get_chats()["timestamp"]
+        "npcs_loaded": len(npc_manager.get_npc_summaries()[0]),
+        "timestamp": datetime.now().isoformat()
     }
@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Tuple
+
+# Dimensione oltre la quale si apre un nuovo file di segmento
+ARCHIVE_SEGMENT_MAX_BYTES = int(os.getenv("ARCHIVE_SEGMENT_MAX_MB", "64")) * 1024 * 1024
+# Blocchi decompressi tenuti in memoria per le letture ripetute
+ARCHIVE_CACHE_BLOCKS = int(os.getenv("ARCHIVE_CACHE_BLOCKS", "64"))
+
+
+class ArchiveError(Exception):
+    """Un blocco dell'archivio manca o non corrisponde all'indice"""
+
+
+class SegmentStore:
+    """Archivio dei messaggi in file di segmento compressi, scritti solo in coda.
+
+    Ogni conversazione archiviata diventa un blocco (lista JSON di messaggi
+    compressa con zlib) accodato all'ultimo segmento. Il database conserva la
+    posizione di ogni blocco (segmento, offset, lunghezza, crc32) nella tabella
+    archive_index; i segmenti non vengono mai riscritti.
+    """
+
+    def __init__(self, directory: str, segment_max_bytes: int = ARCHIVE_SEGMENT_MAX_BYTES,
+                 cache_blocks: int = ARCHIVE_CACHE_BLOCKS):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.cache_blocks = cache_blocks
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[int, int], List[tuple]]" = OrderedDict()
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:06d}.z")
+
+    def _current_segment(self) -> int:
+        """Ultimo segmento, o il successivo se ha raggiunto la dimensione massima"""
+        segments = [int(name[8:14]) for name in os.listdir(self.directory)
+                    if name.startswith("segment-") and name.endswith(".z")]
+        segment = max(segments, default=1)
+        path = self._path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_max_bytes:
+            segment += 1
+        return segment
+
+    def append(self, blocks: List[List[tuple]]) -> List[Tuple[int, int, int, int]]:
+        """Accoda i blocchi di messaggi e li rende persistenti (fsync).
+
+        Restituisce per ogni blocco (segmento, offset, lunghezza, crc32). Le
+        scritture concorrenti di più processi vanno serializzate dal chiamante
+        (il database le esegue con il lock di scrittura di SQLite).
+        """
+        payloads = [
+            zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            for rows in blocks
+        ]
+        locations = []
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            segment = self._current_segment()
+            with open(self._path(segment), "ab") as f:
+                offset = f.tell()
+                for payload in payloads:
+                    f.write(payload)
+                    locations.append((segment, offset, len(payload), zlib.crc32(payload)))
+                    offset += len(payload)
+                f.flush()
+                os.fsync(f.fileno())
+        return locations
+
+    def read(self, segment: int, offset: int, length: int, crc32: int) -> List[tuple]:
+        """Legge un blocco: messaggi (id, sender, content, timestamp, token_count) in ordine di id"""
+        key = (segment, offset)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        try:
+            with open(self._path(segment), "rb") as f:
+                f.seek(offset)
+                payload = f.read(length)
+        except OSError as e:
+            raise ArchiveError(f"Segmento {segment} non leggibile: {e}") from e
+        if len(payload) != length or zlib.crc32(payload) != crc32:
+            raise ArchiveError(f"Blocco corrotto nel segmento {segment} all'offset {offset}")
+        rows = [tuple(row) for row in json.loads(zlib.decompress(payload))]
+
+        with self._lock:
+            self._cache[key] = rows
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return rows
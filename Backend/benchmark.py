@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Benchmark di carico del backend NPC.
+
+Avvia l'app FastAPI nello stesso processo (uvicorn in un thread) su un database
+temporaneo, la collega a un Ollama simulato e la fa usare da N utenti in
+parallelo. Riporta latenze (p50/p95/p99), throughput, tempo di database per
+turno e attese sul lock di scrittura di SQLite, e salva i risultati in JSON per
+confrontarli tra un commit e l'altro.
+
+Uso:
+    python benchmark.py --users 20 --turns 5 --stream --output risultati.json
+    python benchmark.py --compare vecchi.json --output nuovi.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fake_ollama import FakeOllama
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Percentile con il metodo nearest-rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize_latencies(values: List[float]) -> Dict:
+    """Riassunto delle latenze in millisecondi"""
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+    return {
+        "count": len(values),
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "max_ms": ms(max(values) if values else None),
+    }
+
+
+def git_commit() -> Optional[str]:
+    """Commit corrente, per sapere a cosa si riferiscono i risultati"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def simulate_user(client, base_url: str, npc_id: str, user_index: int, args, results: Dict):
+    """Un utente che invia `turns` messaggi in sequenza"""
+    user_id = f"bench_user_{user_index}"
+    for turn in range(args.turns):
+        payload = {"message": f"Messaggio {turn} dell'utente {user_index}", "user_id": user_id}
+        started = time.perf_counter()
+        first_token = None
+        try:
+            if args.stream:
+                async with client.stream("POST", f"{base_url}/api/{npc_id}/stream", json=payload) as response:
+                    status = response.status_code
+                    async for line in response.aiter_lines():
+                        if first_token is None and line.startswith("event: token"):
+                            first_token = time.perf_counter()
+                        if line.startswith("event: error"):
+                            status = 500
+            else:
+                response = await client.post(f"{base_url}/api/{npc_id}", json=payload)
+                status = response.status_code
+                if status == 200 and response.json()["reply"].startswith("Errore"):
+                    status = 500
+        except Exception:
+            status = 0
+        elapsed = time.perf_counter() - started
+
+        if status == 200:
+            results["latencies"].append(elapsed)
+            if first_token is not None:
+                results["ttft"].append(first_token - started)
+        elif status == 429:
+            results["rejected"] += 1
+        else:
+            results["errors"] += 1
+
+        if args.think_time:
+            await asyncio.sleep(args.think_time)
+
+
+async def drive_load(base_url: str, npc_ids: List[str], args) -> Dict:
+    import httpx
+
+    results = {"latencies": [], "ttft": [], "errors": 0, "rejected": 0}
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(limits=limits, timeout=600) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            simulate_user(client, base_url, npc_ids[i % len(npc_ids)], i, args, results)
+            for i in range(args.users)
+        ))
+        results["duration"] = time.perf_counter() - started
+    return results
+
+
+def run_benchmark(args) -> Dict:
+    fake = FakeOllama(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                      reply_tokens=args.reply_tokens, error_rate=args.error_rate, seed=42).start()
+
+    tmp = tempfile.TemporaryDirectory()
+    # La configurazione viene letta all'import dei moduli: va impostata prima
+    os.environ["OLLAMA_URL"] = fake.url
+    os.environ["DATABASE_PATH"] = os.path.join(tmp.name, "benchmark.db")
+    os.environ.setdefault("LLM_MAX_CONCURRENCY", str(args.llm_concurrency))
+    os.environ.setdefault("LLM_MAX_QUEUE_PER_USER", str(max(args.turns, 3)))
+    os.environ.setdefault("SUMMARY_ENABLED", "false")
+
+    import uvicorn
+    from api_server import app
+    from database import chat_db
+    from scheduler import llm_scheduler
+    from shared import npc_manager
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    npc_ids = [npc['id'] for npc in npc_manager.get_all_npcs()][:args.npcs]
+    db_before = chat_db.pool.stats()
+    try:
+        load = asyncio.run(drive_load(f"http://127.0.0.1:{port}", npc_ids, args))
+    finally:
+        server.should_exit = True
+        thread.join()
+        chat_db.flush()
+    db_after = chat_db.pool.stats()
+    fake.stop()
+    chat_db.close()
+    tmp.cleanup()
+
+    turns = len(load["latencies"]) + load["errors"]
+    db_delta = {key: db_after[key] - db_before[key] for key in db_before if key != "connections"}
+    per_turn = (lambda value: round(value / turns * 1000, 3)) if turns else (lambda value: None)
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "config": {
+            "users": args.users,
+            "turns": args.turns,
+            "npcs": len(npc_ids),
+            "stream": args.stream,
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "reply_tokens": args.reply_tokens,
+            "error_rate": args.error_rate,
+            "think_time": args.think_time,
+            "llm_concurrency": llm_scheduler.max_concurrency,
+        },
+        "results": {
+            "duration_s": round(load["duration"], 3),
+            "completed": len(load["latencies"]),
+            "errors": load["errors"],
+            "rejected": load["rejected"],
+            "throughput_rps": round(len(load["latencies"]) / load["duration"], 3) if load["duration"] else 0,
+            "latency": summarize_latencies(load["latencies"]),
+            "time_to_first_token": summarize_latencies(load["ttft"]) if args.stream else None,
+            "db": {
+                "connections": db_after["connections"],
+                "borrows": db_delta["borrows"],
+                "db_ms_per_turn": per_turn(db_delta["borrow_seconds"]),
+                "pool_wait_ms_per_turn": per_turn(db_delta["acquire_wait_seconds"]),
+                "lock_waits": db_delta["lock_waits"],
+                "lock_wait_ms_total": round(db_delta["lock_wait_seconds"] * 1000, 3),
+                "lock_wait_ms_per_turn": per_turn(db_delta["lock_wait_seconds"]),
+            },
+            "llm_queue": llm_scheduler.stats(),
+        },
+    }
+
+
+def compare(old: Dict, new: Dict):
+    """Stampa le differenze delle metriche principali rispetto a un risultato precedente"""
+    metrics = [
+        ("throughput_rps", lambda r: r["throughput_rps"]),
+        ("latency p50_ms", lambda r: r["latency"]["p50_ms"]),
+        ("latency p95_ms", lambda r: r["latency"]["p95_ms"]),
+        ("latency p99_ms", lambda r: r["latency"]["p99_ms"]),
+        ("db_ms_per_turn", lambda r: r["db"]["db_ms_per_turn"]),
+        ("lock_wait_ms_per_turn", lambda r: r["db"]["lock_wait_ms_per_turn"]),
+    ]
+    print(f"\n📊 Confronto con {old.get('commit')} → {new.get('commit')}")
+    for name, get in metrics:
+        try:
+            before, after = get(old["results"]), get(new["results"])
+        except (KeyError, TypeError):
+            continue
+        if before is None or after is None:
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/d"
+        print(f"   {name:<24} {before:>10} → {after:<10} ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di carico del backend NPC")
+    parser.add_argument("--users", type=int, default=20, help="Utenti simulati in parallelo")
+    parser.add_argument("--turns", type=int, default=5, help="Messaggi inviati da ogni utente")
+    parser.add_argument("--npcs", type=int, default=3, help="NPC tra cui distribuire gli utenti")
+    parser.add_argument("--stream", action="store_true", help="Usa l'endpoint in streaming")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Pausa tra i messaggi (secondi)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latenza di Ollama prima del primo token")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Velocità di Ollama (0 = istantaneo)")
+    parser.add_argument("--reply-tokens", type=int, default=20, help="Token per risposta")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Frazione di generazioni che falliscono")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Generazioni contemporanee")
+    parser.add_argument("--output", help="File JSON in cui salvare i risultati")
+    parser.add_argument("--compare", help="Risultati JSON precedenti da confrontare")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Risultati salvati in {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+    return 0 if report["results"]["completed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,90 +1,397 @@
+import atexit
+import json
 import sqlite3
-from datetime import datetime
-from typing import List, Dict, Optional
+from array import array
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Set, Tuple
 import os
+from archive import SegmentStore
+from metrics import DB_LOCK_WAIT, timed_db_method
+from migrations import ACTIVITY_BUCKETS, LAST_MESSAGE_PREVIEW_CHARS, create_message_search, run_migrations
 
-class ChatDatabase:
-    def __init__(self, db_path: str = "database.db"):
+DATABASE_PATH = os.getenv("DATABASE_PATH", "database.db")
+# Cartella dei segmenti dell'archivio (vuoto = "<nome database>_archive" accanto al database)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+# Conversazioni archiviate per transazione
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "50"))
+# Corrispondenze più recenti tra cui la ricerca ordina per pertinenza
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "2000"))
+
+# Numero massimo di connessioni SQLite aperte contemporaneamente
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+# PRAGMA applicati a ogni connessione del pool
+DEFAULT_PRAGMAS = {
+    # Ha effetto solo su un database nuovo (prima di journal_mode, che crea il file);
+    # per uno esistente serve un VACUUM completo (python db_tools.py vacuum)
+    "auto_vacuum": os.getenv("DB_AUTO_VACUUM", "INCREMENTAL"),
+    "journal_mode": os.getenv("DB_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": -int(os.getenv("DB_CACHE_SIZE_KB", "20000")),  # valore negativo = KiB
+    "temp_store": "MEMORY",
+}
+
+# Modalità write-behind: i messaggi vengono accodati e scritti in batch da un thread dedicato
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+DB_WRITE_BATCH_MS = int(os.getenv("DB_WRITE_BATCH_MS", "50"))
+DB_WRITE_BATCH_ROWS = int(os.getenv("DB_WRITE_BATCH_ROWS", "500"))
+DB_WRITE_QUEUE_SIZE = int(os.getenv("DB_WRITE_QUEUE_SIZE", "10000"))
+
+# Manutenzione: conversazioni eliminate per transazione e pausa tra un batch e l'altro,
+# così le scritture delle chat non restano in attesa del lock per tutta la pulizia
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "200"))
+MAINTENANCE_BATCH_PAUSE_MS = int(os.getenv("MAINTENANCE_BATCH_PAUSE_MS", "50"))
+
+# Per quanto tempo si conservano i bucket di activity_rollups (0 = per sempre)
+ACTIVITY_RETENTION = {
+    "minute": timedelta(hours=int(os.getenv("ACTIVITY_RETENTION_MINUTE_HOURS", "48"))),
+    "hour": timedelta(days=int(os.getenv("ACTIVITY_RETENTION_HOUR_DAYS", "90"))),
+    "day": timedelta(days=int(os.getenv("ACTIVITY_RETENTION_DAY_DAYS", "0"))),
+}
+# Dimensioni di activity_rollups: (npc_id, user_id) di ogni riga
+ACTIVITY_SCOPES = {
+    'npc': ("npc_id", "'*'"),
+    'user': ("'*'", "user_id"),
+    'all': ("'*'", "'*'"),
+}
+
+class ConnectionPool:
+    """Pool di connessioni SQLite persistenti, configurate una sola volta con i PRAGMA"""
+    
+    def __init__(self, db_path: str, pool_size: int = DB_POOL_SIZE,
+                 pragmas: Optional[Dict] = None, timeout: float = 30.0):
         self.db_path = db_path
-        self.init_database()
+        self.pool_size = pool_size
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Statistiche cumulative (secondi), lette da benchmark e metriche
+        self._stats = {
+            "borrows": 0,
+            "borrow_seconds": 0.0,
+            "acquire_wait_seconds": 0.0,
+            "lock_waits": 0,
+            "lock_wait_seconds": 0.0,
+        }
     
-    def init_database(self):
-        """Inizializza il database con le tabelle necessarie"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Tabella per gli NPC
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS npcs (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    avatar TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    status TEXT DEFAULT 'online',
-                    prompt TEXT NOT NULL,
-                    last_message TEXT DEFAULT '',
-                    last_message_time TEXT DEFAULT '',
-                    unread_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Tabella per le conversazioni
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    npc_id TEXT NOT NULL,
-                    user_id TEXT DEFAULT 'default_user',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    title TEXT DEFAULT '',
-                    message_count INTEGER DEFAULT 0,
-                    FOREIGN KEY (npc_id) REFERENCES npcs (id)
-                )
-            ''')
+    def _create_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+    
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.pool_size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return self._create_connection()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Nessuna connessione disponibile nel pool")
+    
+    @contextmanager
+    def connection(self):
+        """Presta una connessione al thread corrente.
+        
+        Le chiamate annidate nello stesso thread riusano la stessa connessione;
+        il commit (o il rollback in caso di errore) avviene all'uscita più esterna.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        
+        started = time.perf_counter()
+        conn = self._acquire()
+        acquired = time.perf_counter()
+        self._local.conn = conn
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._idle.put(conn)
+            with self._lock:
+                self._stats["borrows"] += 1
+                self._stats["borrow_seconds"] += time.perf_counter() - started
+                self._stats["acquire_wait_seconds"] += acquired - started
+    
+    def begin_immediate(self, conn: sqlite3.Connection):
+        """Apre una transazione di scrittura, misurando l'attesa del lock del database"""
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        waited = time.perf_counter() - started
+        DB_LOCK_WAIT.observe(waited)
+        with self._lock:
+            self._stats["lock_waits"] += 1
+            self._stats["lock_wait_seconds"] += waited
+    
+    def stats(self) -> Dict:
+        """Statistiche cumulative del pool: prestiti, tempo di utilizzo e attese"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["connections"] = self._created
+        return stats
+    
+    def close_all(self):
+        """Chiude tutte le connessioni inattive del pool"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+class WriteBehindQueue:
+    """Coda di scritture differite (group commit).
+    
+    Le operazioni accodate vengono applicate da un thread dedicato, raggruppate
+    in un'unica transazione ogni `batch_ms` millisecondi o `batch_rows` operazioni.
+    La coda è limitata: quando è piena, chi scrive attende (backpressure).
+    """
+    
+    def __init__(self, db: "ChatDatabase", batch_ms: int = DB_WRITE_BATCH_MS,
+                 batch_rows: int = DB_WRITE_BATCH_ROWS, max_size: int = DB_WRITE_QUEUE_SIZE):
+        self.db = db
+        self.batch_seconds = batch_ms / 1000
+        self.batch_rows = batch_rows
+        self._queue = queue.Queue(maxsize=max_size)
+        # Messaggi accodati ma non ancora confermati, per conversazione
+        self._pending: Dict[int, List[Dict]] = {}
+        self.pending_lock = threading.RLock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+    
+    def submit(self, func, args: tuple, messages: List[tuple]):
+        """Accoda un'operazione; `messages` sono le tuple (conversation_id, sender, content, token_count) che scrive"""
+        if self._closed:
+            raise RuntimeError("La coda di scrittura è stata chiusa")
+        
+        timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        entries = []
+        with self.pending_lock:
+            for conversation_id, sender, content, token_count in messages:
+                # Senza id finché il batch non è scritto: chi usa gli id deve saltare None
+                entry = {'id': None, 'sender': sender, 'content': content, 'timestamp': timestamp,
+                         'token_count': token_count}
+                self._pending.setdefault(conversation_id, []).append(entry)
+                entries.append((conversation_id, entry))
+        
+        self._queue.put((func, args, entries))
+    
+    def pending_messages(self, conversation_id: int) -> List[Dict]:
+        """Messaggi non ancora confermati (chiamare tenendo `pending_lock`)"""
+        return list(self._pending.get(conversation_id, []))
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                self._queue.task_done()
+                return
             
-            # Tabella per i messaggi
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    conversation_id INTEGER NOT NULL,
-                    sender TEXT NOT NULL, -- 'user' o 'npc'
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-                )
-            ''')
+            deadline = time.monotonic() + self.batch_seconds
+            stop = False
+            while len(batch) < self.batch_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
             
-            # Tabella per le sessioni utente
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_sessions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    npc_id TEXT NOT NULL,
-                    conversation_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id),
-                    FOREIGN KEY (npc_id) REFERENCES npcs (id)
-                )
-            ''')
+            self._apply(batch)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+    
+    def _apply(self, batch: List[tuple]):
+        try:
+            self._commit(batch)
+        except Exception as e:
+            # Riprova le operazioni una per una, così un errore non fa perdere l'intero batch
+            print(f"⚠️  Batch di scrittura fallito ({e}), riprovo singolarmente")
+            for item in batch:
+                try:
+                    self._commit([item])
+                except Exception as item_error:
+                    print(f"❌ Scrittura differita scartata: {item_error}")
+                    self._forget(item[2])
+    
+    def _commit(self, batch: List[tuple]):
+        with self.db.connection() as conn:
+            self.db.pool.begin_immediate(conn)
+            for func, args, _ in batch:
+                func(*args)
+            # Commit e rimozione dai pendenti sono atomici rispetto ai lettori
+            with self.pending_lock:
+                conn.commit()
+                for _, _, entries in batch:
+                    self._forget(entries, locked=True)
+    
+    def _forget(self, entries: List[tuple], locked: bool = False):
+        if not locked:
+            with self.pending_lock:
+                return self._forget(entries, locked=True)
+        for conversation_id, entry in entries:
+            pending = self._pending.get(conversation_id)
+            if pending is None:
+                continue
+            pending[:] = [e for e in pending if e is not entry]
+            if not pending:
+                del self._pending[conversation_id]
+    
+    def flush(self):
+        """Attende che tutte le scritture accodate siano confermate"""
+        self._queue.join()
+    
+    def close(self):
+        """Svuota la coda e ferma il thread di scrittura"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+class ChatDatabase:
+    def __init__(self, db_path: str = DATABASE_PATH, pool_size: int = DB_POOL_SIZE,
+                 pragmas: Optional[Dict] = None, write_behind: bool = DB_WRITE_BEHIND,
+                 archive_dir: str = ARCHIVE_DIR):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, pool_size, pragmas)
+        # Messaggi delle conversazioni inattive, spostati fuori dal database
+        self.archive = SegmentStore(archive_dir or os.path.splitext(db_path)[0] + "_archive")
+        self.init_database()
+        
+        # Connessione dedicata per rilevare modifiche fatte da altre connessioni/processi
+        self._watch_conn: Optional[sqlite3.Connection] = None
+        self._watch_lock = threading.Lock()
+        self._watch_data_version: Optional[int] = None
+        self._npc_versions: Optional[Tuple[int, int]] = None
+        
+        self.writer = None
+        if write_behind:
+            self.writer = WriteBehindQueue(self)
+            atexit.register(self.close)
+    
+    def connection(self):
+        """Ottiene una connessione dal pool (riusata se il thread ne ha già una).
+        
+        Usabile come context manager per raggruppare più operazioni
+        sulla stessa connessione e nella stessa transazione.
+        """
+        return self.pool.connection()
+    
+    @contextmanager
+    def read_snapshot(self):
+        """Esegue più letture sulla stessa istantanea consistente del database"""
+        with self.connection() as conn, self._pending_view():
+            if not conn.in_transaction:
+                conn.execute("BEGIN")
+            yield conn
+    
+    @contextmanager
+    def transaction(self):
+        """Transazione di scrittura: le operazioni annidate vengono confermate insieme"""
+        with self.connection() as conn:
+            if not conn.in_transaction:
+                # Prende subito il lock di scrittura per evitare upgrade in conflitto
+                self.pool.begin_immediate(conn)
+            yield conn
+    
+    def flush(self):
+        """Conferma le scritture ancora in coda (solo in modalità write-behind)"""
+        if self.writer:
+            self.writer.flush()
+    
+    def close(self):
+        """Svuota le scritture in coda e chiude le connessioni del pool"""
+        if self.writer:
+            self.writer.close()
+        self.pool.close_all()
+        with self._watch_lock:
+            if self._watch_conn is not None:
+                self._watch_conn.close()
+                self._watch_conn = None
+                self._npc_versions = None
+    
+    @timed_db_method
+    def get_npc_versions(self) -> Tuple[int, int]:
+        """Restituisce (versione definizioni NPC, versione attività NPC).
+        
+        I contatori vengono riletti solo quando `PRAGMA data_version` segnala un
+        commit di un'altra connessione (anche di un altro processo, es. la CLI).
+        """
+        with self._watch_lock:
+            if self._watch_conn is None:
+                self._watch_conn = sqlite3.connect(self.db_path, check_same_thread=False)
             
-            # Indici per migliorare le performance
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_npcs_id ON npcs(id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_npc ON conversations(npc_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_npc ON user_sessions(user_id, npc_id)')
+            data_version = self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._npc_versions is None or data_version != self._watch_data_version:
+                rows = dict(self._watch_conn.execute(
+                    "SELECT key, value FROM db_meta WHERE key IN ('npc_version', 'npc_activity_version')"
+                ).fetchall())
+                self._npc_versions = (rows.get('npc_version', 0), rows.get('npc_activity_version', 0))
+                self._watch_data_version = data_version
             
-            conn.commit()
+            return self._npc_versions
+    
+    def init_database(self):
+        """Porta lo schema all'ultima versione e inizializza gli NPC di default"""
+        with self.connection() as conn:
+            run_migrations(self, conn)
+            self.database_id = conn.execute("SELECT value FROM db_meta WHERE key = 'database_id'").fetchone()[0]
+            # Falso se SQLite non include FTS5
+            self.search_enabled = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+            ).fetchone() is not None
             
             # Inizializza gli NPC di default se la tabella è vuota
             self._init_default_npcs()
     
     def _init_default_npcs(self):
         """Inizializza gli NPC di default se la tabella è vuota"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT COUNT(*) FROM npcs')
             if cursor.fetchone()[0] == 0:
@@ -112,12 +419,12 @@ class ChatDatabase:
                         npc['lastMessageTime'], npc['unread_count']
                     ))
                 
-                conn.commit()
     
     # Metodi per gestire gli NPC
+    @timed_db_method
     def get_all_npcs(self) -> List[Dict]:
         """Ottiene tutti gli NPC"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, name, avatar, description, status, prompt, 
@@ -145,9 +452,42 @@ class ChatDatabase:
             
             return npcs
     
+    @timed_db_method
+    def get_npc_summaries(self) -> List[Dict]:
+        """Ottiene la lista degli NPC per la sidebar, senza il prompt"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, name, avatar, description, status,
+                       last_message, last_message_time, unread_count
+                FROM npcs
+                ORDER BY name
+            ''')
+            
+            return [
+                {
+                    'id': row[0],
+                    'name': row[1],
+                    'avatar': row[2],
+                    'description': row[3],
+                    'status': row[4],
+                    'lastMessage': row[5],
+                    'lastMessageTime': row[6],
+                    'unread': row[7]
+                }
+                for row in cursor.fetchall()
+            ]
+    
+    @timed_db_method
+    def get_npc_names(self) -> List[Tuple[str, str]]:
+        """Ottiene (id, nome) di tutti gli NPC, per risolverli per nome"""
+        with self.connection() as conn:
+            return conn.execute('SELECT id, name FROM npcs ORDER BY name').fetchall()
+    
+    @timed_db_method
     def get_npc_by_id(self, npc_id: str) -> Optional[Dict]:
         """Ottiene un NPC specifico per ID"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT id, name, avatar, description, status, prompt, 
@@ -174,10 +514,11 @@ class ChatDatabase:
                 }
             return None
     
+    @timed_db_method
     def create_npc(self, npc_data: Dict) -> bool:
         """Crea un nuovo NPC"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO npcs (id, name, avatar, description, status, prompt)
@@ -190,14 +531,14 @@ class ChatDatabase:
                     npc_data.get('status', 'online'),
                     npc_data['prompt']
                 ))
-                conn.commit()
                 return True
         except sqlite3.IntegrityError:
             return False  # ID già esistente
     
+    @timed_db_method
     def update_npc(self, npc_id: str, npc_data: Dict) -> bool:
         """Aggiorna un NPC esistente"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE npcs 
@@ -212,120 +553,495 @@ class ChatDatabase:
                 npc_data['prompt'],
                 npc_id
             ))
-            conn.commit()
             return cursor.rowcount > 0
     
+    @timed_db_method
     def delete_npc(self, npc_id: str) -> bool:
         """Elimina un NPC e tutte le sue conversazioni"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             
-            # Elimina le conversazioni dell'NPC
+            # Elimina le conversazioni dell'NPC con i loro messaggi e le sessioni
+            cursor.execute('''
+                DELETE FROM messages
+                WHERE conversation_id IN (SELECT id FROM conversations WHERE npc_id = ?)
+            ''', (npc_id,))
+            cursor.execute('''
+                DELETE FROM archive_index
+                WHERE conversation_id IN (SELECT id FROM conversations WHERE npc_id = ?)
+            ''', (npc_id,))
+            cursor.execute('DELETE FROM user_sessions WHERE npc_id = ?', (npc_id,))
             cursor.execute('DELETE FROM conversations WHERE npc_id = ?', (npc_id,))
             
             # Elimina l'NPC
             cursor.execute('DELETE FROM npcs WHERE id = ?', (npc_id,))
             
-            conn.commit()
             return cursor.rowcount > 0
     
+    @timed_db_method
     def update_npc_last_message(self, npc_id: str, message: str, time: str = None):
         """Aggiorna l'ultimo messaggio di un NPC"""
         if time is None:
             time = datetime.now().strftime("%H:%M")
             
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 UPDATE npcs 
                 SET last_message = ?, last_message_time = ?, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ?
             ''', (message, time, npc_id))
-            conn.commit()
     
+    @timed_db_method
     def get_or_create_conversation(self, npc_id: str, user_id: str = "default_user") -> int:
-        """Ottiene o crea una conversazione per un utente con un NPC specifico"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Ottiene o crea una conversazione per un utente con un NPC specifico.
+        
+        L'indice univoco su (npc_id, user_id) garantisce una sola conversazione
+        anche se due primi messaggi arrivano insieme.
+        """
+        with self.connection() as conn:
             cursor = conn.cursor()
             
-            # Cerca una conversazione esistente
+            # Crea la conversazione o, se esiste già, aggiorna il timestamp di attività
+            cursor.execute('''
+                INSERT INTO conversations (npc_id, user_id, title)
+                VALUES (?, ?, ?)
+                ON CONFLICT (npc_id, user_id) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+            ''', (npc_id, user_id, f"Chat con {npc_id}"))
+            cursor.execute('''
+                SELECT id FROM conversations 
+                WHERE npc_id = ? AND user_id = ?
+            ''', (npc_id, user_id))
+            
+            return cursor.fetchone()[0]
+    
+    @timed_db_method
+    def find_conversation(self, npc_id: str, user_id: str = "default_user") -> Optional[int]:
+        """Cerca la conversazione di un utente con un NPC senza crearla"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
                 SELECT id FROM conversations 
                 WHERE npc_id = ? AND user_id = ?
-                ORDER BY updated_at DESC LIMIT 1
             ''', (npc_id, user_id))
             
             result = cursor.fetchone()
+            return result[0] if result else None
+    
+    @timed_db_method
+    def record_turn(self, npc_id: str, user_id: str, user_message: str, npc_reply: str,
+                    conversation_id: Optional[int] = None,
+                    update_npc_last_message: bool = True,
+                    user_tokens: Optional[int] = None, reply_tokens: Optional[int] = None,
+                    llm_context: Optional[Dict] = None) -> int:
+        """Registra un turno completo (messaggio utente + risposta NPC) in un'unica transazione.
+        
+        Crea la conversazione se necessario, inserisce i due messaggi (con il loro
+        numero di token, se noto), aggiorna i contatori e, se richiesto, l'ultimo
+        messaggio dell'NPC. Se `llm_context` è indicato salva anche il contesto di
+        Ollama (un dizionario vuoto lo cancella). Restituisce l'ID della
+        conversazione. In modalità write-behind il turno viene accodato.
+        """
+        if self.writer:
+            if conversation_id is None:
+                conversation_id = self.find_conversation(npc_id, user_id)
+            if conversation_id is None:
+                conversation_id = self.get_or_create_conversation(npc_id, user_id)
+            self.writer.submit(
+                self._record_turn,
+                (npc_id, user_id, user_message, npc_reply, conversation_id,
+                 update_npc_last_message, user_tokens, reply_tokens, llm_context),
+                [(conversation_id, "user", user_message, user_tokens),
+                 (conversation_id, "npc", npc_reply, reply_tokens)],
+            )
+            return conversation_id
+        
+        return self._record_turn(npc_id, user_id, user_message, npc_reply, conversation_id,
+                                 update_npc_last_message, user_tokens, reply_tokens, llm_context)
+    
+    def _record_turn(self, npc_id: str, user_id: str, user_message: str, npc_reply: str,
+                     conversation_id: Optional[int], update_npc_last_message: bool,
+                     user_tokens: Optional[int], reply_tokens: Optional[int],
+                     llm_context: Optional[Dict]) -> int:
+        with self.transaction() as conn:
+            if conversation_id is None:
+                conversation_id = self.get_or_create_conversation(npc_id, user_id)
             
-            if result:
-                conversation_id = result[0]
-                # Aggiorna il timestamp di attività
-                cursor.execute('''
-                    UPDATE conversations 
-                    SET updated_at = CURRENT_TIMESTAMP 
-                    WHERE id = ?
-                ''', (conversation_id,))
-            else:
-                # Crea una nuova conversazione
-                cursor.execute('''
-                    INSERT INTO conversations (npc_id, user_id, title)
-                    VALUES (?, ?, ?)
-                ''', (npc_id, user_id, f"Chat con {npc_id}"))
-                conversation_id = cursor.lastrowid
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO messages (conversation_id, sender, content, token_count)
+                VALUES (?, ?, ?, ?)
+            ''', [
+                (conversation_id, "user", user_message, user_tokens),
+                (conversation_id, "npc", npc_reply, reply_tokens),
+            ])
             
-            conn.commit()
-            return conversation_id
+            # last_insert_rowid() è l'id della risposta, l'ultimo messaggio inserito
+            cursor.execute('''
+                UPDATE conversations 
+                SET message_count = message_count + 2, 
+                    updated_at = CURRENT_TIMESTAMP,
+                    last_message_id = last_insert_rowid(),
+                    last_message_preview = ?
+                WHERE id = ?
+            ''', (npc_reply[:LAST_MESSAGE_PREVIEW_CHARS], conversation_id))
+            
+            if llm_context is not None:
+                self.set_llm_context(conversation_id, **llm_context)
+            
+            if update_npc_last_message:
+                self.update_npc_last_message(npc_id, npc_reply)
+        
+        return conversation_id
     
-    def add_message(self, conversation_id: int, sender: str, content: str) -> int:
-        """Aggiunge un messaggio alla conversazione"""
-        with sqlite3.connect(self.db_path) as conn:
+    @timed_db_method
+    def get_llm_context(self, conversation_id: int) -> Optional[Dict]:
+        """Ottiene l'ultimo contesto di Ollama salvato per una conversazione"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT llm_context, llm_context_model, llm_context_prompt_hash
+                FROM conversations
+                WHERE id = ?
+            ''', (conversation_id,))
+            
+            row = cursor.fetchone()
+            if not row or row[0] is None:
+                return None
+            
+            context = array('i')
+            context.frombytes(row[0])
+            return {
+                'context': context.tolist(),
+                'model': row[1],
+                'prompt_hash': row[2]
+            }
+    
+    @timed_db_method
+    def set_llm_context(self, conversation_id: int, context: Optional[List[int]] = None,
+                        model: Optional[str] = None, prompt_hash: Optional[str] = None):
+        """Salva (o, senza `context`, cancella) il contesto di Ollama di una conversazione"""
+        blob = array('i', context).tobytes() if context else None
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE conversations
+                SET llm_context = ?, llm_context_model = ?, llm_context_prompt_hash = ?
+                WHERE id = ?
+            ''', (blob, model if blob else None, prompt_hash if blob else None, conversation_id))
+    
+    @timed_db_method
+    def add_message(self, conversation_id: int, sender: str, content: str,
+                    token_count: Optional[int] = None) -> Optional[int]:
+        """Aggiunge un messaggio alla conversazione.
+        
+        In modalità write-behind il messaggio viene accodato e restituisce None.
+        """
+        if self.writer:
+            self.writer.submit(self._add_message, (conversation_id, sender, content, token_count),
+                               [(conversation_id, sender, content, token_count)])
+            return None
+        return self._add_message(conversation_id, sender, content, token_count)
+    
+    def _add_message(self, conversation_id: int, sender: str, content: str,
+                     token_count: Optional[int]) -> int:
+        with self.connection() as conn:
             cursor = conn.cursor()
             
             # Inserisce il messaggio
             cursor.execute('''
-                INSERT INTO messages (conversation_id, sender, content)
-                VALUES (?, ?, ?)
-            ''', (conversation_id, sender, content))
+                INSERT INTO messages (conversation_id, sender, content, token_count)
+                VALUES (?, ?, ?, ?)
+            ''', (conversation_id, sender, content, token_count))
             
             message_id = cursor.lastrowid
             
-            # Aggiorna il contatore dei messaggi e il timestamp della conversazione
+            # Aggiorna contatore, timestamp e ultimo messaggio della conversazione
             cursor.execute('''
                 UPDATE conversations 
                 SET message_count = message_count + 1, 
-                    updated_at = CURRENT_TIMESTAMP
+                    updated_at = CURRENT_TIMESTAMP,
+                    last_message_id = ?,
+                    last_message_preview = ?
                 WHERE id = ?
-            ''', (conversation_id,))
+            ''', (message_id, content[:LAST_MESSAGE_PREVIEW_CHARS], conversation_id))
             
-            conn.commit()
             return message_id
     
+    @contextmanager
+    def _pending_view(self):
+        """Blocca i commit della coda mentre si leggono database e scritture pendenti"""
+        if self.writer:
+            with self.writer.pending_lock:
+                yield
+        else:
+            yield
+    
+    def _pending_messages(self, conversation_id: int) -> List[Dict]:
+        return self.writer.pending_messages(conversation_id) if self.writer else []
+    
+    def _archived_rows(self, conn: sqlite3.Connection, conversation_id: int, limit: int,
+                       after_id: int = 0, before_id: Optional[int] = None,
+                       descending: bool = False) -> List[tuple]:
+        """Messaggi archiviati (id, sender, content, timestamp, token_count) con id in (after_id, before_id).
+        
+        I messaggi archiviati di una conversazione hanno sempre id minori di quelli
+        ancora nella tabella messages, quindi le letture li accodano (o li
+        antepongono) ai risultati senza doverli riordinare.
+        """
+        if limit <= 0:
+            return []
+        before = "AND first_id < ?" if before_id is not None else ""
+        params = (before_id,) if before_id is not None else ()
+        blocks = conn.execute(f'''
+            SELECT segment, offset, length, crc32
+            FROM archive_index
+            WHERE conversation_id = ? AND last_id > ? {before}
+            ORDER BY first_id {"DESC" if descending else "ASC"}
+        ''', (conversation_id, after_id, *params)).fetchall()
+        
+        rows = []
+        for block in blocks:
+            block_rows = [
+                row for row in self.archive.read(*block)
+                if row[0] > after_id and (before_id is None or row[0] < before_id)
+            ]
+            rows.extend(reversed(block_rows) if descending else block_rows)
+            if len(rows) >= limit:
+                break
+        return rows[:limit]
+    
+    @timed_db_method
     def get_conversation_history(self, conversation_id: int, limit: int = 50) -> List[Dict]:
         """Ottiene lo storico di una conversazione"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn, self._pending_view():
             cursor = conn.cursor()
             
+            # I messaggi più vecchi possono essere nell'archivio
+            archived = self._archived_rows(conn, conversation_id, limit)
             cursor.execute('''
-                SELECT sender, content, timestamp
+                SELECT id, sender, content, timestamp
                 FROM messages 
                 WHERE conversation_id = ?
-                ORDER BY timestamp ASC
+                ORDER BY id ASC
                 LIMIT ?
-            ''', (conversation_id, limit))
+            ''', (conversation_id, limit - len(archived)))
             
             messages = []
-            for row in cursor.fetchall():
+            for row in [row[:4] for row in archived] + cursor.fetchall():
+                messages.append({
+                    'sender': row[1],
+                    'content': row[2],
+                    'timestamp': row[3]
+                })
+            
+            # Includi i messaggi ancora in coda di scrittura, con le stesse chiavi
+            messages.extend({
+                'sender': message['sender'],
+                'content': message['content'],
+                'timestamp': message['timestamp']
+            } for message in self._pending_messages(conversation_id))
+            return messages[:limit]
+    
+    @timed_db_method
+    def get_message_page(self, conversation_id: int, limit: int = 50,
+                         before_id: Optional[int] = None, after_id: Optional[int] = None) -> Dict:
+        """Pagina di messaggi con paginazione per chiave (cursore sull'id del messaggio).
+        
+        Senza cursori restituisce i messaggi più recenti; con `before_id` quelli
+        precedenti, con `after_id` quelli successivi. I messaggi della pagina sono
+        sempre in ordine cronologico e `has_more` indica se ce ne sono altri nella
+        direzione richiesta. Ogni pagina è una sola ricerca sull'indice
+        (conversation_id, id), qualunque sia la lunghezza della conversazione;
+        l'archivio viene letto solo per le pagine che vi arrivano.
+        """
+        with self.connection() as conn, self._pending_view():
+            cursor = conn.cursor()
+            
+            if after_id is not None:
+                rows = [row[:4] for row in self._archived_rows(conn, conversation_id, limit + 1, after_id=after_id)]
+                cursor.execute('''
+                    SELECT id, sender, content, timestamp
+                    FROM messages
+                    WHERE conversation_id = ? AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                ''', (conversation_id, after_id, limit + 1 - len(rows)))
+                rows += cursor.fetchall()
+            else:
+                before = "AND id < ?" if before_id is not None else ""
+                params = (before_id,) if before_id is not None else ()
+                cursor.execute(f'''
+                    SELECT id, sender, content, timestamp
+                    FROM messages
+                    WHERE conversation_id = ? {before}
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (conversation_id, *params, limit + 1))
+                rows = cursor.fetchall()
+                # Pagina non piena: continua con i messaggi archiviati
+                rows += [row[:4] for row in self._archived_rows(
+                    conn, conversation_id, limit + 1 - len(rows), before_id=before_id, descending=True
+                )]
+            
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if after_id is None:
+                rows.reverse()
+            
+            messages = [{
+                'id': row[0],
+                'sender': row[1],
+                'content': row[2],
+                'timestamp': row[3]
+            } for row in rows]
+            
+            # I messaggi ancora in coda di scrittura chiudono la pagina più recente
+            reaches_end = before_id is None and (after_id is None or not has_more)
+            if reaches_end:
+                messages.extend({
+                    'id': None,
+                    'sender': message['sender'],
+                    'content': message['content'],
+                    'timestamp': message['timestamp']
+                } for message in self._pending_messages(conversation_id))
+            
+            return {'messages': messages, 'has_more': has_more}
+    
+    @timed_db_method
+    def get_recent_messages(self, conversation_id: int, limit: int = 10, after_id: int = 0) -> List[Dict]:
+        """Ottiene gli ultimi `limit` messaggi di una conversazione, in ordine cronologico.
+        
+        Legge la coda dall'indice (conversation_id, id) al contrario, quindi il costo
+        non dipende dalla lunghezza della conversazione. Con `after_id` si escludono
+        i messaggi precedenti (es. quelli già riassunti).
+        """
+        with self.connection() as conn, self._pending_view():
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT id, sender, content, timestamp, token_count
+                FROM messages 
+                WHERE conversation_id = ? AND id > ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (conversation_id, after_id, limit))
+            rows = cursor.fetchall()
+            rows += self._archived_rows(conn, conversation_id, limit - len(rows), after_id=after_id, descending=True)
+            
+            messages = []
+            for row in reversed(rows):
                 messages.append({
-                    'sender': row[0],
-                    'content': row[1],
-                    'timestamp': row[2]
+                    'id': row[0],
+                    'sender': row[1],
+                    'content': row[2],
+                    'timestamp': row[3],
+                    'token_count': row[4]
                 })
             
-            return messages
+            # I messaggi ancora in coda di scrittura sono i più recenti
+            messages.extend(self._pending_messages(conversation_id))
+            return messages[-limit:] if limit > 0 else []
+    
+    @timed_db_method
+    def get_messages_after(self, conversation_id: int, after_id: int = 0, limit: int = 50) -> List[Dict]:
+        """Ottiene i primi `limit` messaggi successivi a `after_id`, in ordine cronologico"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            archived = self._archived_rows(conn, conversation_id, limit, after_id=after_id)
+            cursor.execute('''
+                SELECT id, sender, content, timestamp, token_count
+                FROM messages 
+                WHERE conversation_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (conversation_id, after_id, limit - len(archived)))
+            
+            return [{
+                'id': row[0],
+                'sender': row[1],
+                'content': row[2],
+                'timestamp': row[3],
+                'token_count': row[4]
+            } for row in archived + cursor.fetchall()]
+    
+    @timed_db_method
+    def get_messages_by_ids(self, conversation_id: int, message_ids: List[int]) -> List[Dict]:
+        """Ottiene i messaggi di una conversazione con gli id indicati, in ordine cronologico.
+
+        Gli id assenti dalla tabella messages vengono cercati nell'archivio, leggendo
+        solo il blocco che li contiene; quelli inesistenti vengono ignorati.
+        """
+        if not message_ids:
+            return []
+        with self.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, sender, content, timestamp, token_count
+                FROM messages
+                WHERE conversation_id = ? AND id IN (SELECT value FROM json_each(?))
+            ''', (conversation_id, json.dumps(list(message_ids)))).fetchall()
+            found = {row[0] for row in rows}
+            for message_id in message_ids:
+                if message_id not in found:
+                    rows += self._archived_rows(conn, conversation_id, 1,
+                                                after_id=message_id - 1, before_id=message_id + 1)
+
+            return [{
+                'id': row[0],
+                'sender': row[1],
+                'content': row[2],
+                'timestamp': row[3],
+                'token_count': row[4]
+            } for row in sorted(rows)]
+
+    @timed_db_method
+    def get_conversation_ids(self, after_id: int = 0, limit: int = 500) -> List[int]:
+        """Id delle conversazioni successive a `after_id`, in ordine (per scorrerle tutte a pagine)"""
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute(
+                'SELECT id FROM conversations WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit)
+            )]
+
+    @timed_db_method
+    def get_existing_conversation_ids(self, conversation_ids: List[int]) -> Set[int]:
+        """Tra gli id indicati, quelli di conversazioni ancora presenti nel database"""
+        with self.connection() as conn:
+            return {row[0] for row in conn.execute(
+                'SELECT id FROM conversations WHERE id IN (SELECT value FROM json_each(?))',
+                (json.dumps(list(conversation_ids)),)
+            )}
+
+    @timed_db_method
+    def get_summary(self, conversation_id: int) -> Dict:
+        """Ottiene il riassunto di una conversazione e l'ultimo messaggio che include"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT summary, summary_upto_id FROM conversations WHERE id = ?
+            ''', (conversation_id,))
+            
+            row = cursor.fetchone()
+            return {
+                'summary': (row[0] or "") if row else "",
+                'upto_id': (row[1] or 0) if row else 0
+            }
+    
+    @timed_db_method
+    def set_summary(self, conversation_id: int, summary: str, upto_id: int, previous_upto_id: int) -> bool:
+        """Aggiorna il riassunto, solo se nel frattempo non è stato aggiornato da altri"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE conversations
+                SET summary = ?, summary_upto_id = ?
+                WHERE id = ? AND COALESCE(summary_upto_id, 0) = ?
+            ''', (summary, upto_id, conversation_id, previous_upto_id))
+            return cursor.rowcount > 0
     
+    @timed_db_method
     def get_conversation_context(self, conversation_id: int, max_messages: int = 10) -> str:
-        """Ottiene il contesto della conversazione per l'LLM"""
-        messages = self.get_conversation_history(conversation_id, max_messages)
+        """Ottiene il contesto della conversazione per l'LLM (ultimi `max_messages` messaggi)"""
+        messages = self.get_recent_messages(conversation_id, max_messages)
         
         if not messages:
             return ""
@@ -337,22 +1053,19 @@ class ChatDatabase:
         
         return context
     
+    @timed_db_method
     def get_user_conversations(self, user_id: str = "default_user", limit: int = 20) -> List[Dict]:
         """Ottiene le conversazioni di un utente"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.connection() as conn:
             cursor = conn.cursor()
             
+            # Scansione dell'indice (user_id, updated_at DESC): nessun ordinamento né subquery
             cursor.execute('''
-                SELECT c.id, c.npc_id, c.title, c.message_count, c.updated_at,
-                       m.content as last_message
-                FROM conversations c
-                LEFT JOIN messages m ON m.id = (
-                    SELECT id FROM messages 
-                    WHERE conversation_id = c.id 
-                    ORDER BY timestamp DESC LIMIT 1
-                )
-                WHERE c.user_id = ?
-                ORDER BY c.updated_at DESC
+                SELECT id, npc_id, title, message_count, updated_at,
+                       last_message_preview, last_message_id
+                FROM conversations
+                WHERE user_id = ?
+                ORDER BY updated_at DESC
                 LIMIT ?
             ''', (user_id, limit))
             
@@ -364,71 +1077,496 @@ class ChatDatabase:
                     'title': row[2],
                     'message_count': row[3],
                     'updated_at': row[4],
-                    'last_message': row[5] or ""
+                    'last_message': row[5] or "",
+                    'last_message_id': row[6]
                 })
             
             return conversations
     
+    @timed_db_method
     def delete_conversation(self, conversation_id: int) -> bool:
-        """Elimina una conversazione e tutti i suoi messaggi"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Elimina una conversazione con i suoi messaggi e le sue sessioni"""
+        with self.connection() as conn:
             cursor = conn.cursor()
             
-            # Elimina i messaggi
+            # Elimina i messaggi e le sessioni
             cursor.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+            cursor.execute('DELETE FROM user_sessions WHERE conversation_id = ?', (conversation_id,))
+            cursor.execute('DELETE FROM archive_index WHERE conversation_id = ?', (conversation_id,))
             
             # Elimina la conversazione
             cursor.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
             
-            conn.commit()
             return cursor.rowcount > 0
     
+    @timed_db_method
     def get_conversation_stats(self, npc_id: str = None) -> Dict:
-        """Ottiene statistiche sulle conversazioni"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Ottiene statistiche sulle conversazioni (lette dalla tabella conversation_stats)"""
+        with self.connection() as conn:
             cursor = conn.cursor()
-            
-            if npc_id:
-                cursor.execute('''
-                    SELECT COUNT(*) as total_conversations,
-                           SUM(message_count) as total_messages,
-                           AVG(message_count) as avg_messages
-                    FROM conversations 
-                    WHERE npc_id = ?
-                ''', (npc_id,))
-            else:
-                cursor.execute('''
-                    SELECT COUNT(*) as total_conversations,
-                           SUM(message_count) as total_messages,
-                           AVG(message_count) as avg_messages
-                    FROM conversations
-                ''')
+            cursor.execute('''
+                SELECT total_conversations, total_messages
+                FROM conversation_stats
+                WHERE npc_id = ?
+            ''', (npc_id or '*',))
             
             row = cursor.fetchone()
+            total_conversations, total_messages = row if row else (0, 0)
             return {
-                'total_conversations': row[0] or 0,
-                'total_messages': row[1] or 0,
-                'avg_messages': row[2] or 0
+                'total_conversations': total_conversations,
+                'total_messages': total_messages,
+                'avg_messages': total_messages / total_conversations if total_conversations else 0
             }
     
-    def cleanup_old_conversations(self, days_old: int = 30) -> int:
-        """Pulisce le conversazioni vecchie"""
-        with sqlite3.connect(self.db_path) as conn:
+    @timed_db_method
+    def rebuild_stats(self):
+        """Ricalcola da zero le statistiche delle conversazioni (per ripristino)"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM conversation_stats')
+            cursor.execute('''
+                INSERT INTO conversation_stats (npc_id, total_conversations, total_messages)
+                SELECT npc_id, COUNT(*), COALESCE(SUM(message_count), 0)
+                FROM conversations
+                GROUP BY npc_id
+            ''')
+            cursor.execute('''
+                INSERT INTO conversation_stats (npc_id, total_conversations, total_messages)
+                SELECT '*', COALESCE(SUM(total_conversations), 0), COALESCE(SUM(total_messages), 0)
+                FROM conversation_stats
+            ''')
+    
+    @timed_db_method
+    def get_activity_timeseries(self, bucket_size: str, start: str, end: str,
+                                npc_id: Optional[str] = None, user_id: Optional[str] = None) -> List[Dict]:
+        """Messaggi per bucket nell'intervallo [start, end), per NPC, per utente o in totale.
+        
+        Somma gli aggregati di activity_rollups e i contatori al minuto non ancora
+        riportati dalla manutenzione (activity_minutes, pochi per costruzione);
+        i bucket senza messaggi non compaiono.
+        """
+        with self.connection() as conn:
             cursor = conn.cursor()
+            cursor.execute('''
+                SELECT bucket_start, SUM(messages), SUM(user_messages) FROM (
+                    SELECT bucket_start, messages, user_messages
+                    FROM activity_rollups
+                    WHERE bucket_size = :bucket_size AND npc_id = :npc AND user_id = :usr
+                      AND bucket_start >= :start AND bucket_start < :end
+                    UNION ALL
+                    SELECT strftime(:format, bucket_start), messages, user_messages
+                    FROM activity_minutes
+                    WHERE (:npc = '*' OR npc_id = :npc) AND (:usr = '*' OR user_id = :usr)
+                )
+                WHERE bucket_start >= :start AND bucket_start < :end
+                GROUP BY bucket_start
+                ORDER BY bucket_start
+            ''', {'bucket_size': bucket_size, 'format': ACTIVITY_BUCKETS[bucket_size],
+                  'npc': npc_id or '*', 'usr': user_id or '*', 'start': start, 'end': end})
             
-            # Trova le conversazioni da eliminare
+            return [
+                {
+                    'bucket_start': row[0],
+                    'messages': row[1],
+                    'user_messages': row[2],
+                    'npc_messages': row[1] - row[2]
+                }
+                for row in cursor.fetchall()
+            ]
+    
+    @timed_db_method
+    def fold_activity_rollups(self) -> int:
+        """Riporta i contatori al minuto in activity_rollups (tutti i bucket e le dimensioni).
+        
+        Il trigger sui messaggi aggiorna solo activity_minutes, una riga per NPC,
+        utente e minuto; qui, in una sola transazione, i contatori vengono sommati
+        agli aggregati ed eliminati. Restituisce le righe riportate.
+        """
+        with self.transaction() as conn:
+            rows = conn.execute('SELECT COUNT(*) FROM activity_minutes').fetchone()[0]
+            if not rows:
+                return 0
+            for bucket_size, fmt in ACTIVITY_BUCKETS.items():
+                for npc_expr, user_expr in ACTIVITY_SCOPES.values():
+                    conn.execute(f'''
+                        INSERT INTO activity_rollups
+                            (bucket_size, npc_id, user_id, bucket_start, messages, user_messages)
+                        SELECT ?, {npc_expr}, {user_expr}, strftime(?, bucket_start),
+                               SUM(messages), SUM(user_messages)
+                        FROM activity_minutes
+                        WHERE true
+                        GROUP BY 2, 3, 4
+                        ON CONFLICT (bucket_size, npc_id, user_id, bucket_start) DO UPDATE
+                        SET messages = messages + excluded.messages,
+                            user_messages = user_messages + excluded.user_messages
+                    ''', (bucket_size, fmt))
+            conn.execute('DELETE FROM activity_minutes')
+        return rows
+    
+    @timed_db_method
+    def prune_activity_rollups(self) -> int:
+        """Elimina i bucket più vecchi del periodo di conservazione; restituisce le righe eliminate"""
+        deleted = 0
+        now = datetime.utcnow()
+        with self.transaction() as conn:
+            for bucket_size, retention in ACTIVITY_RETENTION.items():
+                if not retention:
+                    continue
+                cutoff = (now - retention).strftime("%Y-%m-%d %H:%M:%S")
+                deleted += conn.execute(
+                    'DELETE FROM activity_rollups WHERE bucket_size = ? AND bucket_start < ?',
+                    (bucket_size, cutoff)
+                ).rowcount
+        return deleted
+    
+    @timed_db_method
+    def rebuild_activity_rollups(self):
+        """Ricalcola gli aggregati di attività dalla tabella messages (per ripristino).
+        
+        I messaggi già archiviati non sono più nella tabella: i loro bucket vanno persi.
+        """
+        now = datetime.utcnow()
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM activity_rollups')
+            # Assente se la ricostruzione avviene durante la migrazione che crea activity_rollups
+            if conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activity_minutes'"
+            ).fetchone():
+                conn.execute('DELETE FROM activity_minutes')
+            for bucket_size, fmt in ACTIVITY_BUCKETS.items():
+                retention = ACTIVITY_RETENTION[bucket_size]
+                since = (now - retention).strftime("%Y-%m-%d %H:%M:%S") if retention else ''
+                for npc_expr, user_expr in ACTIVITY_SCOPES.values():
+                    conn.execute(f'''
+                        INSERT INTO activity_rollups
+                            (bucket_size, npc_id, user_id, bucket_start, messages, user_messages)
+                        SELECT ?, {npc_expr}, {user_expr}, strftime(?, m.timestamp),
+                               COUNT(*), SUM(m.sender = 'user')
+                        FROM messages m
+                        JOIN conversations c ON c.id = m.conversation_id
+                        WHERE m.timestamp >= ?
+                        GROUP BY 2, 3, 4
+                    ''', (bucket_size, fmt, since))
+    
+    def _in_batches(self, delete_batch, batch_size: int, pause: float) -> Dict:
+        """Ripete `delete_batch` (una transazione per chiamata) finché elimina meno di `batch_size` elementi.
+        
+        Tra un batch e l'altro il lock di scrittura è libero per `pause` secondi.
+        Restituisce le righe eliminate per tabella.
+        """
+        totals: Dict[str, int] = {}
+        while True:
+            deleted = delete_batch(batch_size)
+            for table, count in deleted.items():
+                totals[table] = totals.get(table, 0) + count
+            if deleted['batch'] < batch_size:
+                break
+            time.sleep(pause)
+        totals.pop('batch')
+        return totals
+    
+    def _delete_conversation_batch(self, conn: sqlite3.Connection) -> Dict:
+        """Elimina le conversazioni nella tabella temporanea prune_batch, con messaggi e sessioni"""
+        deleted = {
+            'batch': conn.execute('SELECT COUNT(*) FROM prune_batch').fetchone()[0],
+            'messages': conn.execute(
+                'DELETE FROM messages WHERE conversation_id IN (SELECT id FROM prune_batch)'
+            ).rowcount,
+            'user_sessions': conn.execute(
+                'DELETE FROM user_sessions WHERE conversation_id IN (SELECT id FROM prune_batch)'
+            ).rowcount,
+            'archived_blocks': conn.execute(
+                'DELETE FROM archive_index WHERE conversation_id IN (SELECT id FROM prune_batch)'
+            ).rowcount,
+            'conversations': conn.execute(
+                'DELETE FROM conversations WHERE id IN (SELECT id FROM prune_batch)'
+            ).rowcount,
+        }
+        conn.execute('DROP TABLE prune_batch')
+        return deleted
+    
+    @timed_db_method
+    def delete_old_conversations_batch(self, days_old: int, batch_size: int = MAINTENANCE_BATCH_SIZE) -> Dict:
+        """Elimina in una transazione fino a `batch_size` conversazioni inattive da più di `days_old` giorni"""
+        with self.transaction() as conn:
+            conn.execute('CREATE TEMP TABLE prune_batch (id INTEGER PRIMARY KEY)')
+            conn.execute('''
+                INSERT INTO prune_batch (id)
+                SELECT id FROM conversations
+                WHERE updated_at < datetime('now', ?)
+                LIMIT ?
+            ''', (f'-{int(days_old)} days', batch_size))
+            return self._delete_conversation_batch(conn)
+    
+    def _find_orphan_conversations(self, after_id: int, limit: int) -> Tuple[List[int], Optional[int]]:
+        """Cerca fino a `limit` conversazioni mancanti che hanno ancora messaggi, dopo `after_id`.
+    
+        Scorre gli id distinti di messages in ordine di chiave, con un salto
+        sull'indice (conversation_id, id) per ognuno, fuori da transazioni di
+        scrittura. Restituisce gli orfani trovati e il cursore da cui riprendere
+        (None a fine indice).
+        """
+        orphans = []
+        with self.connection() as conn:
+            while len(orphans) < limit:
+                row = conn.execute('''
+                    SELECT conversation_id FROM messages
+                    WHERE conversation_id > ?
+                    ORDER BY conversation_id
+                    LIMIT 1
+                ''', (after_id,)).fetchone()
+                if row is None:
+                    return orphans, None
+                after_id = row[0]
+                if conn.execute('SELECT 1 FROM conversations WHERE id = ?', (after_id,)).fetchone() is None:
+                    orphans.append(after_id)
+        return orphans, after_id
+    
+    def _find_orphan_blocks_and_conversations(self) -> List[int]:
+        """Conversazioni mancanti con blocchi archiviati e conversazioni di NPC eliminati (senza lock)"""
+        with self.connection() as conn:
+            return [row[0] for row in conn.execute('''
+                SELECT DISTINCT conversation_id FROM archive_index
+                WHERE conversation_id NOT IN (SELECT id FROM conversations)
+                UNION
+                SELECT id FROM conversations
+                WHERE npc_id NOT IN (SELECT id FROM npcs)
+            ''')]
+    
+    @timed_db_method
+    def delete_orphans_batch(self, conversation_ids: List[int]) -> Dict:
+        """Elimina in una transazione breve le conversazioni orfane indicate, con messaggi e sessioni.
+    
+        Gli id vengono ricontrollati dentro la transazione, per chiave primaria:
+        una conversazione tornata valida nel frattempo (es. NPC ricreato) resta.
+        """
+        with self.transaction() as conn:
+            conn.execute('CREATE TEMP TABLE prune_batch (id INTEGER PRIMARY KEY)')
+            conn.executemany('INSERT OR IGNORE INTO prune_batch (id) VALUES (?)',
+                             [(conversation_id,) for conversation_id in conversation_ids])
+            conn.execute('''
+                DELETE FROM prune_batch
+                WHERE id IN (
+                    SELECT c.id FROM prune_batch p
+                    JOIN conversations c ON c.id = p.id
+                    JOIN npcs n ON n.id = c.npc_id
+                )
+            ''')
+            return self._delete_conversation_batch(conn)
+    
+    @timed_db_method
+    def delete_orphan_sessions(self) -> int:
+        """Elimina le sessioni di NPC o conversazioni che non esistono più"""
+        with self.transaction() as conn:
+            return conn.execute('''
+                DELETE FROM user_sessions
+                WHERE npc_id NOT IN (SELECT id FROM npcs)
+                   OR (conversation_id IS NOT NULL AND conversation_id NOT IN (SELECT id FROM conversations))
+            ''').rowcount
+    
+    @timed_db_method
+    def prune_old_conversations(self, days_old: int, batch_size: int = MAINTENANCE_BATCH_SIZE,
+                                pause: float = MAINTENANCE_BATCH_PAUSE_MS / 1000) -> Dict:
+        """Elimina a batch le conversazioni inattive da più di `days_old` giorni; restituisce le righe eliminate"""
+        return self._in_batches(
+            lambda size: self.delete_old_conversations_batch(days_old, size), batch_size, pause
+        )
+    
+    @timed_db_method
+    def prune_orphans(self, batch_size: int = MAINTENANCE_BATCH_SIZE,
+                      pause: float = MAINTENANCE_BATCH_PAUSE_MS / 1000) -> Dict:
+        """Elimina a batch messaggi, sessioni e conversazioni orfani; restituisce le righe eliminate.
+    
+        Gli orfani si cercano senza tenere il lock di scrittura; ogni batch di
+        `batch_size` conversazioni viene poi eliminato in una transazione breve.
+        """
+        totals = {'messages': 0, 'user_sessions': 0, 'archived_blocks': 0, 'conversations': 0}
+    
+        def delete(conversation_ids: List[int]):
+            for table, count in self.delete_orphans_batch(conversation_ids).items():
+                if table != 'batch':
+                    totals[table] += count
+            time.sleep(pause)
+    
+        after_id = 0
+        while after_id is not None:
+            orphans, after_id = self._find_orphan_conversations(after_id, batch_size)
+            if orphans:
+                delete(orphans)
+        others = self._find_orphan_blocks_and_conversations()
+        for start in range(0, len(others), batch_size):
+            delete(others[start:start + batch_size])
+        totals['user_sessions'] += self.delete_orphan_sessions()
+        return totals
+    
+    @timed_db_method
+    def search_messages(self, terms: List[str], npc_id: Optional[str] = None, user_id: Optional[str] = None,
+                        limit: int = 20, offset: int = 0) -> Dict:
+        """Cerca i messaggi che contengono tutti i `terms`, dal più pertinente (bm25).
+        
+        Ogni termine (parola o frase) viene quotato, quindi non può usare la
+        sintassi FTS5 né uscire dalla colonna del testo; `parola*` cerca per
+        prefisso. Solleva ValueError se non resta nessun termine da cercare.
+        I filtri per NPC e utente fanno parte della query FTS5. La pertinenza viene
+        calcolata sulle `SEARCH_MAX_CANDIDATES` corrispondenze più recenti, così il
+        costo resta limitato anche per termini presenti in milioni di messaggi
+        (`truncated` indica che ce n'erano di più). Lo snippet, con i termini
+        trovati tra parentesi quadre, si calcola solo per la pagina restituita.
+        I messaggi archiviati non sono nell'indice.
+        """
+        parts = []
+        for term in terms:
+            prefix = len(term) > 1 and term.endswith("*")
+            term = term.rstrip("*") if prefix else term
+            if term.strip():
+                parts.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+        if not parts:
+            raise ValueError("Specifica almeno una parola da cercare")
+        
+        query = f"{{content}}: ({' '.join(parts)})"
+        if npc_id:
+            query += f' AND {{npc}}: "{npc_id.encode().hex()}"'
+        if user_id:
+            query += f' AND {{usr}}: "{user_id.encode().hex()}"'
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                SELECT id FROM conversations 
-                WHERE updated_at < datetime('now', '-{} days')
-            '''.format(days_old))
+                SELECT rowid, score FROM (
+                    SELECT rowid, bm25(messages_fts, 1.0, 0.0, 0.0) AS score
+                    FROM messages_fts
+                    WHERE messages_fts MATCH ?
+                    ORDER BY rowid DESC
+                    LIMIT ?
+                )
+                ORDER BY score, rowid DESC
+            ''', (query, SEARCH_MAX_CANDIDATES))
+            candidates = cursor.fetchall()
+            page = candidates[offset:offset + limit]
             
-            old_conversations = [row[0] for row in cursor.fetchall()]
+            results = []
+            for message_id, score in page:
+                row = cursor.execute('''
+                    SELECT m.conversation_id, c.npc_id, c.user_id, m.sender, m.timestamp,
+                           (SELECT snippet(messages_fts, 0, '[', ']', '…', 16)
+                            FROM messages_fts WHERE messages_fts MATCH ? AND rowid = m.id)
+                    FROM messages m
+                    JOIN conversations c ON c.id = m.conversation_id
+                    WHERE m.id = ?
+                ''', (query, message_id)).fetchone()
+                if row is None:
+                    continue
+                results.append({
+                    'message_id': message_id,
+                    'conversation_id': row[0],
+                    'npc_id': row[1],
+                    'user_id': row[2],
+                    'sender': row[3],
+                    'timestamp': row[4],
+                    'snippet': row[5],
+                    'score': round(-score, 6)
+                })
             
-            # Elimina le conversazioni e i messaggi associati
-            for conv_id in old_conversations:
-                self.delete_conversation(conv_id)
+            return {
+                'results': results,
+                'has_more': len(candidates) > offset + limit,
+                'truncated': len(candidates) >= SEARCH_MAX_CANDIDATES
+            }
+    
+    @timed_db_method
+    def rebuild_search_index(self):
+        """Crea (se manca) e ricostruisce l'indice full-text dalla tabella messages"""
+        with self.transaction() as conn:
+            create_message_search(conn.cursor())
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            # Unisce i segmenti dell'indice per letture più veloci
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        self.search_enabled = True
+    
+    @timed_db_method
+    def archive_conversations_batch(self, days_idle: int, batch_size: int = ARCHIVE_BATCH_SIZE) -> Dict:
+        """Sposta nell'archivio i messaggi di fino a `batch_size` conversazioni inattive da più di `days_idle` giorni.
+        
+        Le conversazioni restano nel database (contatori, anteprima, riassunto) e
+        le letture dei messaggi passano all'archivio quando serve. I blocchi sono
+        scritti su disco prima di eliminare i messaggi, dentro la transazione di
+        scrittura: un'interruzione lascia al più byte non referenziati nel segmento.
+        """
+        with self.transaction() as conn:
+            conversation_ids = [row[0] for row in conn.execute('''
+                SELECT id FROM conversations c
+                WHERE updated_at < datetime('now', ?)
+                  AND EXISTS (SELECT 1 FROM messages m WHERE m.conversation_id = c.id)
+                LIMIT ?
+            ''', (f'-{int(days_idle)} days', batch_size))]
+            blocks = [conn.execute('''
+                SELECT id, sender, content, timestamp, token_count
+                FROM messages
+                WHERE conversation_id = ?
+                ORDER BY id ASC
+            ''', (conversation_id,)).fetchall() for conversation_id in conversation_ids]
+            locations = self.archive.append(blocks) if blocks else []
             
-            return len(old_conversations)
+            conn.executemany('''
+                INSERT INTO archive_index
+                    (conversation_id, first_id, last_id, message_count, segment, offset, length, crc32)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (conversation_id, rows[0][0], rows[-1][0], len(rows), *location)
+                for conversation_id, rows, location in zip(conversation_ids, blocks, locations)
+            ])
+            conn.executemany(
+                'DELETE FROM messages WHERE conversation_id = ? AND id <= ?',
+                [(conversation_id, rows[-1][0]) for conversation_id, rows in zip(conversation_ids, blocks)]
+            )
+            return {
+                'batch': len(conversation_ids),
+                'conversations': len(conversation_ids),
+                'messages': sum(len(rows) for rows in blocks),
+                'bytes': sum(location[2] for location in locations),
+            }
+    
+    @timed_db_method
+    def archive_idle_conversations(self, days_idle: int, batch_size: int = ARCHIVE_BATCH_SIZE,
+                                   pause: float = MAINTENANCE_BATCH_PAUSE_MS / 1000) -> Dict:
+        """Archivia a batch i messaggi delle conversazioni inattive; restituisce conversazioni, messaggi e byte scritti"""
+        return self._in_batches(
+            lambda size: self.archive_conversations_batch(days_idle, size), batch_size, pause
+        )
+    
+    @timed_db_method
+    def cleanup_old_conversations(self, days_old: int = 30) -> int:
+        """Pulisce le conversazioni vecchie"""
+        return self.prune_old_conversations(days_old)['conversations']
+    
+    @timed_db_method
+    def incremental_vacuum(self, pages: int) -> int:
+        """Restituisce al filesystem fino a `pages` pagine libere (solo con auto_vacuum=INCREMENTAL).
+        
+        Restituisce le pagine liberate.
+        """
+        with self.connection() as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                return 0
+            before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # executescript esegue il PRAGMA fino in fondo (execute libererebbe una pagina sola)
+            conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+            return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    
+    @timed_db_method
+    def optimize(self):
+        """Aggiorna le statistiche del query planner dove servono (PRAGMA optimize)"""
+        with self.connection() as conn:
+            conn.execute('PRAGMA optimize')
+    
+    def vacuum(self):
+        """VACUUM completo: ricompatta il file e applica l'impostazione auto_vacuum corrente.
+        
+        Blocca il database per tutta la durata: va eseguito a servizio fermo.
+        """
+        with self.connection() as conn:
+            conn.execute(f"PRAGMA auto_vacuum = {self.pool.pragmas['auto_vacuum']}")
+            conn.execute('VACUUM')
 
 # Istanza globale del database
 chat_db = ChatDatabase() 
\ No newline at end of file
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Strumenti di manutenzione del database
+
+Uso:
+    python db_tools.py rebuild-stats
+    python db_tools.py rebuild-rollups
+    python db_tools.py prune-rollups
+    python db_tools.py rebuild-search
+    python db_tools.py maintenance --days 90
+    python db_tools.py archive --days 30
+    python db_tools.py index-memory
+    python db_tools.py vacuum
+"""
+
+import argparse
+import sqlite3
+import sys
+
+from database import ARCHIVE_BATCH_SIZE, MAINTENANCE_BATCH_SIZE, chat_db
+from maintenance import ARCHIVE_AFTER_DAYS, CONVERSATION_RETENTION_DAYS, MAINTENANCE_VACUUM_PAGES, run_maintenance
+from memory import conversation_memory
+
+def rebuild_stats(args) -> int:
+    """Ricalcola le statistiche delle conversazioni dalla tabella conversations"""
+    chat_db.rebuild_stats()
+    stats = chat_db.get_conversation_stats()
+    print(f"✅ Statistiche ricostruite: {stats['total_conversations']} conversazioni, "
+          f"{stats['total_messages']} messaggi")
+    return 0
+
+def rebuild_rollups(args) -> int:
+    """Ricalcola gli aggregati di attività dalla tabella messages"""
+    chat_db.rebuild_activity_rollups()
+    print("✅ Aggregati di attività ricostruiti")
+    return 0
+
+def prune_rollups(args) -> int:
+    """Riporta i contatori al minuto negli aggregati, poi elimina i bucket oltre la conservazione"""
+    chat_db.fold_activity_rollups()
+    deleted = chat_db.prune_activity_rollups()
+    print(f"✅ Eliminati {deleted} bucket di attività scaduti")
+    return 0
+
+def rebuild_search(args) -> int:
+    """Crea e ricostruisce l'indice full-text dei messaggi"""
+    try:
+        chat_db.rebuild_search_index()
+    except sqlite3.OperationalError as e:
+        print(f"❌ Impossibile creare l'indice di ricerca: {e}")
+        return 1
+    print("✅ Indice di ricerca ricostruito")
+    return 0
+
+def maintenance(args) -> int:
+    """Elimina conversazioni inattive e righe orfane a batch, poi vacuum incrementale e optimize"""
+    report = run_maintenance(retention_days=args.days, batch_size=args.batch_size,
+                             vacuum_pages=args.vacuum_pages)
+    old = report.get("old_conversations", {})
+    print(f"✅ Manutenzione completata in {report['duration_seconds']}s")
+    print(f"   🗑️  Conversazioni inattive: {old.get('conversations', 0)} "
+          f"({old.get('messages', 0)} messaggi, {old.get('user_sessions', 0)} sessioni)")
+    archived = report.get("archived", {})
+    print(f"   📦 Conversazioni archiviate: {archived.get('conversations', 0)} ({archived.get('messages', 0)} messaggi)")
+    print(f"   🧩 Righe orfane: {report['orphans']}")
+    print(f"   📈 Contatori di attività riportati: {report['activity_folded']}")
+    print(f"   📉 Bucket di attività scaduti: {report['activity_buckets']}")
+    print(f"   💾 Pagine liberate: {report.get('vacuumed_pages', 0)}")
+    if "memory_conversations" in report:
+        print(f"   🧠 Ricordi di conversazioni eliminate: {report['memory_conversations']}")
+    return 0
+
+def archive(args) -> int:
+    """Sposta nell'archivio i messaggi delle conversazioni inattive"""
+    if args.days <= 0:
+        print("❌ Indica dopo quanti giorni di inattività archiviare (--days o ARCHIVE_AFTER_DAYS)")
+        return 1
+    archived = chat_db.archive_idle_conversations(args.days, args.batch_size)
+    print(f"✅ Archiviate {archived.get('conversations', 0)} conversazioni "
+          f"({archived.get('messages', 0)} messaggi, {archived.get('bytes', 0) / 1024:.1f} KiB) "
+          f"in {chat_db.archive.directory}")
+    return 0
+
+def index_memory(args) -> int:
+    """Calcola gli embedding mancanti di tutte le conversazioni (es. dopo aver attivato MEMORY_ENABLED)"""
+    conversations = messages = 0
+    conversation_id = 0
+    while True:
+        page = chat_db.get_conversation_ids(conversation_id)
+        if not page:
+            break
+        for conversation_id in page:
+            try:
+                while True:
+                    indexed = conversation_memory.index(conversation_id)
+                    messages += indexed
+                    if indexed < conversation_memory.batch_size:
+                        break
+            except Exception as e:
+                print(f"❌ Embedding non disponibili ({conversation_memory.client.embed_url}): {e}")
+                return 1
+            conversations += 1
+    removed = conversation_memory.prune()
+    print(f"✅ Indicizzati {messages} messaggi di {conversations} conversazioni "
+          f"in {conversation_memory.store.directory} ({removed} conversazioni eliminate rimosse)")
+    return 0
+
+def vacuum(args) -> int:
+    """VACUUM completo: abilita il vacuum incrementale anche su database creati prima"""
+    chat_db.vacuum()
+    print("✅ Database ricompattato")
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Strumenti di manutenzione del database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    commands.add_parser("rebuild-stats", help="Ricalcola le statistiche delle conversazioni").set_defaults(func=rebuild_stats)
+    commands.add_parser("rebuild-rollups", help="Ricalcola gli aggregati di attività").set_defaults(func=rebuild_rollups)
+    commands.add_parser("prune-rollups", help="Elimina i bucket di attività scaduti").set_defaults(func=prune_rollups)
+    commands.add_parser("rebuild-search", help="Ricostruisce l'indice di ricerca dei messaggi").set_defaults(func=rebuild_search)
+    
+    maintenance_parser = commands.add_parser("maintenance", help="Pulizia del database a batch")
+    maintenance_parser.add_argument("--days", type=int, default=CONVERSATION_RETENTION_DAYS,
+                                    help="Elimina le conversazioni inattive da più giorni (0 = nessuna)")
+    maintenance_parser.add_argument("--batch-size", type=int, default=MAINTENANCE_BATCH_SIZE, help="Conversazioni per transazione")
+    maintenance_parser.add_argument("--vacuum-pages", type=int, default=MAINTENANCE_VACUUM_PAGES,
+                                    help="Pagine libere da restituire al filesystem (0 = nessuna)")
+    maintenance_parser.set_defaults(func=maintenance)
+    archive_parser = commands.add_parser("archive", help="Archivia i messaggi delle conversazioni inattive")
+    archive_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                                help="Giorni di inattività dopo cui archiviare")
+    archive_parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE, help="Conversazioni per transazione")
+    archive_parser.set_defaults(func=archive)
+    commands.add_parser("index-memory", help="Calcola gli embedding mancanti dei messaggi").set_defaults(func=index_memory)
+    commands.add_parser("vacuum", help="VACUUM completo (a servizio fermo)").set_defaults(func=vacuum)
+    
+    args = parser.parse_args()
+    try:
+        return args.func(args)
+    finally:
+        chat_db.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
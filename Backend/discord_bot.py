@@ -1,9 +1,22 @@
+import asyncio
 import discord
 import os
-from Backend.shared import query_ollama
+import re
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+from scheduler import SchedulerQueueFull
+from shared import aquery_ollama, npc_manager
 
 # Usa variabile d'ambiente per il token
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "")
+# Risposte generate contemporaneamente su tutti i server e canali
+DISCORD_MAX_CONCURRENCY = int(os.getenv("DISCORD_MAX_CONCURRENCY", "4"))
+# Lunghezza massima di un messaggio Discord
+DISCORD_MESSAGE_LIMIT = 2000
+# Associazioni esplicite canale -> NPC, es. "taverna:elenya,trono:aedryan".
+# I canali non elencati rispondono se il loro nome è l'ID dell'NPC o il suo nome
+# in minuscolo con i trattini (es. "re-aedryan" per "Re Aedryan").
+DISCORD_CHANNEL_MAP = os.getenv("DISCORD_CHANNEL_MAP", "")
 
 if not DISCORD_TOKEN:
     print("⚠️  DISCORD_TOKEN non configurato. Il bot Discord non verrà avviato.")
@@ -14,21 +27,111 @@ intents = discord.Intents.default()
 intents.message_content = True
 client = discord.Client(intents=intents)
 
+# Limita le generazioni in corso; i canali restano indipendenti tra loro.
+# Creato al primo uso: su Python 3.8/3.9 va creato dentro l'event loop di client.run
+generation_slots: Optional[asyncio.Semaphore] = None
+
+def get_generation_slots() -> asyncio.Semaphore:
+    """Semaforo delle generazioni, creato nell'event loop in esecuzione"""
+    global generation_slots
+    if generation_slots is None:
+        generation_slots = asyncio.Semaphore(DISCORD_MAX_CONCURRENCY)
+    return generation_slots
+
+class ConversationLocks:
+    """Un lock per utente e canale, così le risposte di una conversazione arrivano in ordine.
+    
+    Il lock viene eliminato quando nessuno lo tiene né lo attende, quindi i lock
+    non crescono con il numero di utenti e canali visti.
+    """
+    
+    def __init__(self):
+        # chiave -> (lock, richieste che lo tengono o lo attendono)
+        self._locks: Dict[Tuple[int, int], Tuple[asyncio.Lock, int]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._locks)
+    
+    @asynccontextmanager
+    async def hold(self, key: Tuple[int, int]):
+        lock, users = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+conversation_locks = ConversationLocks()
+
+def parse_channel_map(value: str) -> Dict[str, str]:
+    """Legge DISCORD_CHANNEL_MAP nel formato canale:npc_id,canale:npc_id"""
+    mapping = {}
+    for entry in value.split(","):
+        if ":" in entry:
+            channel, npc_id = entry.split(":", 1)
+            mapping[channel.strip().lower()] = npc_id.strip()
+    return mapping
+
+channel_map = parse_channel_map(DISCORD_CHANNEL_MAP)
+
+def slugify(name: str) -> str:
+    """Nome in formato canale Discord: minuscolo, parole separate da trattini"""
+    return re.sub(r"[^\w]+", "-", name.lower()).strip("-")
+
+def resolve_npc(channel_name: str) -> Optional[str]:
+    """ID dell'NPC che risponde in un canale, o None se il canale non ha un NPC"""
+    channel_name = channel_name.lower()
+    if channel_name in channel_map:
+        return channel_map[channel_name]
+    
+    # Solo id e nomi: a differenza della lista completa, la loro cache non si svuota a ogni messaggio
+    for npc_id, name in npc_manager.get_npc_names():
+        if channel_name in (npc_id.lower(), slugify(name)):
+            return npc_id
+    return None
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT):
+    """Divide una risposta lunga in parti che rispettano il limite di Discord"""
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or [""]
+
 @client.event
 async def on_ready():
+    get_generation_slots()
     print(f"Bot connesso come {client.user}")
 
 @client.event
 async def on_message(message):
-    if message.author == client.user or message.channel.name != "re-aedryan":
+    channel_name = getattr(message.channel, "name", None)
+    if message.author == client.user or message.author.bot or not channel_name:
         return
 
     user_input = message.content.strip()
     if not user_input:
         return
 
-    await message.channel.typing()
-    reply = query_ollama(user_input)
-    await message.channel.send(reply)
+    # I nomi degli NPC sono in cache; la lettura dal database avviene fuori dall'event loop
+    npc_id = await asyncio.get_running_loop().run_in_executor(None, resolve_npc, channel_name)
+    if npc_id is None:
+        return
+
+    # Ogni utente Discord ha la propria conversazione con ciascun NPC
+    user_id = f"discord:{message.author.id}"
+
+    async with conversation_locks.hold((message.channel.id, message.author.id)):
+        # L'indicatore "sta scrivendo" resta attivo per tutta la generazione
+        async with message.channel.typing():
+            async with get_generation_slots():
+                try:
+                    reply = await aquery_ollama(user_input, npc_id, user_id)
+                except SchedulerQueueFull as e:
+                    reply = f"Sono in troppi a parlarmi in questo momento, riprova tra {e.retry_after} secondi."
+
+        for part in split_message(reply):
+            await message.channel.send(part)
 
 client.run(DISCORD_TOKEN)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Sostituto locale di Ollama per test e benchmark.
+
+Risponde su /api/generate come Ollama (anche in streaming) con una latenza
+iniziale, una velocità di generazione e una percentuale di errori configurabili.
+Su /api/embed restituisce embedding deterministici: testi con parole in comune
+hanno vettori simili.
+
+Uso:
+    python fake_ollama.py --port 11435 --latency 0.2 --tokens-per-second 50
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+WORDS = ("il", "regno", "di", "Aedryan", "ti", "saluta", "viandante", "la", "strada",
+         "verso", "nord", "è", "lunga", "e", "piena", "di", "pericoli")
+# Dimensione degli embedding simulati
+EMBED_DIM = 64
+
+
+def fake_embedding(text: str, dim: int = EMBED_DIM) -> List[float]:
+    """Embedding "bag of words": ogni parola somma ±1 su una coordinata scelta dal suo hash"""
+    vector = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        vector[digest[0] % dim] += 1.0 if digest[1] % 2 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOllama:
+    """Server HTTP che imita l'API di Ollama (generazione ed embedding)"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 tokens_per_second: float = 0.0, reply_tokens: int = 20,
+                 error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.requests = 0
+        self.embed_requests = 0
+        self.last_request: Optional[Dict] = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/generate"
+
+    def start(self) -> "FakeOllama":
+        """Avvia il server in un thread in background"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Ferma il server"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_request(self, body: Dict) -> bool:
+        """Registra la richiesta; restituisce True se deve fallire"""
+        with self._lock:
+            self.requests += 1
+            self.last_request = body
+            return self._random.random() < self.error_rate
+
+    def _reply_tokens(self):
+        return [WORDS[i % len(WORDS)] + " " for i in range(self.reply_tokens)]
+
+    def _final_chunk(self, body: Dict, response: str) -> Dict:
+        prompt_eval_count = max(1, len(body.get("prompt", "")) // 4)
+        eval_duration = int(self.reply_tokens / self.tokens_per_second * 1e9) if self.tokens_per_second else 0
+        return {
+            "model": body.get("model", ""),
+            "response": response,
+            "done": True,
+            "context": list(range(len(body.get("context") or []) + prompt_eval_count + self.reply_tokens)),
+            "prompt_eval_count": prompt_eval_count,
+            "eval_count": self.reply_tokens,
+            "eval_duration": eval_duration,
+        }
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/api/embed":
+                    return self._embed(body)
+                if self.path != "/api/generate":
+                    return self._send_json(404, {"error": "not found"})
+
+                fail = fake._next_request(body)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fail:
+                    return self._send_json(500, {"error": "errore simulato"})
+
+                tokens = fake._reply_tokens()
+                delay = 1 / fake.tokens_per_second if fake.tokens_per_second else 0
+                if not body.get("stream", True):
+                    time.sleep(delay * len(tokens))
+                    return self._send_json(200, fake._final_chunk(body, "".join(tokens).strip()))
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for token in tokens:
+                        if delay:
+                            time.sleep(delay)
+                        self._write_chunk({"model": body.get("model", ""), "response": token, "done": False})
+                    self._write_chunk(fake._final_chunk(body, ""))
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # Il client ha chiuso lo stream (es. utente disconnesso)
+                    self.close_connection = True
+
+            def _embed(self, body: Dict):
+                with fake._lock:
+                    fake.embed_requests += 1
+                texts = body.get("input", [])
+                if isinstance(texts, str):
+                    texts = [texts]
+                self._send_json(200, {
+                    "model": body.get("model", ""),
+                    "embeddings": [fake_embedding(text) for text in texts],
+                })
+
+            def _write_chunk(self, data: Dict):
+                line = json.dumps(data).encode() + b"\n"
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, status: int, data: Dict):
+                out = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sostituto locale di Ollama")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.2, help="Secondi prima del primo token")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="0 = istantaneo")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="Token per risposta")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Frazione di richieste che falliscono")
+    args = parser.parse_args()
+
+    fake = FakeOllama(args.host, args.port, args.latency, args.tokens_per_second,
+                      args.reply_tokens, args.error_rate)
+    print(f"🦙 Ollama simulato in ascolto su {fake.url}")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import os
+import time
+from typing import Dict, Optional
+
+from database import (
+    ARCHIVE_BATCH_SIZE, MAINTENANCE_BATCH_PAUSE_MS, MAINTENANCE_BATCH_SIZE, ChatDatabase, chat_db
+)
+from memory import MEMORY_ENABLED, ConversationMemory, conversation_memory
+
+# Giorni di inattività dopo cui una conversazione viene eliminata (0 = mai)
+CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", "0"))
+# Giorni di inattività dopo cui i messaggi di una conversazione passano all'archivio (0 = mai)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+# Ogni quanti secondi l'API esegue la manutenzione (0 = mai, es. se la si lancia da cron)
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+# Pagine libere restituite al filesystem a ogni esecuzione (0 = nessun vacuum incrementale)
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "1000"))
+# Esegue PRAGMA optimize a fine manutenzione
+MAINTENANCE_OPTIMIZE = os.getenv("MAINTENANCE_OPTIMIZE", "true").lower() in ("1", "true", "yes")
+
+
+def run_maintenance(db: ChatDatabase = chat_db, retention_days: int = CONVERSATION_RETENTION_DAYS,
+                    archive_days: int = ARCHIVE_AFTER_DAYS,
+                    batch_size: int = MAINTENANCE_BATCH_SIZE,
+                    pause: float = MAINTENANCE_BATCH_PAUSE_MS / 1000,
+                    vacuum_pages: int = MAINTENANCE_VACUUM_PAGES,
+                    optimize: bool = MAINTENANCE_OPTIMIZE,
+                    memory: Optional[ConversationMemory] = conversation_memory if MEMORY_ENABLED else None) -> Dict:
+    """Pulizia periodica del database.
+
+    Elimina le conversazioni inattive, archivia i messaggi di quelle ferme da
+    `archive_days` giorni ed elimina le righe orfane, a batch (una transazione
+    breve per batch); elimina i vettori della `memory` delle conversazioni che
+    non esistono più, riporta i contatori al minuto negli aggregati di attività
+    e ne applica la conservazione e, se abilitati, il vacuum incrementale e
+    PRAGMA optimize. Bloccante: dall'API
+    va eseguita in un thread. Restituisce il resoconto di ciò che è stato fatto.
+    """
+    started = time.perf_counter()
+    report = {}
+    if retention_days > 0:
+        report["old_conversations"] = db.prune_old_conversations(retention_days, batch_size, pause)
+    if archive_days > 0:
+        report["archived"] = db.archive_idle_conversations(archive_days, ARCHIVE_BATCH_SIZE, pause)
+    report["orphans"] = db.prune_orphans(batch_size, pause)
+    report["activity_folded"] = db.fold_activity_rollups()
+    report["activity_buckets"] = db.prune_activity_rollups()
+    if memory is not None:
+        report["memory_conversations"] = memory.prune()
+    if vacuum_pages > 0:
+        report["vacuumed_pages"] = db.incremental_vacuum(vacuum_pages)
+    if optimize:
+        db.optimize()
+    report["duration_seconds"] = round(time.perf_counter() - started, 3)
+    return report
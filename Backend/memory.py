@@ -0,0 +1,302 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from database import ChatDatabase, chat_db
+from metrics import MEMORY_RECALL
+from ollama_client import OllamaClient, ollama
+from scheduler import BACKGROUND_QUEUE, PRIORITY_BACKGROUND, LLMScheduler, llm_scheduler
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "false").lower() in ("1", "true", "yes")
+# Cartella dei vettori (vuoto = "<nome database>_memory" accanto al database)
+MEMORY_DIR = os.getenv("MEMORY_DIR", "")
+# Messaggi rilevanti aggiunti al prompt
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))
+# Similarità del coseno minima perché un messaggio venga ricordato
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.5"))
+# Messaggi per richiesta di embedding nel worker in background
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "64"))
+# Attesa massima (secondi) per l'embedding del messaggio dell'utente durante il turno
+MEMORY_QUERY_TIMEOUT = float(os.getenv("MEMORY_QUERY_TIMEOUT", "0.5"))
+# Se l'embedding non arriva in tempo: ultimi messaggi indicizzati la cui media fa da domanda
+MEMORY_QUERY_MESSAGES = int(os.getenv("MEMORY_QUERY_MESSAGES", "2"))
+
+
+class VectorStore:
+    """Vettori dei messaggi, un paio di file per conversazione.
+
+    `<id>.f32` contiene gli embedding normalizzati come matrice float32 contigua
+    (una riga per messaggio) e `<id>.ids` gli id dei messaggi corrispondenti
+    (int64, crescenti). I file sono scritti solo in coda e letti con np.memmap,
+    quindi la ricerca non carica in memoria più di quanto il sistema operativo
+    tenga in cache. `meta.json` ricorda modello e dimensione: se cambiano, i
+    vettori vengono scartati e ricalcolati. I vettori si possono sempre
+    ricalcolare dai messaggi, quindi non si fa fsync.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._meta: Optional[Dict] = None
+
+    def _path(self, conversation_id: int, ext: str) -> str:
+        return os.path.join(self.directory, f"{conversation_id}.{ext}")
+
+    def _read_meta(self) -> Optional[Dict]:
+        if self._meta is None:
+            try:
+                with open(os.path.join(self.directory, "meta.json")) as f:
+                    self._meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+        return self._meta
+
+    def _ensure_meta(self, model: str, dim: int):
+        """Prepara la cartella per vettori di `model`, scartando quelli di un altro modello"""
+        meta = self._read_meta()
+        if meta == {"model": model, "dim": dim}:
+            return
+        if meta is not None:
+            print(f"🧠 Modello degli embedding cambiato ({meta['model']} -> {model}): ricalcolo dei ricordi")
+            shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump({"model": model, "dim": dim}, f)
+        self._meta = {"model": model, "dim": dim}
+
+    def count(self, conversation_id: int) -> int:
+        """Messaggi indicizzati di una conversazione"""
+        try:
+            return os.path.getsize(self._path(conversation_id, "ids")) // 8
+        except OSError:
+            return 0
+
+    def last_id(self, conversation_id: int, model: str) -> int:
+        """Ultimo messaggio indicizzato con `model` (0 se nessuno)"""
+        meta = self._read_meta()
+        if meta is None or meta["model"] != model or not self.count(conversation_id):
+            return 0
+        with open(self._path(conversation_id, "ids"), "rb") as f:
+            f.seek(-8, os.SEEK_END)
+            return int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+
+    def recent(self, conversation_id: int, model: str, n: int) -> Tuple[List[int], Optional[np.ndarray]]:
+        """Id e vettori degli ultimi `n` messaggi indicizzati con `model`"""
+        meta = self._read_meta()
+        count = self.count(conversation_id)
+        if meta is None or meta["model"] != model or not count or n <= 0:
+            return [], None
+        first = max(0, count - n)
+        ids = np.memmap(self._path(conversation_id, "ids"), dtype=np.int64, mode="r", shape=(count,))
+        vectors = np.memmap(self._path(conversation_id, "f32"), dtype=np.float32, mode="r",
+                            shape=(count, meta["dim"]))
+        return [int(i) for i in ids[first:]], np.array(vectors[first:])
+
+    def append(self, conversation_id: int, model: str, message_ids: List[int], vectors: np.ndarray):
+        """Accoda i vettori (già normalizzati) dei messaggi indicati.
+
+        Prima i vettori, poi gli id: il numero di id decide quante righe sono
+        valide, e una riga di troppo lasciata da un'interruzione viene tagliata
+        alla scrittura successiva.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            self._ensure_meta(model, vectors.shape[1])
+            valid_bytes = self.count(conversation_id) * vectors.shape[1] * 4
+            with open(self._path(conversation_id, "f32"), "ab") as f:
+                f.truncate(valid_bytes)
+                f.write(vectors.tobytes())
+            with open(self._path(conversation_id, "ids"), "ab") as f:
+                f.write(np.asarray(message_ids, dtype=np.int64).tobytes())
+
+    def search(self, conversation_id: int, model: str, query: np.ndarray, k: int,
+               before_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        """I `k` messaggi più simili a `query` (normalizzata), come (id, similarità) decrescenti.
+
+        Con `before_id` si considerano solo i messaggi precedenti, tagliando il
+        prefisso della matrice invece di filtrarla.
+        """
+        meta = self._read_meta()
+        count = self.count(conversation_id)
+        if meta is None or meta["model"] != model or meta["dim"] != len(query) or not count or k <= 0:
+            return []
+        ids = np.memmap(self._path(conversation_id, "ids"), dtype=np.int64, mode="r", shape=(count,))
+        if before_id is not None:
+            count = int(np.searchsorted(ids, before_id))
+            if not count:
+                return []
+        vectors = np.memmap(self._path(conversation_id, "f32"), dtype=np.float32, mode="r",
+                            shape=(count, meta["dim"]))
+
+        scores = vectors @ query
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def conversation_ids(self) -> List[int]:
+        """Conversazioni che hanno vettori salvati"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [int(name[:-4]) for name in names if name.endswith(".ids") and name[:-4].isdigit()]
+
+    def remove(self, conversation_id: int):
+        """Elimina i vettori di una conversazione"""
+        with self._lock:
+            for ext in ("f32", "ids"):
+                try:
+                    os.remove(self._path(conversation_id, ext))
+                except FileNotFoundError:
+                    pass
+
+
+def normalize(vectors) -> np.ndarray:
+    """Normalizza le righe, così la similarità del coseno è un prodotto scalare"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class ConversationMemory:
+    """Memoria a lungo termine degli NPC: ritrova i messaggi passati più pertinenti.
+
+    Un worker in background calcola gli embedding dei nuovi messaggi a batch
+    (una richiesta a Ollama per batch, con priorità bassa nello scheduler) e li
+    accoda al VectorStore. Durante il turno si calcola solo l'embedding del
+    messaggio appena scritto, con un timeout breve e senza passare dallo
+    scheduler (altrimenti aspetterebbe le generazioni in corso); se non arriva
+    in tempo la domanda è la media dei vettori degli ultimi messaggi già
+    indicizzati. La ricerca per similarità avviene in locale con NumPy.
+    """
+
+    def __init__(self, db: ChatDatabase = chat_db, client: OllamaClient = ollama,
+                 directory: str = MEMORY_DIR, top_k: int = MEMORY_TOP_K,
+                 min_score: float = MEMORY_MIN_SCORE, batch_size: int = MEMORY_BATCH_SIZE,
+                 query_messages: int = MEMORY_QUERY_MESSAGES, query_timeout: float = MEMORY_QUERY_TIMEOUT,
+                 scheduler: LLMScheduler = llm_scheduler):
+        self.db = db
+        self.client = client
+        self.store = VectorStore(directory or os.path.splitext(db.db_path)[0] + "_memory")
+        self.top_k = top_k
+        self.min_score = min_score
+        self.batch_size = batch_size
+        self.query_messages = query_messages
+        self.query_timeout = query_timeout
+        self.scheduler = scheduler
+        self._queue = queue.Queue()
+        self._scheduled = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, conversation_id: int):
+        """Segnala che una conversazione ha nuovi messaggi da indicizzare (non blocca il turno)"""
+        with self._lock:
+            if conversation_id in self._scheduled:
+                return
+            self._scheduled.add(conversation_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="memory", daemon=True)
+                self._thread.start()
+        self._queue.put(conversation_id)
+
+    def _run(self):
+        while True:
+            conversation_id = self._queue.get()
+            with self._lock:
+                self._scheduled.discard(conversation_id)
+            try:
+                while self.index(conversation_id) == self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"⚠️  Indicizzazione dei ricordi della conversazione {conversation_id} fallita: {e}")
+
+    def index(self, conversation_id: int) -> int:
+        """Indicizza il prossimo batch di messaggi; restituisce quanti ne ha indicizzati"""
+        model = self.client.embed_model
+        messages = self.db.get_messages_after(
+            conversation_id, self.store.last_id(conversation_id, model), self.batch_size
+        )
+        if not messages:
+            return 0
+
+        with self.scheduler.slot_sync(BACKGROUND_QUEUE, "memory", PRIORITY_BACKGROUND):
+            vectors = normalize(self.client.embed([msg['content'] for msg in messages]))
+        self.store.append(conversation_id, model, [msg['id'] for msg in messages], vectors)
+        return len(messages)
+
+    def _query(self, conversation_id: int, model: str, text: str,
+               history_ids: List[int]) -> Tuple[Optional[np.ndarray], Optional[int], str]:
+        """Vettore della domanda, primo id escluso dalla ricerca ed esito ("ok" o "fallback").
+
+        La domanda è l'embedding di `text`; se fallisce o scade il timeout si usa la
+        media degli ultimi messaggi indicizzati, che vengono a loro volta esclusi.
+        """
+        if text:
+            try:
+                vector = self.client.embed([text], timeout=self.query_timeout)[0]
+                return normalize(vector), (history_ids[0] if history_ids else None), "ok"
+            except Exception as e:
+                print(f"⚠️  Embedding della domanda non disponibile ({e}): uso gli ultimi messaggi")
+
+        query_ids, query_vectors = self.store.recent(conversation_id, model, self.query_messages)
+        if not query_ids:
+            return None, None, "fallback"
+        return normalize(query_vectors.mean(axis=0)), min(history_ids[:1] + query_ids[:1]), "fallback"
+
+    def recall(self, conversation_id: int, history: Optional[List[Dict]] = None,
+               text: str = "") -> List[Dict]:
+        """Messaggi passati più pertinenti a `text` (il messaggio dell'utente), in ordine cronologico.
+
+        Si escludono i messaggi di `history` (già nel prompt) e i successivi; i
+        messaggi ancora in coda di scrittura non hanno id e non contano. Ogni
+        messaggio ha anche la sua similarità ('score'). In caso di errore
+        restituisce una lista vuota: il turno prosegue senza ricordi.
+        """
+        started = time.perf_counter()
+        model = self.client.embed_model
+        try:
+            if self.store.last_id(conversation_id, model) == 0:
+                return []
+            history_ids = [msg['id'] for msg in history or [] if msg.get('id') is not None]
+            query, before_id, outcome = self._query(conversation_id, model, text, history_ids)
+            if query is None:
+                return []
+
+            scores = {
+                message_id: score for message_id, score in self.store.search(
+                    conversation_id, model, query, self.top_k, before_id
+                )
+                if score >= self.min_score
+            }
+            memories = self.db.get_messages_by_ids(conversation_id, list(scores))
+            for message in memories:
+                message['score'] = round(scores[message['id']], 4)
+        except Exception as e:
+            MEMORY_RECALL.labels("error").observe(time.perf_counter() - started)
+            print(f"⚠️  Ricerca dei ricordi della conversazione {conversation_id} fallita: {e}")
+            return []
+        MEMORY_RECALL.labels(outcome).observe(time.perf_counter() - started)
+        return memories
+
+    def prune(self) -> int:
+        """Elimina i vettori delle conversazioni non più presenti nel database"""
+        stored = self.store.conversation_ids()
+        existing = self.db.get_existing_conversation_ids(stored) if stored else set()
+        removed = 0
+        for conversation_id in stored:
+            if conversation_id not in existing:
+                self.store.remove(conversation_id)
+                removed += 1
+        return removed
+
+
+# Istanza globale della memoria delle conversazioni
+conversation_memory = ConversationMemory()
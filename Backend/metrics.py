@@ -0,0 +1,92 @@
+import functools
+import time
+from typing import Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Bucket (secondi) per operazioni brevi, come query e costruzione del prompt
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Bucket (secondi) per le generazioni del modello e le attese in coda
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+# Bucket per i conteggi di token
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+REQUEST_LATENCY = Histogram(
+    "npc_http_request_duration_seconds", "Durata delle richieste HTTP per route",
+    ["method", "route", "status"], buckets=FAST_BUCKETS + SLOW_BUCKETS[5:],
+)
+DB_OPERATION = Histogram(
+    "npc_db_operation_duration_seconds", "Durata dei metodi di ChatDatabase",
+    ["method"], buckets=FAST_BUCKETS,
+)
+DB_LOCK_WAIT = Histogram(
+    "npc_db_lock_wait_seconds", "Attesa del lock di scrittura di SQLite (BEGIN IMMEDIATE)",
+    buckets=FAST_BUCKETS,
+)
+PROMPT_BUILD = Histogram(
+    "npc_prompt_build_duration_seconds", "Preparazione del turno: letture dal database e costruzione del prompt",
+    ["mode"], buckets=FAST_BUCKETS,
+)
+MEMORY_RECALL = Histogram(
+    "npc_memory_recall_duration_seconds", "Ricerca dei ricordi: embedding del messaggio (o media degli ultimi, se fallisce) e similarità",
+    ["outcome"], buckets=FAST_BUCKETS,
+)
+QUEUE_WAIT = Histogram(
+    "npc_llm_queue_wait_seconds", "Attesa nella coda dello scheduler prima della generazione",
+    ["npc"], buckets=(0.0,) + SLOW_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "npc_llm_time_to_first_token_seconds", "Tempo dal via della generazione al primo token (streaming)",
+    ["npc", "model"], buckets=SLOW_BUCKETS,
+)
+GENERATION = Histogram(
+    "npc_llm_generation_duration_seconds", "Durata totale delle generazioni di Ollama",
+    ["npc", "model", "outcome"], buckets=SLOW_BUCKETS,
+)
+PROMPT_EVAL_COUNT = Histogram(
+    "npc_llm_prompt_eval_count", "Token del prompt valutati da Ollama (prompt_eval_count)",
+    ["npc", "model"], buckets=TOKEN_BUCKETS,
+)
+EVAL_COUNT = Histogram(
+    "npc_llm_eval_count", "Token generati da Ollama (eval_count)",
+    ["npc", "model"], buckets=TOKEN_BUCKETS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "npc_llm_tokens_per_second", "Velocità di generazione riportata da Ollama",
+    ["npc", "model"], buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500),
+)
+GENERATED_TOKENS = Counter(
+    "npc_llm_generated_tokens", "Token generati in totale", ["npc", "model"],
+)
+
+
+def timed_db_method(func):
+    """Decoratore: misura la durata di un metodo del database"""
+    histogram = DB_OPERATION.labels(method=func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+def observe_ollama_stats(npc_id: str, model: str, data: Dict):
+    """Registra le statistiche restituite da Ollama a fine generazione"""
+    if data.get("prompt_eval_count") is not None:
+        PROMPT_EVAL_COUNT.labels(npc_id, model).observe(data["prompt_eval_count"])
+    eval_count = data.get("eval_count")
+    if eval_count is not None:
+        EVAL_COUNT.labels(npc_id, model).observe(eval_count)
+        GENERATED_TOKENS.labels(npc_id, model).inc(eval_count)
+        # eval_duration è in nanosecondi
+        if data.get("eval_duration"):
+            TOKENS_PER_SECOND.labels(npc_id, model).observe(eval_count / data["eval_duration"] * 1e9)
+
+
+def render_metrics():
+    """Restituisce (corpo, content type) nel formato di esposizione di Prometheus"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,464 @@
+import sqlite3
+from typing import Callable, List, Tuple
+
+# Caratteri dell'ultimo messaggio salvati nella conversazione per le anteprime
+LAST_MESSAGE_PREVIEW_CHARS = 200
+
+# Aggregati dei messaggi per intervallo di tempo: formato (strftime) dell'inizio del bucket
+ACTIVITY_BUCKETS = {
+    "minute": "%Y-%m-%d %H:%M:00",
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d 00:00:00",
+}
+
+
+def ensure_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> bool:
+    """Aggiunge una colonna a una tabella esistente se manca; restituisce True se è stata aggiunta"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
+    return False
+
+
+def activity_keys_sql() -> str:
+    """SELECT delle chiavi di activity_rollups toccate dal nuovo messaggio (NEW)"""
+    buckets = " UNION ALL ".join(
+        f"SELECT '{size}' AS bucket_size, '{fmt}' AS format" for size, fmt in ACTIVITY_BUCKETS.items()
+    )
+    return f'''
+        SELECT b.bucket_size, s.npc_id, s.user_id, strftime(b.format, NEW.timestamp),
+               1, NEW.sender = 'user'
+        FROM ({buckets}) b, (
+            SELECT npc_id, '*' AS user_id FROM conversations WHERE id = NEW.conversation_id
+            UNION ALL
+            SELECT '*', user_id FROM conversations WHERE id = NEW.conversation_id
+            UNION ALL
+            SELECT '*', '*'
+        ) s
+    '''
+
+
+# Ogni migrazione è idempotente: i database creati prima del sistema di versioni
+# (user_version = 0) hanno già parte dello schema e le ripercorrono tutte.
+
+def create_base_schema(cursor: sqlite3.Cursor, db):
+    """Tabelle e indici originali"""
+    # Tabella per gli NPC
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS npcs (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            avatar TEXT NOT NULL,
+            description TEXT NOT NULL,
+            status TEXT DEFAULT 'online',
+            prompt TEXT NOT NULL,
+            last_message TEXT DEFAULT '',
+            last_message_time TEXT DEFAULT '',
+            unread_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Tabella per le conversazioni
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            npc_id TEXT NOT NULL,
+            user_id TEXT DEFAULT 'default_user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            title TEXT DEFAULT '',
+            message_count INTEGER DEFAULT 0,
+            FOREIGN KEY (npc_id) REFERENCES npcs (id)
+        )
+    ''')
+
+    # Tabella per i messaggi
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            sender TEXT NOT NULL, -- 'user' o 'npc'
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )
+    ''')
+
+    # Tabella per le sessioni utente
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            npc_id TEXT NOT NULL,
+            conversation_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            FOREIGN KEY (npc_id) REFERENCES npcs (id)
+        )
+    ''')
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_npc ON conversations(npc_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_npc ON user_sessions(user_id, npc_id)')
+
+
+def add_llm_columns(cursor: sqlite3.Cursor, db):
+    """Token dei messaggi, contesto di Ollama e riassunto delle conversazioni"""
+    ensure_column(cursor, 'messages', 'token_count', 'INTEGER')  # token del messaggio (da Ollama o stimati)
+    ensure_column(cursor, 'conversations', 'llm_context', 'BLOB')  # contesto di Ollama (int32 impacchettati)
+    ensure_column(cursor, 'conversations', 'llm_context_model', 'TEXT')
+    ensure_column(cursor, 'conversations', 'llm_context_prompt_hash', 'TEXT')
+    ensure_column(cursor, 'conversations', 'summary', "TEXT DEFAULT ''")  # riassunto dei messaggi più vecchi
+    ensure_column(cursor, 'conversations', 'summary_upto_id', 'INTEGER DEFAULT 0')  # ultimo messaggio riassunto
+
+
+def add_messages_tail_index(cursor: sqlite3.Cursor, db):
+    """(conversation_id, id) copre sia i filtri per conversazione sia la coda "ultimi N\""""
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_conversation')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id, id)')
+
+
+def add_npc_versions(cursor: sqlite3.Cursor, db):
+    """Contatori di versione per invalidare le cache degli NPC"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS db_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('npc_version', 0)")
+    cursor.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('npc_activity_version', 0)")
+
+    # Ogni modifica alla definizione di un NPC incrementa npc_version,
+    # ogni nuovo ultimo messaggio incrementa npc_activity_version
+    version_triggers = {
+        'trg_npcs_insert_version': ('AFTER INSERT ON npcs', 'npc_version'),
+        'trg_npcs_delete_version': ('AFTER DELETE ON npcs', 'npc_version'),
+        'trg_npcs_update_version': (
+            'AFTER UPDATE OF id, name, avatar, description, status, prompt ON npcs', 'npc_version'
+        ),
+        'trg_npcs_activity_version': (
+            'AFTER UPDATE OF last_message, last_message_time, unread_count ON npcs', 'npc_activity_version'
+        ),
+    }
+    for trigger, (event, key) in version_triggers.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {trigger} {event}
+            BEGIN
+                UPDATE db_meta SET value = value + 1 WHERE key = '{key}';
+            END
+        ''')
+
+
+def add_conversation_stats(cursor: sqlite3.Cursor, db):
+    """Statistiche delle conversazioni per NPC e globali (npc_id = '*'), mantenute dai trigger"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_stats (
+            npc_id TEXT PRIMARY KEY,
+            total_conversations INTEGER NOT NULL DEFAULT 0,
+            total_messages INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    stats_triggers = {
+        'trg_conversations_stats_insert': ('AFTER INSERT ON conversations', 'NEW.npc_id', '1', 'COALESCE(NEW.message_count, 0)'),
+        'trg_conversations_stats_delete': ('AFTER DELETE ON conversations', 'OLD.npc_id', '-1', '-COALESCE(OLD.message_count, 0)'),
+        'trg_conversations_stats_update': (
+            'AFTER UPDATE OF message_count ON conversations', 'NEW.npc_id',
+            '0', 'COALESCE(NEW.message_count, 0) - COALESCE(OLD.message_count, 0)'
+        ),
+    }
+    for trigger, (event, npc_id, conversations, messages) in stats_triggers.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {trigger} {event}
+            BEGIN
+                INSERT OR IGNORE INTO conversation_stats (npc_id) VALUES ({npc_id});
+                INSERT OR IGNORE INTO conversation_stats (npc_id) VALUES ('*');
+                UPDATE conversation_stats
+                SET total_conversations = total_conversations + {conversations},
+                    total_messages = total_messages + {messages}
+                WHERE npc_id IN ({npc_id}, '*');
+            END
+        ''')
+    # Database esistente senza statistiche: si calcolano una volta
+    if cursor.execute('SELECT 1 FROM conversation_stats LIMIT 1').fetchone() is None:
+        db.rebuild_stats()
+
+
+def add_activity_rollups(cursor: sqlite3.Cursor, db):
+    """Messaggi per bucket di tempo, per NPC (user_id = '*'), per utente (npc_id = '*') e in totale.
+
+    Il trigger creato qui viene sostituito da add_activity_minutes.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_rollups (
+            bucket_size TEXT NOT NULL,
+            npc_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            user_messages INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket_size, npc_id, user_id, bucket_start)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_activity AFTER INSERT ON messages
+        BEGIN
+            -- Upsert: una ricerca per chiave primaria per ogni bucket toccato
+            INSERT INTO activity_rollups
+                (bucket_size, npc_id, user_id, bucket_start, messages, user_messages)
+            {activity_keys_sql()}
+            WHERE true
+            ON CONFLICT (bucket_size, npc_id, user_id, bucket_start) DO UPDATE
+            SET messages = messages + 1,
+                user_messages = user_messages + excluded.user_messages;
+        END
+    ''')
+    if cursor.execute('SELECT 1 FROM activity_rollups LIMIT 1').fetchone() is None:
+        db.rebuild_activity_rollups()
+
+
+def add_database_id(cursor: sqlite3.Cursor, db):
+    """Identificativo casuale del database: distingue i contatori di un database ricreato"""
+    cursor.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('database_id', abs(random() % 1000000000))")
+
+
+def add_last_message_pointer(cursor: sqlite3.Cursor, db):
+    """Ultimo messaggio di ogni conversazione e indice per l'elenco delle conversazioni di un utente"""
+    ensure_column(cursor, 'conversations', 'last_message_id', 'INTEGER')
+    ensure_column(cursor, 'conversations', 'last_message_preview', "TEXT DEFAULT ''")
+    cursor.execute('''
+        UPDATE conversations
+        SET last_message_id = (
+            SELECT MAX(id) FROM messages WHERE conversation_id = conversations.id
+        )
+        WHERE last_message_id IS NULL
+    ''')
+    cursor.execute('''
+        UPDATE conversations
+        SET last_message_preview = COALESCE((
+            SELECT substr(content, 1, ?) FROM messages WHERE id = conversations.last_message_id
+        ), '')
+        WHERE last_message_preview IS NULL OR last_message_preview = ''
+    ''', (LAST_MESSAGE_PREVIEW_CHARS,))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations(user_id, updated_at DESC)')
+
+
+def unique_conversations(cursor: sqlite3.Cursor, db):
+    """Una sola conversazione per (npc_id, user_id) e rimozione degli indici ridondanti.
+
+    Le conversazioni duplicate (create da primi messaggi concorrenti) vengono fuse
+    nella più vecchia: i messaggi vengono spostati e il contesto di Ollama e il
+    riassunto azzerati, perché lo storico è cambiato.
+    """
+    cursor.execute('''
+        CREATE TEMP TABLE conversation_merge AS
+        SELECT c.id AS old_id, k.keep_id
+        FROM conversations c
+        JOIN (
+            SELECT npc_id, user_id, MIN(id) AS keep_id
+            FROM conversations
+            GROUP BY npc_id, user_id
+            HAVING COUNT(*) > 1
+        ) k ON c.npc_id = k.npc_id AND c.user_id IS k.user_id
+        WHERE c.id <> k.keep_id
+    ''')
+    if cursor.execute('SELECT 1 FROM conversation_merge LIMIT 1').fetchone():
+        for table in ('messages', 'user_sessions'):
+            cursor.execute(f'''
+                UPDATE {table}
+                SET conversation_id = (SELECT keep_id FROM conversation_merge WHERE old_id = {table}.conversation_id)
+                WHERE conversation_id IN (SELECT old_id FROM conversation_merge)
+            ''')
+        cursor.execute('''
+            UPDATE conversations
+            SET message_count = (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id),
+                updated_at = (
+                    SELECT MAX(updated_at) FROM conversations c
+                    WHERE c.id = conversations.id
+                       OR c.id IN (SELECT old_id FROM conversation_merge WHERE keep_id = conversations.id)
+                ),
+                last_message_id = (SELECT MAX(id) FROM messages WHERE conversation_id = conversations.id),
+                llm_context = NULL,
+                llm_context_model = NULL,
+                llm_context_prompt_hash = NULL,
+                summary = '',
+                summary_upto_id = 0
+            WHERE id IN (SELECT keep_id FROM conversation_merge)
+        ''')
+        cursor.execute('''
+            UPDATE conversations
+            SET last_message_preview = COALESCE((
+                SELECT substr(content, 1, ?) FROM messages WHERE id = conversations.last_message_id
+            ), '')
+            WHERE id IN (SELECT keep_id FROM conversation_merge)
+        ''', (LAST_MESSAGE_PREVIEW_CHARS,))
+        cursor.execute('DELETE FROM conversations WHERE id IN (SELECT old_id FROM conversation_merge)')
+    cursor.execute('DROP TABLE conversation_merge')
+
+    # L'indice univoco serve anche la ricerca per NPC (prefisso npc_id)
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_conversations_npc_user ON conversations(npc_id, user_id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_conversations_npc')
+    # Duplicava la chiave primaria
+    cursor.execute('DROP INDEX IF EXISTS idx_npcs_id')
+
+
+def add_archive_index(cursor: sqlite3.Cursor, db):
+    """Posizione nei file di segmento dei messaggi archiviati (un blocco per archiviazione)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_index (
+            conversation_id INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            segment INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            crc32 INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (conversation_id, first_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def create_message_search(cursor: sqlite3.Cursor):
+    """Indice FTS5 sui messaggi, mantenuto dai trigger.
+    
+    È una tabella "external content": il testo resta solo in messages e l'indice
+    contiene i token. NPC e utente sono indicizzati come un solo token (hex
+    dell'id), così i filtri della ricerca sono risolti dall'indice stesso.
+    Solleva sqlite3.OperationalError se SQLite non include FTS5.
+    """
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS messages_search_source AS
+        SELECT m.id, m.content, hex(c.npc_id) AS npc, hex(c.user_id) AS usr
+        FROM messages m
+        LEFT JOIN conversations c ON c.id = m.conversation_id
+    ''')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, npc, usr,
+            content='messages_search_source', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    # I valori passati a 'delete' devono coincidere con quelli indicizzati:
+    # i messaggi vanno eliminati prima della loro conversazione
+    def values(row: str) -> str:
+        return (f"{row}.id, {row}.content, "
+                f"(SELECT hex(npc_id) FROM conversations WHERE id = {row}.conversation_id), "
+                f"(SELECT hex(user_id) FROM conversations WHERE id = {row}.conversation_id)")
+    
+    insert = f"INSERT INTO messages_fts (rowid, content, npc, usr) VALUES ({values('NEW')});"
+    delete = f"INSERT INTO messages_fts (messages_fts, rowid, content, npc, usr) VALUES ('delete', {values('OLD')});"
+    search_triggers = {
+        'trg_messages_fts_insert': ('AFTER INSERT ON messages', insert),
+        'trg_messages_fts_delete': ('AFTER DELETE ON messages', delete),
+        'trg_messages_fts_update': ('AFTER UPDATE OF content, conversation_id ON messages', delete + insert),
+    }
+    for trigger, (event, body) in search_triggers.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {trigger} {event}
+            BEGIN
+                {body}
+            END
+        ''')
+
+
+def add_activity_minutes(cursor: sqlite3.Cursor, db):
+    """Il trigger dell'attività scrive un solo contatore al minuto per NPC e utente.
+
+    I nove upsert per messaggio (tre bucket per tre dimensioni) stavano nella
+    transazione di ogni scrittura; ora la manutenzione riporta i contatori in
+    activity_rollups. Gli aggregati già presenti restano validi.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_minutes (
+            npc_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            bucket_start TEXT NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            user_messages INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (npc_id, user_id, bucket_start)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS trg_messages_activity')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_messages_activity AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO activity_minutes (npc_id, user_id, bucket_start, messages, user_messages)
+            SELECT npc_id, user_id, strftime('{ACTIVITY_BUCKETS["minute"]}', NEW.timestamp), 1, NEW.sender = 'user'
+            FROM conversations WHERE id = NEW.conversation_id
+            ON CONFLICT (npc_id, user_id, bucket_start) DO UPDATE
+            SET messages = messages + 1,
+                user_messages = user_messages + excluded.user_messages;
+        END
+    ''')
+
+
+def add_message_search(cursor: sqlite3.Cursor, db):
+    """Ricerca full-text nei messaggi, indicizzando quelli già presenti"""
+    try:
+        create_message_search(cursor)
+    except sqlite3.OperationalError as e:
+        if "fts5" not in str(e):
+            raise
+        # Si potrà creare in seguito con python db_tools.py rebuild-search
+        print("⚠️  SQLite non include FTS5: ricerca nei messaggi disabilitata")
+        return
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+# Migrazioni in ordine: la versione dello schema (PRAGMA user_version) è la posizione nella lista
+MIGRATIONS: List[Tuple[str, Callable[[sqlite3.Cursor, object], None]]] = [
+    ("schema iniziale", create_base_schema),
+    ("token, contesto di Ollama e riassunti", add_llm_columns),
+    ("indice (conversation_id, id) sui messaggi", add_messages_tail_index),
+    ("versioni degli NPC", add_npc_versions),
+    ("statistiche delle conversazioni", add_conversation_stats),
+    ("aggregati di attività", add_activity_rollups),
+    ("identificativo del database", add_database_id),
+    ("ultimo messaggio delle conversazioni", add_last_message_pointer),
+    ("conversazioni univoche per NPC e utente", unique_conversations),
+    ("indice dell'archivio dei messaggi", add_archive_index),
+    ("ricerca full-text nei messaggi", add_message_search),
+    ("attività al minuto nel trigger, aggregati in manutenzione", add_activity_minutes),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def run_migrations(db, conn: sqlite3.Connection) -> List[int]:
+    """Applica le migrazioni mancanti, ciascuna nella propria transazione.
+
+    Se lo schema è già aggiornato basta una lettura, senza lock di scrittura:
+    un riavvio non contende il lock con chi sta scrivendo. Altrimenti la
+    versione viene riletta dopo aver preso il lock, così più processi avviati
+    insieme non applicano due volte la stessa migrazione.
+    Restituisce le versioni applicate.
+    """
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    if current >= len(MIGRATIONS):
+        return []
+
+    applied = []
+    for version, (_, migration) in enumerate(MIGRATIONS[current:], current + 1):
+        db.pool.begin_immediate(conn)
+        try:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            if current >= version:
+                conn.commit()
+                continue
+            migration(conn.cursor(), db)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        applied.append(version)
+    if applied:
+        print(f"🗄️  Schema del database aggiornato alla versione {applied[-1]} (migrazioni {applied[0]}-{applied[-1]})")
+    return applied
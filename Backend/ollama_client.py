@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "openhermes")
+# Endpoint e modello degli embedding (di default /api/embed sullo stesso server)
+OLLAMA_EMBED_URL = os.getenv("OLLAMA_EMBED_URL", "")
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+
+# Dimensione del pool di connessioni keep-alive verso Ollama
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "100"))
+# Timeout (secondi) per una singola generazione
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))
+
+
+class OllamaClient:
+    """Client per Ollama con connessioni persistenti, sia sincrono che asincrono"""
+
+    def __init__(self, url: str = OLLAMA_URL, model: str = OLLAMA_MODEL,
+                 pool_size: int = OLLAMA_POOL_SIZE, timeout: float = OLLAMA_TIMEOUT,
+                 embed_url: str = OLLAMA_EMBED_URL, embed_model: str = OLLAMA_EMBED_MODEL):
+        self.url = url
+        self.model = model
+        self.embed_url = embed_url or url.rsplit("/api/", 1)[0] + "/api/embed"
+        self.embed_model = embed_model
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session: Optional[requests.Session] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_session(self) -> requests.Session:
+        """Sessione requests condivisa (usata dal percorso sincrono)"""
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """Client httpx condiviso, ricreato se cambia l'event loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop or self._async_client.is_closed:
+            limits = httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            )
+            self._async_client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+            self._async_loop = loop
+        return self._async_client
+
+    def _payload(self, prompt: str, stream: bool, **options) -> Dict:
+        payload = {"model": self.model, "prompt": prompt, "stream": stream}
+        payload.update(options)
+        return payload
+
+    def generate(self, prompt: str, **options) -> Dict:
+        """Genera una risposta in modo sincrono"""
+        response = self._get_session().post(
+            self.url, json=self._payload(prompt, False, **options), timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def embed(self, texts: List[str], timeout: Optional[float] = None) -> List[List[float]]:
+        """Calcola gli embedding di più testi con una sola richiesta"""
+        response = self._get_session().post(
+            self.embed_url, json={"model": self.embed_model, "input": texts},
+            timeout=timeout or self.timeout
+        )
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    async def agenerate(self, prompt: str, **options) -> Dict:
+        """Genera una risposta senza occupare un thread durante l'attesa"""
+        response = await self._get_async_client().post(
+            self.url, json=self._payload(prompt, False, **options)
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def astream(self, prompt: str, **options) -> AsyncIterator[Dict]:
+        """Genera una risposta in streaming, restituendo i chunk di Ollama man mano"""
+        client = self._get_async_client()
+        async with client.stream("POST", self.url, json=self._payload(prompt, True, **options)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    def close(self):
+        """Chiude la sessione sincrona"""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    async def aclose(self):
+        """Chiude il client asincrono (da chiamare allo shutdown dell'app)"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_loop = None
+
+
+# Istanza globale del client Ollama
+ollama = OllamaClient()
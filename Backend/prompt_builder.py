@@ -0,0 +1,130 @@
+import hashlib
+import math
+import os
+from typing import Dict, List, Optional
+
+# Finestra di contesto del modello (inviata a Ollama come options.num_ctx)
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
+# Token lasciati liberi per la risposta dell'NPC
+PROMPT_RESPONSE_RESERVE = int(os.getenv("PROMPT_RESPONSE_RESERVE", "512"))
+# Numero massimo di messaggi candidati da leggere per lo storico
+PROMPT_HISTORY_MAX_MESSAGES = int(os.getenv("PROMPT_HISTORY_MAX_MESSAGES", "100"))
+# Riusa il contesto restituito da Ollama invece di rinviare prompt e storico a ogni turno
+OLLAMA_REUSE_CONTEXT = os.getenv("OLLAMA_REUSE_CONTEXT", "true").lower() in ("1", "true", "yes")
+
+# Stima prudente: meglio sovrastimare che superare num_ctx
+CHARS_PER_TOKEN = 3.0
+# Token aggiuntivi per l'etichetta e gli a capo di ogni messaggio
+MESSAGE_OVERHEAD_TOKENS = 4
+
+CONTEXT_HEADER = "Contesto della conversazione precedente:\n\n"
+SUMMARY_HEADER = "Riassunto della conversazione finora:\n"
+MEMORY_HEADER = "Ricordi pertinenti di questa conversazione:\n\n"
+# Quota massima del budget dello storico riservata ai ricordi
+MEMORY_BUDGET_SHARE = 0.25
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima locale del numero di token di un testo"""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def message_tokens(message: Dict) -> int:
+    """Token di un messaggio: quelli salvati nel database o, se mancano, stimati"""
+    token_count = message.get('token_count')
+    if token_count is None:
+        token_count = estimate_tokens(message['content'])
+    return token_count + MESSAGE_OVERHEAD_TOKENS
+
+
+def format_turn(npc: Dict, user_input: str) -> str:
+    """Ultima battuta del prompt: il messaggio dell'avventuriero e l'attacco della risposta"""
+    return f"Avventuriero: {user_input}\n{npc['name']}:"
+
+
+def prompt_hash(npc: Dict) -> str:
+    """Impronta del prompt dell'NPC, per capire se un contesto salvato è ancora valido"""
+    return hashlib.sha1(npc['prompt'].encode('utf-8')).hexdigest()
+
+
+def can_reuse_context(llm_context: Optional[Dict], npc: Dict, user_input: str, model: str,
+                      num_ctx: int = OLLAMA_NUM_CTX,
+                      response_reserve: int = PROMPT_RESPONSE_RESERVE) -> bool:
+    """Indica se il turno può continuare dal contesto di Ollama salvato.
+
+    Non si può se il contesto manca, se nel frattempo sono cambiati il modello o il
+    prompt dell'NPC, o se il contesto è cresciuto troppo per la finestra del modello.
+    """
+    if not OLLAMA_REUSE_CONTEXT or not llm_context:
+        return False
+    if llm_context['model'] != model or llm_context['prompt_hash'] != prompt_hash(npc):
+        return False
+    needed = len(llm_context['context']) + estimate_tokens(format_turn(npc, user_input)) + response_reserve
+    return needed <= num_ctx
+
+
+def select_history(history: List[Dict], budget: int) -> List[Dict]:
+    """Sceglie i messaggi più recenti che stanno nel budget, in ordine cronologico"""
+    selected = []
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if cost > budget:
+            break
+        budget -= cost
+        selected.append(message)
+    selected.reverse()
+    return selected
+
+
+def format_history(messages: List[Dict], header: str = CONTEXT_HEADER) -> str:
+    """Formatta lo storico come contesto per l'LLM"""
+    if not messages:
+        return ""
+
+    context = header
+    for msg in messages:
+        role = "Utente" if msg['sender'] == 'user' else "NPC"
+        context += f"{role}: {msg['content']}\n\n"
+    return context
+
+
+def build_prompt(npc: Dict, user_input: str, history: Optional[List[Dict]] = None,
+                 summary: str = "", memories: Optional[List[Dict]] = None,
+                 num_ctx: int = OLLAMA_NUM_CTX,
+                 response_reserve: int = PROMPT_RESPONSE_RESERVE) -> str:
+    """Costruisce il prompt completo restando nella finestra di contesto del modello.
+
+    L'eventuale riassunto dei messaggi più vecchi precede lo storico recente, che
+    viene riempito dal messaggio più recente al più vecchio finché non si esaurisce
+    il budget di token. I ricordi (messaggi passati pertinenti, in ordine
+    cronologico) stanno tra riassunto e storico e usano al massimo
+    MEMORY_BUDGET_SHARE del budget.
+    """
+    base_prompt = npc['prompt']
+    turn = format_turn(npc, user_input)
+    if summary:
+        base_prompt = f"{base_prompt}\n\n{SUMMARY_HEADER}{summary}"
+
+    budget = (num_ctx - response_reserve - estimate_tokens(base_prompt)
+              - estimate_tokens(turn) - estimate_tokens(CONTEXT_HEADER))
+    if memories:
+        memory_budget = int(budget * MEMORY_BUDGET_SHARE) - estimate_tokens(MEMORY_HEADER)
+        recalled = []
+        for message in memories:
+            cost = message_tokens(message)
+            if cost <= memory_budget:
+                memory_budget -= cost
+                budget -= cost
+                recalled.append(message)
+        if recalled:
+            base_prompt = f"{base_prompt}\n\n{format_history(recalled, MEMORY_HEADER).rstrip()}"
+            budget -= estimate_tokens(MEMORY_HEADER)
+    context = format_history(select_history(history or [], budget))
+
+    if context:
+        # Aggiungi il contesto al prompt
+        return f"{base_prompt}\n\n{context}\n\n{turn}"
+    # Prima conversazione o conversazione senza storico, usa solo il prompt base
+    return f"{base_prompt}\n\n{turn}"
@@ -0,0 +1,249 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional
+from metrics import QUEUE_WAIT
+
+# Generazioni contemporanee verso Ollama (come OLLAMA_NUM_PARALLEL del backend)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "1"))
+# Richieste in attesa oltre le quali si risponde 429
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))
+# Richieste in attesa consentite per singolo utente
+LLM_MAX_QUEUE_PER_USER = int(os.getenv("LLM_MAX_QUEUE_PER_USER", "3"))
+
+# Priorità delle richieste: i turni di chat passano prima dei lavori in background
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+# Etichetta "NPC" dei lavori in background, tenuti separati nella metrica dell'attesa in coda
+BACKGROUND_QUEUE = "background"
+
+
+class SchedulerQueueFull(Exception):
+    """La coda delle generazioni è piena: riprovare dopo `retry_after` secondi"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """Richiesta in attesa di un posto, da un event loop (future) o da un thread (evento)"""
+
+    __slots__ = ("npc_id", "granted", "_loop", "_future", "_event")
+
+    def __init__(self, npc_id: str, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.npc_id = npc_id
+        self.granted = False
+        self._loop = loop
+        self._future = loop.create_future() if loop is not None else None
+        self._event = threading.Event() if loop is None else None
+
+    def wake(self) -> bool:
+        """Assegna il posto e sveglia chi attende; False se il suo event loop è già chiuso"""
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._resolve)
+            except RuntimeError:
+                return False
+        else:
+            self._event.set()
+        self.granted = True
+        return True
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+    async def wait(self):
+        await self._future
+
+    def wait_sync(self):
+        self._event.wait()
+
+
+class LLMScheduler:
+    """Scheduler delle generazioni con turni equi tra NPC e tra utenti.
+
+    Al massimo `max_concurrency` generazioni sono in corso; le altre attendono in
+    una coda per NPC, divisa a sua volta per utente. Quando si libera un posto si
+    serve il prossimo NPC a rotazione e, al suo interno, il prossimo utente a
+    rotazione: una raffica di messaggi verso un NPC non passa davanti agli utenti
+    degli altri NPC, e un utente non passa davanti agli altri utenti dello stesso
+    NPC. Le richieste in background (riassunti, embedding) hanno una coda a
+    parte, servita solo quando non c'è nessun turno di chat in attesa.
+
+    Si usa sia dall'event loop (`slot`) sia dai thread (`slot_sync`): lo stato è
+    protetto da un lock e chi attende viene svegliato nel proprio contesto.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE,
+                 max_queue_per_user: int = LLM_MAX_QUEUE_PER_USER):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self._lock = threading.Lock()
+        self._active = 0
+        # priorità -> npc_id -> user_id -> richieste in attesa
+        self._queues: Dict[int, "OrderedDict[str, OrderedDict[str, deque]]"] = {
+            PRIORITY_INTERACTIVE: OrderedDict(),
+            PRIORITY_BACKGROUND: OrderedDict(),
+        }
+        self._waiting = 0
+        self._waiting_per_user: Dict[str, int] = {}
+        # Statistiche
+        self._served = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._service_total = 0.0
+
+    def retry_after(self) -> int:
+        """Stima dei secondi necessari a smaltire la coda attuale"""
+        average_service = self._service_total / self._served if self._served else 10.0
+        return max(1, math.ceil((self._waiting + 1) * average_service / self.max_concurrency))
+
+    def check_capacity(self, user_id: str):
+        """Solleva SchedulerQueueFull se una nuova richiesta dell'utente verrebbe rifiutata"""
+        with self._lock:
+            self._check_capacity(user_id)
+
+    def _check_capacity(self, user_id: str):
+        if self._active < self.max_concurrency and self._waiting == 0:
+            return
+        if self._waiting >= self.max_queue:
+            self._rejected += 1
+            raise SchedulerQueueFull("Troppe richieste in coda, riprova più tardi", self.retry_after())
+        if self._waiting_per_user.get(user_id, 0) >= self.max_queue_per_user:
+            self._rejected += 1
+            raise SchedulerQueueFull("Hai già troppi messaggi in attesa di risposta", self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, npc_id: str, user_id: str, priority: int = PRIORITY_INTERACTIVE):
+        """Attende il proprio turno e occupa un posto di generazione per la durata del blocco"""
+        queued_at = time.monotonic()
+        waiter = self._enqueue(npc_id, user_id, priority, asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await waiter.wait()
+            except asyncio.CancelledError:
+                self._cancel(waiter, user_id, priority)
+                raise
+        started_at = self._started(npc_id, queued_at)
+        try:
+            yield started_at - queued_at
+        finally:
+            self._finished(started_at)
+
+    @contextmanager
+    def slot_sync(self, npc_id: str, user_id: str, priority: int = PRIORITY_INTERACTIVE):
+        """Come `slot`, per il codice sincrono: blocca il thread finché non c'è un posto"""
+        queued_at = time.monotonic()
+        waiter = self._enqueue(npc_id, user_id, priority)
+        if waiter is not None:
+            waiter.wait_sync()
+        started_at = self._started(npc_id, queued_at)
+        try:
+            yield started_at - queued_at
+        finally:
+            self._finished(started_at)
+
+    def _enqueue(self, npc_id: str, user_id: str, priority: int,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> Optional[_Waiter]:
+        """Occupa subito un posto libero (None) o mette in coda la richiesta"""
+        with self._lock:
+            # Le richieste in background non vengono mai rifiutate: sono poche e aspettano
+            if priority == PRIORITY_INTERACTIVE:
+                self._check_capacity(user_id)
+            if self._active < self.max_concurrency and self._waiting == 0:
+                self._active += 1
+                return None
+
+            waiter = _Waiter(npc_id, loop)
+            users = self._queues[priority].setdefault(npc_id, OrderedDict())
+            users.setdefault(user_id, deque()).append(waiter)
+            self._waiting += 1
+            self._waiting_per_user[user_id] = self._waiting_per_user.get(user_id, 0) + 1
+            return waiter
+
+    def _cancel(self, waiter: _Waiter, user_id: str, priority: int):
+        with self._lock:
+            if waiter.granted:
+                # Il posto era già stato assegnato: lo si restituisce
+                self._active -= 1
+                self._wake_next()
+                return
+            npcs = self._queues[priority]
+            users = npcs.get(waiter.npc_id, {})
+            if user_id in users and waiter in users[user_id]:
+                users[user_id].remove(waiter)
+                self._dequeued(user_id)
+                if not users[user_id]:
+                    del users[user_id]
+                if not users:
+                    del npcs[waiter.npc_id]
+
+    def _started(self, npc_id: str, queued_at: float) -> float:
+        started_at = time.monotonic()
+        waited = started_at - queued_at
+        QUEUE_WAIT.labels(npc_id).observe(waited)
+        with self._lock:
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return started_at
+
+    def _finished(self, started_at: float):
+        with self._lock:
+            self._served += 1
+            self._service_total += time.monotonic() - started_at
+            self._active -= 1
+            self._wake_next()
+
+    def _dequeued(self, user_id: str):
+        self._waiting -= 1
+        self._waiting_per_user[user_id] -= 1
+        if not self._waiting_per_user[user_id]:
+            del self._waiting_per_user[user_id]
+
+    def _wake_next(self):
+        """Assegna i posti liberi: prima i turni di chat, al prossimo NPC e utente a rotazione"""
+        while self._active < self.max_concurrency:
+            npcs = next((queue for queue in self._queues.values() if queue), None)
+            if npcs is None:
+                return
+            npc_id, users = next(iter(npcs.items()))
+            user_id, pending = next(iter(users.items()))
+            waiter = pending.popleft()
+            self._dequeued(user_id)
+            if pending:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                npcs.move_to_end(npc_id)
+            else:
+                del npcs[npc_id]
+
+            self._active += 1
+            if not waiter.wake():
+                self._active -= 1
+
+    def stats(self) -> Dict:
+        """Statistiche della coda (attesa media e massima in secondi)"""
+        with self._lock:
+            return {
+                "active": self._active,
+                "waiting": self._waiting,
+                "max_concurrency": self.max_concurrency,
+                "served": self._served,
+                "rejected": self._rejected,
+                "avg_wait_seconds": round(self._wait_total / self._served, 3) if self._served else 0.0,
+                "max_wait_seconds": round(self._wait_max, 3),
+            }
+
+
+# Istanza globale dello scheduler
+llm_scheduler = LLMScheduler()
@@ -1,24 +1,132 @@
-import requests
+import asyncio
+import functools
 import json
 import os
-from datetime import datetime
-from typing import Dict, List, Optional
-from database import chat_db
-
-OLLAMA_URL = "http://localhost:11434/api/generate"
-OLLAMA_MODEL = "openhermes"
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from database import ACTIVITY_BUCKETS, chat_db
+from metrics import GENERATION, PROMPT_BUILD, TIME_TO_FIRST_TOKEN, observe_ollama_stats
+from ollama_client import ollama, OLLAMA_URL, OLLAMA_MODEL
+from scheduler import SchedulerQueueFull, llm_scheduler
+from summarizer import SUMMARY_ENABLED, summarizer
+from memory import MEMORY_ENABLED, conversation_memory
+from prompt_builder import (
+    OLLAMA_NUM_CTX, PROMPT_HISTORY_MAX_MESSAGES,
+    build_prompt, can_reuse_context, estimate_tokens, format_turn, prompt_hash
+)
 
 class NPCManager:
+    """Gestore degli NPC con cache in memoria delle definizioni.
+    
+    La cache viene invalidata dalle modifiche fatte tramite il gestore e, per
+    quelle fatte da altri processi (es. la CLI npc_manager.py), dai contatori
+    di versione del database.
+    """
+    
     def __init__(self):
-        pass  # Non serve più caricare da file JSON
+        self._lock = threading.Lock()
+        self._npcs: Dict[str, Dict] = {}
+        self._all_npcs: Optional[List[Dict]] = None
+        self._summaries: Optional[List[Dict]] = None
+        # (id, nome) degli NPC: dipende solo dalle definizioni, non dall'attività
+        self._names: Optional[List[Tuple[str, str]]] = None
+        self._versions: Optional[Tuple[int, int]] = None
+    
+    def _sync_cache(self) -> Tuple[int, int]:
+        """Allinea la cache alle versioni correnti del database"""
+        versions = chat_db.get_npc_versions()
+        with self._lock:
+            if self._versions is None or versions[0] != self._versions[0]:
+                # Definizioni cambiate: si svuota tutto
+                self._npcs.clear()
+                self._all_npcs = None
+                self._summaries = None
+                self._names = None
+            elif versions[1] != self._versions[1]:
+                # Cambiati solo gli ultimi messaggi: si ricaricano le liste
+                self._all_npcs = None
+                self._summaries = None
+            self._versions = versions
+        return versions
+    
+    def invalidate(self):
+        """Svuota la cache degli NPC"""
+        with self._lock:
+            self._npcs.clear()
+            self._all_npcs = None
+            self._summaries = None
+            self._names = None
+            self._versions = None
     
     def get_npc(self, npc_id: str) -> Optional[Dict]:
-        """Ottiene un NPC specifico per ID dal database"""
-        return chat_db.get_npc_by_id(npc_id)
+        """Ottiene un NPC specifico per ID (dalla cache se disponibile).
+        
+        I campi di attività (lastMessage) possono essere meno aggiornati della lista completa.
+        """
+        versions = self._sync_cache()
+        with self._lock:
+            npc = self._npcs.get(npc_id)
+        
+        if npc is None:
+            npc = chat_db.get_npc_by_id(npc_id)
+            if npc is None:
+                return None
+            with self._lock:
+                # Salva solo se nel frattempo la cache non è stata invalidata
+                if self._versions == versions:
+                    self._npcs[npc_id] = npc
+        
+        return dict(npc)
     
     def get_all_npcs(self) -> List[Dict]:
-        """Ottiene tutti gli NPC dal database"""
-        return chat_db.get_all_npcs()
+        """Ottiene tutti gli NPC (dalla cache se disponibile)"""
+        versions = self._sync_cache()
+        with self._lock:
+            npcs = self._all_npcs
+        
+        if npcs is None:
+            npcs = chat_db.get_all_npcs()
+            with self._lock:
+                if self._versions == versions:
+                    self._all_npcs = npcs
+                    self._npcs.update((npc['id'], npc) for npc in npcs)
+        
+        return [dict(npc) for npc in npcs]
+    
+    def get_npc_names(self) -> List[Tuple[str, str]]:
+        """(id, nome) di tutti gli NPC (dalla cache, ricaricata solo se cambiano le definizioni)"""
+        versions = self._sync_cache()
+        with self._lock:
+            names = self._names
+        
+        if names is None:
+            names = chat_db.get_npc_names()
+            with self._lock:
+                if self._versions == versions:
+                    self._names = names
+        
+        return list(names)
+    
+    def get_npc_summaries(self) -> Tuple[List[Dict], str]:
+        """Lista degli NPC senza prompt (dalla cache se disponibile) e la sua versione.
+        
+        La versione cambia a ogni modifica degli NPC o dei loro ultimi messaggi
+        ed è pensata per essere usata come ETag.
+        """
+        versions = self._sync_cache()
+        with self._lock:
+            summaries = self._summaries
+        
+        if summaries is None:
+            summaries = chat_db.get_npc_summaries()
+            with self._lock:
+                if self._versions == versions:
+                    self._summaries = summaries
+        
+        return [dict(npc) for npc in summaries], f"{chat_db.database_id}.{versions[0]}.{versions[1]}"
     
     def update_npc_last_message(self, npc_id: str, message: str):
         """Aggiorna l'ultimo messaggio di un NPC nel database"""
@@ -26,83 +134,284 @@ class NPCManager:
     
     def add_npc(self, npc_data: Dict) -> bool:
         """Aggiunge un nuovo NPC al database"""
-        return chat_db.create_npc(npc_data)
+        success = chat_db.create_npc(npc_data)
+        self.invalidate()
+        return success
     
     def update_npc(self, npc_id: str, npc_data: Dict) -> bool:
         """Aggiorna un NPC esistente nel database"""
-        return chat_db.update_npc(npc_id, npc_data)
+        success = chat_db.update_npc(npc_id, npc_data)
+        self.invalidate()
+        return success
     
     def delete_npc(self, npc_id: str) -> bool:
         """Elimina un NPC dal database"""
-        return chat_db.delete_npc(npc_id)
+        success = chat_db.delete_npc(npc_id)
+        self.invalidate()
+        return success
 
 # Istanza globale del gestore NPC
 npc_manager = NPCManager()
 
-def query_ollama(user_input: str, npc_id: str = "aedryan", user_id: str = "default_user", include_history: bool = True) -> str:
-    """Query Ollama con un NPC specifico e storico della conversazione"""
-    npc = npc_manager.get_npc(npc_id)
-    if not npc:
-        return f"NPC {npc_id} non trovato."
+async def _run_sync(func, *args, **kwargs):
+    """Esegue una funzione bloccante (es. accesso al database) nel thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+def _prepare_turn(user_input: str, npc_id: str, user_id: str, include_history: bool) -> Optional[Dict]:
+    """Prepara un turno di chat: legge NPC e storico e costruisce il prompt.
     
-    # Ottieni o crea la conversazione
-    conversation_id = chat_db.get_or_create_conversation(npc_id, user_id)
+    Se possibile il turno continua dal contesto di Ollama salvato, inviando solo la
+    nuova battuta; altrimenti si costruisce il prompt completo con lo storico.
+    Non scrive nulla: il turno viene salvato per intero da _complete_turn/_fail_turn.
+    """
+    started = time.perf_counter()
+    # Tutte le letture avvengono sulla stessa istantanea del database
+    with chat_db.read_snapshot():
+        npc = npc_manager.get_npc(npc_id)
+        if not npc:
+            return None
+        
+        conversation_id = chat_db.find_conversation(npc_id, user_id)
+        
+        llm_context = None
+        summary = {'summary': "", 'upto_id': 0}
+        history = []
+        if include_history and conversation_id is not None:
+            llm_context = chat_db.get_llm_context(conversation_id)
+            if not can_reuse_context(llm_context, npc, user_input, ollama.model):
+                llm_context = None
+                # Riassunto dei messaggi più vecchi + messaggi candidati successivi
+                # (il prompt builder sceglie quanti ne stanno)
+                summary = chat_db.get_summary(conversation_id)
+                history = chat_db.get_recent_messages(
+                    conversation_id, PROMPT_HISTORY_MAX_MESSAGES, after_id=summary['upto_id']
+                )
     
-    # Salva il messaggio dell'utente
-    chat_db.add_message(conversation_id, "user", user_input)
+    # Messaggi passati pertinenti al nuovo messaggio, esclusi quelli già candidati per lo storico
+    # (solo l'embedding del messaggio, con timeout breve; gli altri sono calcolati in background)
+    memories = []
+    if MEMORY_ENABLED and include_history and conversation_id is not None and not llm_context:
+        memories = conversation_memory.recall(conversation_id, history, user_input)
     
-    # Costruisci il prompt con il contesto storico
-    base_prompt = npc['prompt']
+    turn = {
+        "npc": npc,
+        "user_id": user_id,
+        "user_input": user_input,
+        "conversation_id": conversation_id,
+        "prompt_hash": prompt_hash(npc),
+        # Il contesto di Ollama si aggiorna solo per i turni con storico
+        "track_context": include_history,
+        "params": {"options": {"num_ctx": OLLAMA_NUM_CTX}},
+    }
     
-    if include_history:
-        # Ottieni il contesto della conversazione (ultimi 10 messaggi)
-        conversation_context = chat_db.get_conversation_context(conversation_id, max_messages=10)
-        
-        if conversation_context:
-            # Aggiungi il contesto al prompt
-            full_prompt = f"{base_prompt}\n\n{conversation_context}\n\nAvventuriero: {user_input}\n{npc['name']}:"
-        else:
-            # Prima conversazione, usa solo il prompt base
-            full_prompt = f"{base_prompt}\n\nAvventuriero: {user_input}\n{npc['name']}:"
+    if llm_context:
+        turn["prompt"] = format_turn(npc, user_input)
+        turn["params"]["context"] = llm_context["context"]
     else:
-        # Conversazione senza storico
-        full_prompt = f"{base_prompt}\n\nAvventuriero: {user_input}\n{npc['name']}:"
+        turn["prompt"] = build_prompt(npc, user_input, history, summary=summary['summary'], memories=memories)
+    
+    PROMPT_BUILD.labels("context" if llm_context else "full").observe(time.perf_counter() - started)
+    return turn
+
+def _observe_generation(turn: Dict, started: float, outcome: str):
+    """Registra la durata di una generazione"""
+    GENERATION.labels(turn["npc"]["id"], ollama.model, outcome).observe(time.perf_counter() - started)
+
+def _complete_turn(turn: Dict, data: Dict) -> str:
+    """Salva messaggio utente, risposta dell'NPC e ultimo messaggio in un'unica transazione"""
+    npc = turn["npc"]
+    reply = data.get("response", f"Non ho ricevuto risposta da {npc['name']}.")
+    observe_ollama_stats(npc['id'], ollama.model, data)
+    
+    llm_context = None
+    if turn["track_context"]:
+        llm_context = {}
+        if data.get("context"):
+            llm_context = {
+                "context": data["context"],
+                "model": ollama.model,
+                "prompt_hash": turn["prompt_hash"],
+            }
     
+    turn["conversation_id"] = chat_db.record_turn(
+        npc['id'], turn["user_id"], turn["user_input"], reply,
+        conversation_id=turn["conversation_id"],
+        user_tokens=estimate_tokens(turn["user_input"]),
+        # eval_count è il numero esatto di token generati dal modello
+        reply_tokens=data.get("eval_count") or estimate_tokens(reply),
+        llm_context=llm_context,
+    )
+    
+    # Le conversazioni lunghe vengono riassunte in background
+    if SUMMARY_ENABLED and turn["track_context"]:
+        summarizer.schedule(turn["conversation_id"], npc['name'])
+    # Gli embedding dei nuovi messaggi vengono calcolati in background
+    if MEMORY_ENABLED and turn["track_context"]:
+        conversation_memory.schedule(turn["conversation_id"])
+    return reply
+
+def _fail_turn(turn: Dict, error: Exception) -> str:
+    """Registra un errore di comunicazione con Ollama"""
+    npc = turn["npc"]
+    error_msg = f"Errore nella comunicazione con {npc['name']}: {str(error)}"
+    # Salva anche gli errori nel database, insieme al messaggio dell'utente;
+    # il contesto di Ollama viene scartato e il prossimo turno userà il prompt completo
+    turn["conversation_id"] = chat_db.record_turn(
+        npc['id'], turn["user_id"], turn["user_input"], error_msg,
+        conversation_id=turn["conversation_id"],
+        update_npc_last_message=False,
+        user_tokens=estimate_tokens(turn["user_input"]),
+        reply_tokens=estimate_tokens(error_msg),
+        llm_context={} if turn["track_context"] else None,
+    )
+    return error_msg
+
+def _record_interrupted_turn(turn: Dict):
+    """Salva il messaggio dell'utente di un turno interrotto (client disconnesso o annullato).
+    
+    Il turno viene registrato come fallito senza attendere la scrittura: chi lo
+    interrompe è già in cancellazione e non può più aspettare il thread pool.
+    """
+    error = RuntimeError("risposta interrotta prima della fine")
     try:
-        response = requests.post(OLLAMA_URL, json={
-            "model": OLLAMA_MODEL,
-            "prompt": full_prompt,
-            "stream": False
-        })
-        data = response.json()
-        reply = data.get("response", f"Non ho ricevuto risposta da {npc['name']}.")
-        
-        # Salva la risposta dell'NPC nel database
-        chat_db.add_message(conversation_id, "npc", reply)
-        
-        # Aggiorna l'ultimo messaggio dell'NPC
-        npc_manager.update_npc_last_message(npc_id, reply)
-        
-        return reply
+        asyncio.get_running_loop().run_in_executor(None, _fail_turn, turn, error)
+    except RuntimeError:
+        # Nessun event loop attivo (es. generatore chiuso alla chiusura del loop)
+        _fail_turn(turn, error)
+
+def query_ollama(user_input: str, npc_id: str = "aedryan", user_id: str = "default_user", include_history: bool = True) -> str:
+    """Query Ollama con un NPC specifico e storico della conversazione"""
+    turn = _prepare_turn(user_input, npc_id, user_id, include_history)
+    if not turn:
+        return f"NPC {npc_id} non trovato."
+    
+    try:
+        # Stesso scheduler del percorso asincrono (SchedulerQueueFull se la coda è piena)
+        with llm_scheduler.slot_sync(npc_id, user_id):
+            started = time.perf_counter()
+            try:
+                data = ollama.generate(turn["prompt"], **turn["params"])
+            except Exception:
+                _observe_generation(turn, started, "error")
+                raise
+            _observe_generation(turn, started, "ok")
+    except SchedulerQueueFull:
+        raise
+    except Exception as e:
+        return _fail_turn(turn, e)
+    return _complete_turn(turn, data)
+
+async def aquery_ollama(user_input: str, npc_id: str = "aedryan", user_id: str = "default_user", include_history: bool = True) -> str:
+    """Versione asincrona di query_ollama: l'attesa del modello non occupa thread"""
+    turn = await _run_sync(_prepare_turn, user_input, npc_id, user_id, include_history)
+    if not turn:
+        return f"NPC {npc_id} non trovato."
+    
+    try:
+        # Attende il proprio turno nello scheduler (SchedulerQueueFull se la coda è piena)
+        async with llm_scheduler.slot(npc_id, user_id):
+            started = time.perf_counter()
+            try:
+                data = await ollama.agenerate(turn["prompt"], **turn["params"])
+            except Exception:
+                _observe_generation(turn, started, "error")
+                raise
+            _observe_generation(turn, started, "ok")
+    except SchedulerQueueFull:
+        raise
+    except asyncio.CancelledError:
+        # Richiesta annullata durante l'attesa o la generazione: il messaggio dell'utente resta
+        _record_interrupted_turn(turn)
+        raise
     except Exception as e:
-        error_msg = f"Errore nella comunicazione con {npc['name']}: {str(e)}"
-        # Salva anche gli errori nel database
-        chat_db.add_message(conversation_id, "npc", error_msg)
-        return error_msg
+        return await _run_sync(_fail_turn, turn, e)
+    return await _run_sync(_complete_turn, turn, data)
+
+async def astream_ollama(user_input: str, npc_id: str = "aedryan", user_id: str = "default_user", include_history: bool = True) -> AsyncIterator[Dict]:
+    """Query Ollama in streaming: produce eventi 'token', poi 'done' (o 'error')"""
+    turn = await _run_sync(_prepare_turn, user_input, npc_id, user_id, include_history)
+    if not turn:
+        yield {"type": "error", "error": f"NPC {npc_id} non trovato."}
+        return
+    
+    tokens = []
+    final_chunk = {}
+    try:
+        async with llm_scheduler.slot(npc_id, user_id):
+            started = time.perf_counter()
+            try:
+                async for chunk in ollama.astream(turn["prompt"], **turn["params"]):
+                    if chunk.get("error"):
+                        raise RuntimeError(chunk["error"])
+                    token = chunk.get("response", "")
+                    if token:
+                        if not tokens:
+                            TIME_TO_FIRST_TOKEN.labels(npc_id, ollama.model).observe(time.perf_counter() - started)
+                        tokens.append(token)
+                        yield {"type": "token", "token": token}
+                    if chunk.get("done"):
+                        final_chunk = chunk
+                        break
+            except Exception:
+                _observe_generation(turn, started, "error")
+                raise
+            _observe_generation(turn, started, "ok")
+    except SchedulerQueueFull as e:
+        # Nessuna generazione è avvenuta: il turno non viene salvato
+        yield {"type": "error", "error": str(e), "retry_after": e.retry_after}
+        return
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client disconnesso a metà risposta: il messaggio dell'utente non va perso
+        _record_interrupted_turn(turn)
+        raise
+    except Exception as e:
+        error_msg = await _run_sync(_fail_turn, turn, e)
+        yield {"type": "error", "error": error_msg}
+        return
+    
+    # Salva il turno completo solo a stream terminato
+    # (l'ultimo chunk contiene le statistiche di Ollama, es. eval_count)
+    data = dict(final_chunk)
+    data.pop("response", None)
+    if tokens:
+        data["response"] = "".join(tokens)
+    reply = await _run_sync(_complete_turn, turn, data)
+    yield {"type": "done", "reply": reply}
 
 def get_chats() -> Dict:
-    """Ottiene la lista delle chat per il frontend"""
-    npcs = npc_manager.get_all_npcs()
+    """Ottiene la lista delle chat per il frontend (senza i prompt degli NPC).
+    
+    Il contenuto dipende solo da `version`, così la risposta può essere messa in cache.
+    """
+    npcs, version = npc_manager.get_npc_summaries()
     return {
         "chats": npcs,
         "total": len(npcs),
-        "timestamp": datetime.now().isoformat()
+        "version": version
     }
 
-def get_conversation_history(npc_id: str, user_id: str = "default_user", limit: int = 50) -> List[Dict]:
-    """Ottiene lo storico di una conversazione specifica"""
-    conversation_id = chat_db.get_or_create_conversation(npc_id, user_id)
-    return chat_db.get_conversation_history(conversation_id, limit)
+def get_conversation_history(npc_id: str, user_id: str = "default_user", limit: int = 50,
+                             before_id: Optional[int] = None, after_id: Optional[int] = None) -> Dict:
+    """Ottiene una pagina dello storico di una conversazione (di default i messaggi più recenti).
+    
+    Restituisce i messaggi, `has_more` e i cursori per la pagina precedente
+    (`next_before`) e per i messaggi successivi (`next_after`).
+    """
+    # La lettura dello storico non crea la conversazione
+    conversation_id = chat_db.find_conversation(npc_id, user_id)
+    if conversation_id is None:
+        page = {'messages': [], 'has_more': False}
+    else:
+        page = chat_db.get_message_page(conversation_id, limit, before_id, after_id)
+    
+    ids = [message['id'] for message in page['messages'] if message['id'] is not None]
+    return {
+        "messages": page['messages'],
+        "has_more": page['has_more'],
+        "next_before": ids[0] if ids else before_id,
+        "next_after": ids[-1] if ids else after_id
+    }
 
 def get_user_conversations(user_id: str = "default_user", limit: int = 20) -> List[Dict]:
     """Ottiene tutte le conversazioni di un utente"""
@@ -117,6 +426,59 @@ def get_conversation_stats(npc_id: str = None) -> Dict:
     """Ottiene statistiche sulle conversazioni"""
     return chat_db.get_conversation_stats(npc_id)
 
+# Intervallo restituito quando non si specifica l'inizio della serie
+TIMESERIES_DEFAULT_SPAN = {
+    "minute": timedelta(hours=1),
+    "hour": timedelta(days=1),
+    "day": timedelta(days=30),
+}
+
+def get_activity_timeseries(bucket: str = "hour", npc_id: str = None, user_id: str = None,
+                            start: str = None, end: str = None) -> Dict:
+    """Serie temporale dei messaggi (orari UTC), letta dagli aggregati di attività"""
+    if bucket not in ACTIVITY_BUCKETS:
+        raise ValueError(f"Bucket non valido: usa uno tra {', '.join(ACTIVITY_BUCKETS)}")
+    if npc_id and user_id:
+        raise ValueError("Specifica npc_id oppure user_id, non entrambi")
+    
+    end_time = datetime.fromisoformat(end) if end else datetime.utcnow()
+    start_time = datetime.fromisoformat(start) if start else end_time - TIMESERIES_DEFAULT_SPAN[bucket]
+    # Il primo bucket è quello che contiene l'inizio dell'intervallo
+    start_key = start_time.strftime(ACTIVITY_BUCKETS[bucket])
+    end_key = end_time.strftime("%Y-%m-%d %H:%M:%S")
+    
+    return {
+        "bucket": bucket,
+        "npc_id": npc_id,
+        "user_id": user_id,
+        "start": start_key,
+        "end": end_key,
+        "points": chat_db.get_activity_timeseries(bucket, start_key, end_key, npc_id, user_id)
+    }
+
+def split_search_terms(text: str) -> List[str]:
+    """Divide il testo cercato in termini: parole e frasi "tra virgolette".
+    
+    `parola*` (fuori dalle virgolette) cerca per prefisso; caratteri come
+    - : ( restano testo, perché il database quota ogni termine.
+    """
+    return [phrase.rstrip("*") if phrase else word
+            for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text)]
+
+def search_messages(query: str, npc_id: str = None, user_id: str = None,
+                    limit: int = 20, offset: int = 0) -> Dict:
+    """Ricerca full-text nei messaggi, per NPC e/o per utente"""
+    page = chat_db.search_messages(split_search_terms(query), npc_id, user_id, limit, offset)
+    return {
+        "query": query,
+        "npc_id": npc_id,
+        "user_id": user_id,
+        "results": page["results"],
+        "has_more": page["has_more"],
+        "next_offset": offset + limit if page["has_more"] else None,
+        "truncated": page["truncated"]
+    }
+
 # Funzione legacy per compatibilità
 def query_ollama_legacy(user_input: str) -> str:
     """Funzione legacy per compatibilità con il codice esistente"""
@@ -0,0 +1,146 @@
+import os
+import queue
+import threading
+from typing import Dict, List, Optional
+
+from database import ChatDatabase, chat_db
+from ollama_client import OllamaClient, ollama
+from prompt_builder import CHARS_PER_TOKEN, OLLAMA_NUM_CTX, estimate_tokens, message_tokens
+from scheduler import BACKGROUND_QUEUE, PRIORITY_BACKGROUND, LLMScheduler, llm_scheduler
+
+# Disattivato di default: i riassunti sono generazioni in più sul modello
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "false").lower() in ("1", "true", "yes")
+# Messaggi non ancora riassunti oltre i quali parte il riassunto
+SUMMARY_THRESHOLD = int(os.getenv("SUMMARY_THRESHOLD", "40"))
+# Ultimi messaggi che restano sempre fuori dal riassunto (vanno nel prompt così come sono)
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "20"))
+# Numero massimo di messaggi riassunti con una singola chiamata al modello
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "50"))
+# Lunghezza massima del riassunto (in parole, indicativa)
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "250"))
+# Token lasciati liberi per il riassunto generato (circa due per parola)
+SUMMARY_RESPONSE_RESERVE = SUMMARY_MAX_WORDS * 2
+
+
+def build_summary_prompt(npc_name: str, summary: str, messages: List[Dict]) -> str:
+    """Prompt per aggiornare il riassunto con i nuovi messaggi"""
+    lines = []
+    for msg in messages:
+        role = "Avventuriero" if msg['sender'] == 'user' else npc_name
+        lines.append(f"{role}: {msg['content']}")
+
+    return (
+        f"Stai tenendo il diario di una conversazione tra un avventuriero e {npc_name}.\n\n"
+        f"Riassunto attuale:\n{summary or '(nessuno)'}\n\n"
+        "Nuovi messaggi:\n" + "\n".join(lines) + "\n\n"
+        f"Scrivi il riassunto aggiornato in italiano, in al massimo {SUMMARY_MAX_WORDS} parole. "
+        "Conserva nomi, luoghi, promesse, missioni e fatti importanti. "
+        "Rispondi solo con il riassunto."
+    )
+
+
+def fit_summary_batch(npc_name: str, summary: str, messages: List[Dict],
+                      num_ctx: int = OLLAMA_NUM_CTX,
+                      response_reserve: int = SUMMARY_RESPONSE_RESERVE) -> List[Dict]:
+    """I primi messaggi il cui prompt di riassunto sta nella finestra di contesto.
+
+    Senza budget Ollama taglierebbe il prompt in silenzio, corrompendo il
+    riassunto salvato. I messaggi esclusi restano per il passaggio successivo;
+    un singolo messaggio più lungo dell'intero budget viene accorciato, così il
+    riassunto va comunque avanti.
+    """
+    budget = num_ctx - response_reserve - estimate_tokens(build_summary_prompt(npc_name, summary, []))
+    selected = []
+    for message in messages:
+        cost = message_tokens(message)
+        if cost > budget:
+            break
+        budget -= cost
+        selected.append(message)
+
+    if not selected and messages and budget > 0:
+        chars = int(budget * CHARS_PER_TOKEN) - len(npc_name) - 4
+        selected.append(dict(messages[0], content=messages[0]['content'][:max(chars, 0)], token_count=None))
+    return selected
+
+
+class ConversationSummarizer:
+    """Riassume in background i messaggi più vecchi delle conversazioni lunghe.
+
+    Il riassunto è incrementale: a ogni passaggio si aggiungono solo i messaggi
+    successivi all'ultimo già riassunto, così il prompt di ogni turno resta di
+    dimensione circa costante (riassunto + ultimi messaggi). Le generazioni
+    passano dallo scheduler con priorità bassa: non tolgono posti ai turni di chat.
+    """
+
+    def __init__(self, db: ChatDatabase = chat_db, client: OllamaClient = ollama,
+                 threshold: int = SUMMARY_THRESHOLD, keep_recent: int = SUMMARY_KEEP_RECENT,
+                 batch_messages: int = SUMMARY_BATCH_MESSAGES, num_ctx: int = OLLAMA_NUM_CTX,
+                 scheduler: LLMScheduler = llm_scheduler):
+        self.db = db
+        self.client = client
+        self.scheduler = scheduler
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.batch_messages = batch_messages
+        self.num_ctx = num_ctx
+        self._queue = queue.Queue()
+        self._scheduled = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, conversation_id: int, npc_name: str):
+        """Segnala che una conversazione ha nuovi messaggi (non blocca il turno)"""
+        with self._lock:
+            if conversation_id in self._scheduled:
+                return
+            self._scheduled.add(conversation_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="summarizer", daemon=True)
+                self._thread.start()
+        self._queue.put((conversation_id, npc_name))
+
+    def _run(self):
+        while True:
+            conversation_id, npc_name = self._queue.get()
+            with self._lock:
+                self._scheduled.discard(conversation_id)
+            try:
+                while self.summarize(conversation_id, npc_name):
+                    pass
+            except Exception as e:
+                print(f"⚠️  Riassunto della conversazione {conversation_id} fallito: {e}")
+
+    def summarize(self, conversation_id: int, npc_name: str) -> bool:
+        """Esegue un passaggio di riassunto; restituisce True se il riassunto è stato aggiornato"""
+        state = self.db.get_summary(conversation_id)
+        candidates = self.db.get_messages_after(
+            conversation_id, state['upto_id'],
+            max(self.threshold, self.batch_messages) + self.keep_recent
+        )
+        if len(candidates) < self.threshold + self.keep_recent:
+            return False
+
+        # I più vecchi, escludendo gli ultimi che restano nel prompt così come sono,
+        # quanti ne stanno nella finestra insieme al riassunto attuale
+        to_fold = fit_summary_batch(
+            npc_name, state['summary'],
+            candidates[:len(candidates) - self.keep_recent][:self.batch_messages], self.num_ctx
+        )
+        if not to_fold:
+            return False
+
+        with self.scheduler.slot_sync(BACKGROUND_QUEUE, "summarizer", PRIORITY_BACKGROUND):
+            data = self.client.generate(
+                build_summary_prompt(npc_name, state['summary'], to_fold),
+                options={"num_ctx": self.num_ctx},
+            )
+        summary = data.get("response", "").strip()
+        if not summary:
+            return False
+
+        return self.db.set_summary(conversation_id, summary, to_fold[-1]['id'], state['upto_id'])
+
+
+# Istanza globale del riassuntore
+summarizer = ConversationSummarizer()
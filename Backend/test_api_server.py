@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Test degli endpoint dell'API (in processo, con l'Ollama simulato)
+"""
+
+import asyncio
+import json
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from api_server import app
+from database import chat_db
+from fake_ollama import FakeOllama
+from ollama_client import ollama
+from prompt_builder import SUMMARY_HEADER, format_turn, prompt_hash
+from shared import npc_manager
+
+client = TestClient(app)
+
+@contextmanager
+def fake_ollama(**options):
+    """Punta il client globale di Ollama verso un Ollama simulato"""
+    fake = FakeOllama(**options).start()
+    url = ollama.url
+    ollama.url = fake.url
+    try:
+        yield fake
+    finally:
+        ollama.url = url
+        fake.stop()
+
+def read_events(response):
+    """Eventi Server-Sent Events di una risposta, come (tipo, dati)"""
+    events = []
+    for block in response.text.split("\n\n"):
+        if block.strip():
+            lines = dict(line.split(": ", 1) for line in block.split("\n"))
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def test_stream():
+    print("🧪 Test Risposta in streaming (SSE)")
+    
+    user_id = "stream_test_user"
+    try:
+        with fake_ollama(reply_tokens=5, seed=1) as fake:
+            response = client.post("/api/aedryan/stream", json={"message": "Ciao", "user_id": user_id})
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = read_events(response)
+            assert [kind for kind, _ in events] == ["token"] * 5 + ["done"]
+            reply = events[-1][1]["reply"]
+            assert "".join(data["token"] for _, data in events[:-1]) == reply
+    
+            # Un errore di Ollama arriva come evento 'error' e il turno viene salvato
+            fake.error_rate = 1.0
+            response = client.post("/api/aedryan/stream", json={"message": "Ci sei?", "user_id": user_id})
+            events = read_events(response)
+            assert [kind for kind, _ in events] == ["error"]
+            assert events[0][1]["error"].startswith("Errore nella comunicazione con Re Aedryan")
+    
+        chat_db.flush()
+        conversation_id = chat_db.find_conversation("aedryan", user_id)
+        contents = [m['content'] for m in chat_db.get_recent_messages(conversation_id, 10)]
+        assert contents[:3] == ["Ciao", reply, "Ci sei?"]
+    
+        # NPC inesistente: 404 prima di aprire lo stream
+        response = client.post("/api/fantasma/stream", json={"message": "Ciao", "user_id": user_id})
+        assert response.status_code == 404
+    finally:
+        chat_db.delete_conversation(chat_db.find_conversation("aedryan", user_id) or 0)
+    
+    print("✅ Risposta in streaming OK")
+
+async def stream_until_first_chunk(path, payload):
+    """Chiama l'app ASGI e simula la disconnessione del client dopo il primo evento.
+    
+    TestClient legge sempre la risposta intera, quindi la richiesta si guida a mano.
+    """
+    body = json.dumps(payload).encode()
+    requests = [{"type": "http.request", "body": body, "more_body": False}]
+    first_chunk = asyncio.Event()
+    chunks = []
+    
+    async def receive():
+        if requests:
+            return requests.pop(0)
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+    
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append(message["body"].decode())
+            first_chunk.set()
+    
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("test", 1), "server": ("test", 80),
+    }
+    await app(scope, receive, send)
+    return chunks
+
+def test_stream_disconnect():
+    print("🧪 Test Disconnessione durante lo streaming")
+    
+    user_id = "disconnect_test_user"
+    try:
+        with fake_ollama(reply_tokens=50, tokens_per_second=20):
+            # asyncio.run attende anche la scrittura avviata nel thread pool
+            chunks = asyncio.run(stream_until_first_chunk(
+                "/api/aedryan/stream", {"message": "Raccontami tutto", "user_id": user_id}
+            ))
+        assert chunks and chunks[0].startswith("event: token")
+        assert not any("event: done" in chunk for chunk in chunks)
+        
+        # Il messaggio dell'utente resta, con la risposta segnata come interrotta
+        chat_db.flush()
+        conversation_id = chat_db.find_conversation("aedryan", user_id)
+        messages = chat_db.get_recent_messages(conversation_id, 10)
+        assert [m['content'] for m in messages][0] == "Raccontami tutto"
+        assert len(messages) == 2 and "interrotta" in messages[1]['content']
+    finally:
+        chat_db.delete_conversation(chat_db.find_conversation("aedryan", user_id) or 0)
+    
+    print("✅ Disconnessione durante lo streaming OK")
+
+def test_context_reuse():
+    print("🧪 Test Contesto di Ollama tra i turni")
+    
+    user_id = "context_test_user"
+    npc = npc_manager.get_npc("aedryan")
+    
+    def talk(message):
+        response = client.post("/api/aedryan", json={"message": message, "user_id": user_id})
+        assert response.status_code == 200
+        chat_db.flush()
+        return response.json()["reply"]
+    
+    try:
+        with fake_ollama(reply_tokens=3) as fake:
+            # Primo turno: prompt completo, poi il contesto restituito viene salvato
+            talk("Ciao")
+            assert "context" not in fake.last_request
+            conversation_id = chat_db.find_conversation("aedryan", user_id)
+            saved = chat_db.get_llm_context(conversation_id)
+            assert saved["model"] == ollama.model and saved["prompt_hash"] == prompt_hash(npc)
+            
+            # Secondo turno: solo la nuova battuta, sul contesto salvato
+            talk("Come va?")
+            assert fake.last_request["context"] == saved["context"]
+            assert fake.last_request["prompt"] == format_turn(npc, "Come va?")
+            assert len(chat_db.get_llm_context(conversation_id)["context"]) > len(saved["context"])
+            
+            # Con un altro modello il contesto non vale: prompt completo con lo storico
+            model = ollama.model
+            ollama.model = "altro-modello"
+            try:
+                talk("E adesso?")
+            finally:
+                ollama.model = model
+            assert "context" not in fake.last_request
+            assert "Come va?" in fake.last_request["prompt"]
+            
+            # Un turno fallito cancella il contesto
+            fake.error_rate = 1.0
+            assert talk("Ci sei?").startswith("Errore nella comunicazione")
+            assert chat_db.get_llm_context(conversation_id) is None
+            
+            # Dopo un riassunto il turno successivo riparte dal riassunto, non dal contesto
+            fake.error_rate = 0.0
+            messages = chat_db.get_recent_messages(conversation_id, 10)
+            assert chat_db.set_summary(conversation_id, "Il re ha accolto l'avventuriero.", messages[1]['id'], 0)
+            talk("Ricordi?")
+            assert "context" not in fake.last_request
+            prompt = fake.last_request["prompt"]
+            assert SUMMARY_HEADER + "Il re ha accolto l'avventuriero." in prompt and "Ciao" not in prompt
+            assert chat_db.get_llm_context(conversation_id) is not None
+    finally:
+        chat_db.delete_conversation(chat_db.find_conversation("aedryan", user_id) or 0)
+    
+    print("✅ Contesto di Ollama tra i turni OK")
+
+def test_chats_etag():
+    print("🧪 Test ETag della lista delle chat")
+    
+    user_id = "etag_test_user"
+    try:
+        response = client.get("/api/chats")
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        
+        # Stesso ETag, anche nella forma debole aggiunta da proxy e CDN
+        for header in (etag, f"W/{etag}", f'"altro", W/{etag}', "*"):
+            response = client.get("/api/chats", headers={"If-None-Match": header})
+            assert response.status_code == 304 and response.headers["etag"] == etag
+        assert client.get("/api/chats", headers={"If-None-Match": '"altro"'}).status_code == 200
+        
+        # Un nuovo messaggio cambia l'ultimo messaggio dell'NPC e quindi l'ETag
+        with fake_ollama(reply_tokens=3):
+            assert client.post("/api/aedryan", json={"message": "Ciao", "user_id": user_id}).status_code == 200
+        chat_db.flush()
+        response = client.get("/api/chats", headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["etag"] != etag
+    finally:
+        chat_db.delete_conversation(chat_db.find_conversation("aedryan", user_id) or 0)
+    
+    print("✅ ETag della lista delle chat OK")
+
+def test_metrics():
+    print("🧪 Test Metriche Prometheus")
+    
+    user_id = "metrics_test_user"
+    try:
+        assert client.get("/api/health").status_code == 200
+        with fake_ollama(reply_tokens=3):
+            assert client.post("/api/aedryan", json={"message": "Ciao", "user_id": user_id}).status_code == 200
+        
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        text = response.text
+        # Latenza per route (il modello del percorso, non l'URL) e attesa in coda per NPC
+        assert 'npc_http_request_duration_seconds_count{method="GET",route="/api/health",status="200"}' in text
+        assert 'npc_http_request_duration_seconds_count{method="POST",route="/api/{npc_id}",status="200"}' in text
+        assert 'npc_llm_queue_wait_seconds_count{npc="aedryan"}' in text
+        assert 'npc_llm_generation_duration_seconds_count{' in text
+        
+        # Per lo streaming la durata comprende tutto il corpo, non solo gli header
+        labels = {"method": "POST", "route": "/api/{npc_id}/stream", "status": "200"}
+        def stream_seconds():
+            return REGISTRY.get_sample_value("npc_http_request_duration_seconds_sum", labels) or 0.0
+        before = stream_seconds()
+        with fake_ollama(reply_tokens=8, tokens_per_second=20):
+            response = client.post("/api/aedryan/stream", json={"message": "Racconta", "user_id": user_id})
+            assert read_events(response)[-1][0] == "done"
+        assert stream_seconds() - before >= 0.3
+    finally:
+        chat_db.delete_conversation(chat_db.find_conversation("aedryan", user_id) or 0)
+    
+    print("✅ Metriche Prometheus OK")
+
+if __name__ == "__main__":
+    test_stream()
+    test_stream_disconnect()
+    test_context_reuse()
+    test_chats_etag()
+    test_metrics()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Test per l'Ollama simulato e gli strumenti di benchmark
+"""
+
+import asyncio
+
+import requests
+
+from benchmark import percentile, summarize_latencies
+from fake_ollama import FakeOllama
+from ollama_client import OllamaClient
+
+def test_fake_ollama():
+    print("🧪 Test Ollama simulato")
+    
+    fake = FakeOllama(reply_tokens=5, seed=1).start()
+    client = OllamaClient(url=fake.url, model="test")
+    try:
+        data = client.generate("Avventuriero: ciao\nRe Aedryan:")
+        assert data["done"] and data["eval_count"] == 5
+        assert len(data["response"].split()) == 5
+        
+        async def stream():
+            chunks = [chunk async for chunk in client.astream("ciao", context=data["context"])]
+            await client.aclose()
+            return chunks
+        
+        chunks = asyncio.run(stream())
+        assert len(chunks) == 6 and chunks[-1]["done"]
+        assert fake.last_request["context"] == data["context"]
+        
+        # Con error_rate=1 ogni generazione fallisce
+        fake.error_rate = 1.0
+        try:
+            client.generate("ciao")
+            assert False, "Doveva fallire"
+        except requests.HTTPError:
+            pass
+        assert fake.requests == 3
+    finally:
+        client.close()
+        fake.stop()
+    
+    print("✅ Ollama simulato OK")
+
+def test_percentiles():
+    print("🧪 Test Percentili")
+    
+    values = [i / 1000 for i in range(1, 101)]
+    assert percentile(values, 50) == 0.05
+    assert percentile(values, 99) == 0.099
+    assert percentile([], 50) is None
+    summary = summarize_latencies(values)
+    assert summary["count"] == 100 and summary["p95_ms"] == 95.0 and summary["max_ms"] == 100.0
+    
+    print("✅ Percentili OK")
+
+if __name__ == "__main__":
+    test_fake_ollama()
+    test_percentiles()
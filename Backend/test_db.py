@@ -3,7 +3,17 @@
 Test semplice per verificare il database
 """
 
-from database import chat_db
+import os
+import sqlite3
+import tempfile
+
+from prometheus_client import REGISTRY
+
+from database import ChatDatabase, chat_db
+from migrations import SCHEMA_VERSION
+
+# "npc_di_prova" è un NPC fittizio, non tra quelli di default: serve solo come
+# secondo npc_id per conversazioni, filtri e statistiche
 
 def test_database():
     print("🧪 Test Database NPC")
@@ -29,5 +39,531 @@ def test_database():
     
     print("\n🎉 Test completato!")
 
+def test_connection_pool():
+    print("🧪 Test Pool connessioni")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "pool.db"), pool_size=2)
+        
+        with db.connection() as conn:
+            # Le connessioni del pool usano WAL
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            
+            # Le chiamate annidate riusano la connessione già presa
+            conversation_id = db.get_or_create_conversation("aedryan", "pool_user")
+            db.add_message(conversation_id, "user", "Ciao")
+            with db.connection() as inner:
+                assert inner is conn
+        
+        assert db.pool._created == 1
+        assert len(db.get_conversation_history(conversation_id)) == 1
+        db.close()
+    
+    print("✅ Pool connessioni OK")
+
+def test_record_turn():
+    print("🧪 Test Turno in una transazione")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "turn.db"))
+        
+        assert db.find_conversation("aedryan", "turn_user") is None
+        conversation_id = db.record_turn("aedryan", "turn_user", "Salute, maestà", "Benvenuto, straniero")
+        assert db.find_conversation("aedryan", "turn_user") == conversation_id
+        
+        history = db.get_conversation_history(conversation_id)
+        assert [m['sender'] for m in history] == ["user", "npc"]
+        assert db.get_npc_by_id("aedryan")['lastMessage'] == "Benvenuto, straniero"
+        assert db.get_user_conversations("turn_user")[0]['message_count'] == 2
+        
+        # Un errore a metà turno non lascia scritture parziali
+        try:
+            db.record_turn("aedryan", "turn_user", "Ciao", None, conversation_id=conversation_id)
+        except Exception:
+            pass
+        assert len(db.get_conversation_history(conversation_id)) == 2
+        db.close()
+    
+    print("✅ Turno OK")
+
+def test_write_behind():
+    print("🧪 Test Scritture differite")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "wb.db"), write_behind=True)
+        
+        conversation_id = db.record_turn("aedryan", "wb_user", "Domanda", "Risposta")
+        db.add_message(conversation_id, "user", "Altra domanda")
+        
+        # Le letture vedono subito le scritture ancora in coda
+        history = db.get_conversation_history(conversation_id)
+        assert [m['content'] for m in history] == ["Domanda", "Risposta", "Altra domanda"]
+        assert all(m.keys() == history[0].keys() for m in history)
+        # I messaggi in coda hanno le stesse chiavi di quelli scritti, con id None
+        recent = db.get_recent_messages(conversation_id, 10)
+        assert [m['id'] for m in recent] == [None, None, None]
+        assert recent[0].keys() == {'id', 'sender', 'content', 'timestamp', 'token_count'}
+        
+        db.flush()
+        recent = db.get_recent_messages(conversation_id, 10)
+        assert all(m['id'] is not None for m in recent)
+        assert db.writer.pending_messages(conversation_id) == []
+        assert len(db.get_conversation_history(conversation_id)) == 3
+        assert db.get_user_conversations("wb_user")[0]['message_count'] == 3
+        db.close()
+    
+    print("✅ Scritture differite OK")
+
+def test_npc_versions():
+    print("🧪 Test Versioni NPC")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "versions.db")
+        db = ChatDatabase(path)
+        other = ChatDatabase(path)  # simula un altro processo (es. la CLI)
+        
+        npc_version, activity_version = db.get_npc_versions()
+        assert db.get_npc_versions() == (npc_version, activity_version)
+        
+        other.update_npc_last_message("aedryan", "Ciao")
+        assert db.get_npc_versions() == (npc_version, activity_version + 1)
+        
+        npc = other.get_npc_by_id("aedryan")
+        npc['prompt'] = "Nuovo prompt"
+        other.update_npc("aedryan", npc)
+        assert db.get_npc_versions()[0] == npc_version + 1
+        
+        other.close()
+        db.close()
+    
+    print("✅ Versioni NPC OK")
+
+def db_calls(method: str) -> float:
+    """Chiamate a un metodo di ChatDatabase finora, lette dalle metriche"""
+    return REGISTRY.get_sample_value("npc_db_operation_duration_seconds_count", {"method": method}) or 0
+
+def test_npc_name_cache():
+    print("🧪 Test Cache dei nomi degli NPC")
+    from shared import npc_manager
+    
+    assert ("aedryan", "Re Aedryan") in npc_manager.get_npc_names()
+    calls = db_calls("get_npc_names")
+    
+    # I nuovi messaggi cambiano solo l'attività: i nomi restano in cache
+    chat_db.update_npc_last_message("aedryan", "Ciao")
+    npc_manager.get_all_npcs()
+    assert ("aedryan", "Re Aedryan") in npc_manager.get_npc_names()
+    assert db_calls("get_npc_names") == calls
+    
+    print("✅ Cache dei nomi degli NPC OK")
+
+def test_npc_cache():
+    print("🧪 Test Cache degli NPC")
+    from shared import npc_manager
+    
+    other = ChatDatabase(chat_db.db_path)  # simula un altro processo (es. la CLI)
+    original = other.get_npc_by_id("aedryan")
+    try:
+        npc_manager.get_npc("aedryan")
+        npc_manager.get_all_npcs()
+        calls = db_calls("get_npc_by_id"), db_calls("get_all_npcs")
+        
+        # Versioni invariate: nessuna lettura degli NPC dal database
+        for _ in range(3):
+            assert npc_manager.get_npc("aedryan")["description"] == original["description"]
+            npc_manager.get_all_npcs()
+        assert (db_calls("get_npc_by_id"), db_calls("get_all_npcs")) == calls
+        
+        # Solo attività da un'altra connessione: l'NPC resta in cache, la lista si ricarica
+        other.update_npc_last_message("aedryan", "Messaggio da un altro processo")
+        npc_manager.get_npc("aedryan")
+        lists = {npc['id']: npc for npc in npc_manager.get_all_npcs()}
+        assert lists["aedryan"]["lastMessage"] == "Messaggio da un altro processo"
+        assert db_calls("get_npc_by_id") == calls[0] and db_calls("get_all_npcs") == calls[1] + 1
+        
+        # Definizione modificata da un'altra connessione: cache svuotata
+        other.update_npc("aedryan", dict(original, description="Descrizione modificata"))
+        assert npc_manager.get_npc("aedryan")["description"] == "Descrizione modificata"
+        lists = {npc['id']: npc for npc in npc_manager.get_all_npcs()}
+        assert lists["aedryan"]["description"] == "Descrizione modificata"
+    finally:
+        other.update_npc("aedryan", original)
+        other.close()
+    
+    print("✅ Cache degli NPC OK")
+
+def test_recent_messages():
+    print("🧪 Test Ultimi messaggi")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "recent.db"))
+        
+        conversation_id = db.get_or_create_conversation("aedryan", "recent_user")
+        for i in range(25):
+            db.add_message(conversation_id, "user", f"Messaggio {i}")
+        
+        # Devono arrivare gli ultimi messaggi, in ordine cronologico
+        recent = db.get_recent_messages(conversation_id, 3)
+        assert [m['content'] for m in recent] == ["Messaggio 22", "Messaggio 23", "Messaggio 24"]
+        assert "Messaggio 24" in db.get_conversation_context(conversation_id, max_messages=3)
+        assert "Messaggio 0" not in db.get_conversation_context(conversation_id, max_messages=3)
+        db.close()
+    
+    print("✅ Ultimi messaggi OK")
+
+def test_conversation_stats():
+    print("🧪 Test Statistiche incrementali")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "stats.db"))
+        
+        first = db.record_turn("aedryan", "stats_user", "Ciao", "Salve")
+        db.record_turn("aedryan", "stats_user", "Come stai?", "Bene", conversation_id=first)
+        second = db.get_or_create_conversation("npc_di_prova", "stats_user")
+        db.add_message(second, "user", "Ciao")
+        
+        assert db.get_conversation_stats() == {'total_conversations': 2, 'total_messages': 5, 'avg_messages': 2.5}
+        assert db.get_conversation_stats("aedryan")['total_messages'] == 4
+        
+        db.delete_conversation(first)
+        assert db.get_conversation_stats()['total_conversations'] == 1
+        assert db.get_conversation_stats("aedryan")['total_conversations'] == 0
+        
+        # La ricostruzione deve dare gli stessi valori mantenuti dai trigger
+        expected = db.get_conversation_stats()
+        with db.connection() as conn:
+            conn.execute("UPDATE conversation_stats SET total_messages = 999")
+        db.rebuild_stats()
+        assert db.get_conversation_stats() == expected
+        db.close()
+    
+    print("✅ Statistiche incrementali OK")
+
+def test_activity_rollups():
+    print("🧪 Test Aggregati di attività")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "activity.db"))
+        
+        conversation_id = db.record_turn("aedryan", "activity_user", "Ciao", "Salve")
+        db.record_turn("aedryan", "activity_user", "Come stai?", "Bene", conversation_id=conversation_id)
+        db.record_turn("npc_di_prova", "other_user", "Ciao", "Salve")
+        
+        # Il trigger scrive solo i contatori al minuto, una riga per NPC, utente e minuto
+        with db.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM activity_rollups").fetchone()[0] == 0
+            assert conn.execute("SELECT SUM(messages) FROM activity_minutes").fetchone()[0] == 6
+            assert conn.execute("SELECT COUNT(DISTINCT npc_id || user_id) FROM activity_minutes").fetchone()[0] == 2
+        
+        # Le serie sono le stesse prima e dopo aver riportato i contatori negli aggregati
+        start, end = "2000-01-01 00:00:00", "2100-01-01 00:00:00"
+        def series():
+            return [db.get_activity_timeseries(bucket, start, end) for bucket in ("minute", "hour", "day")] + [
+                db.get_activity_timeseries("hour", start, end, npc_id="aedryan"),
+                db.get_activity_timeseries("day", start, end, user_id="other_user"),
+            ]
+        
+        unfolded = series()
+        for points in unfolded[:3]:
+            assert sum(p['messages'] for p in points) == 6
+        assert sum(p['user_messages'] for p in unfolded[3]) == 2
+        assert sum(p['messages'] for p in unfolded[4]) == 2
+        rows = db.fold_activity_rollups()
+        assert 2 <= rows <= 4
+        assert db.fold_activity_rollups() == 0
+        assert series() == unfolded
+        
+        # Un nuovo messaggio si somma ai bucket già riportati
+        db.record_turn("aedryan", "activity_user", "Ancora", "Sì", conversation_id=conversation_id)
+        assert sum(p['messages'] for p in db.get_activity_timeseries("day", start, end)) == 8
+        db.fold_activity_rollups()
+        assert sum(p['messages'] for p in db.get_activity_timeseries("day", start, end)) == 8
+        
+        # La ricostruzione da messages deve coincidere con gli aggregati riportati
+        with db.connection() as conn:
+            before = conn.execute("SELECT * FROM activity_rollups ORDER BY 1, 2, 3, 4").fetchall()
+        db.rebuild_activity_rollups()
+        with db.connection() as conn:
+            assert conn.execute("SELECT * FROM activity_rollups ORDER BY 1, 2, 3, 4").fetchall() == before
+            conn.execute("UPDATE activity_rollups SET bucket_start = '2000-01-01 00:00:00' WHERE bucket_size = 'minute'")
+        
+        # I bucket al minuto scaduti vengono eliminati, quelli giornalieri restano
+        assert db.prune_activity_rollups() == 5
+        assert db.get_activity_timeseries("minute", start, end) == []
+        assert len(db.get_activity_timeseries("day", start, end)) == 1
+        db.close()
+    
+    print("✅ Aggregati di attività OK")
+
+def test_message_pages():
+    print("🧪 Test Paginazione storico")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "pages.db"))
+        
+        conversation_id = db.get_or_create_conversation("aedryan", "pages_user")
+        for i in range(25):
+            db.add_message(conversation_id, "user", f"Messaggio {i}")
+        
+        # Di default la pagina più recente, in ordine cronologico
+        page = db.get_message_page(conversation_id, 10)
+        assert [m['content'] for m in page['messages']] == [f"Messaggio {i}" for i in range(15, 25)]
+        assert page['has_more']
+        
+        # Scorrendo all'indietro fino all'inizio
+        seen = page['messages']
+        while page['has_more']:
+            page = db.get_message_page(conversation_id, 10, before_id=seen[0]['id'])
+            seen = page['messages'] + seen
+        assert [m['content'] for m in seen] == [f"Messaggio {i}" for i in range(25)]
+        assert len(page['messages']) == 5
+        
+        # In avanti dal cursore
+        newer = db.get_message_page(conversation_id, 10, after_id=seen[19]['id'])
+        assert [m['content'] for m in newer['messages']] == [f"Messaggio {i}" for i in range(20, 25)]
+        assert not newer['has_more']
+        db.close()
+    
+    print("✅ Paginazione storico OK")
+
+def test_user_conversations():
+    print("🧪 Test Elenco conversazioni utente")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "inbox.db"))
+        
+        first = db.record_turn("aedryan", "inbox_user", "Ciao", "Salve, viandante")
+        second = db.get_or_create_conversation("npc_di_prova", "inbox_user")
+        message_id = db.add_message(second, "user", "x" * 500)
+        with db.connection() as conn:
+            conn.execute("UPDATE conversations SET updated_at = '2000-01-01 00:00:00' WHERE id = ?", (second,))
+        
+        conversations = db.get_user_conversations("inbox_user")
+        assert [c['id'] for c in conversations] == [first, second]
+        assert conversations[0]['last_message'] == "Salve, viandante"
+        assert conversations[1]['last_message_id'] == message_id
+        assert len(conversations[1]['last_message']) == 200
+        
+        # La query usa l'indice, senza ordinamenti temporanei
+        with db.connection() as conn:
+            plan = " ".join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT 20",
+                ("inbox_user",)
+            ))
+        assert "idx_conversations_user_updated" in plan and "TEMP B-TREE" not in plan
+        db.close()
+    
+    print("✅ Elenco conversazioni utente OK")
+
+def test_migrations():
+    print("🧪 Test Migrazioni schema")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "legacy.db")
+        # Database creato dalla prima versione: nessuna versione, conversazioni duplicate
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            CREATE TABLE npcs (id TEXT PRIMARY KEY, name TEXT NOT NULL, avatar TEXT NOT NULL,
+                description TEXT NOT NULL, status TEXT DEFAULT 'online', prompt TEXT NOT NULL,
+                last_message TEXT DEFAULT '', last_message_time TEXT DEFAULT '',
+                unread_count INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE TABLE conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, npc_id TEXT NOT NULL,
+                user_id TEXT DEFAULT 'default_user', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, title TEXT DEFAULT '',
+                message_count INTEGER DEFAULT 0);
+            CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id INTEGER NOT NULL,
+                sender TEXT NOT NULL, content TEXT NOT NULL, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+            CREATE INDEX idx_npcs_id ON npcs(id);
+            CREATE INDEX idx_conversations_npc ON conversations(npc_id);
+            CREATE INDEX idx_messages_conversation ON messages(conversation_id);
+            INSERT INTO conversations (id, npc_id, user_id, updated_at, message_count) VALUES
+                (1, 'aedryan', 'dup_user', '2024-01-01 10:00:00', 1),
+                (2, 'aedryan', 'dup_user', '2024-01-02 10:00:00', 2),
+                (3, 'npc_di_prova', 'dup_user', '2024-01-01 10:00:00', 0);
+            INSERT INTO messages (conversation_id, sender, content) VALUES
+                (1, 'user', 'Primo'), (2, 'user', 'Secondo'), (2, 'npc', 'Terzo');
+        ''')
+        conn.close()
+        
+        db = ChatDatabase(path)
+        with db.connection() as conn:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            assert "idx_conversations_npc_user" in indexes
+            assert not indexes & {"idx_npcs_id", "idx_conversations_npc", "idx_messages_conversation"}
+            rows = conn.execute(
+                "SELECT id, message_count, updated_at, last_message_preview FROM conversations WHERE npc_id = 'aedryan'"
+            ).fetchall()
+        
+        # I duplicati sono fusi nella conversazione più vecchia
+        assert rows == [(1, 3, '2024-01-02 10:00:00', 'Terzo')]
+        assert [m['content'] for m in db.get_conversation_history(1)] == ["Primo", "Secondo", "Terzo"]
+        assert db.get_conversation_stats()['total_conversations'] == 2
+        assert db.get_conversation_stats()['total_messages'] == 3
+        
+        # Una sola conversazione per NPC e utente
+        assert db.get_or_create_conversation("aedryan", "dup_user") == 1
+        assert db.get_or_create_conversation("npc_di_prova", "dup_user") == 3
+        assert db.find_conversation("aedryan", "dup_user") == 1
+        db.close()
+        
+        # Riaprire un database aggiornato non riapplica nulla e non prende il lock di scrittura
+        db = ChatDatabase(path)
+        assert db.pool.stats()["lock_waits"] == 0
+        with db.connection() as conn:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        db.close()
+    
+    print("✅ Migrazioni schema OK")
+
+def test_maintenance():
+    print("🧪 Test Manutenzione database")
+    from maintenance import run_maintenance
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "maintenance.db"))
+        
+        recent = db.record_turn("aedryan", "recent_user", "Ciao", "Salve")
+        old = [db.record_turn("npc_di_prova", f"old_user_{i}", "Ciao", "Salve") for i in range(5)]
+        with db.connection() as conn:
+            conn.execute("UPDATE conversations SET updated_at = '2000-01-01 00:00:00' WHERE id != ?", (recent,))
+            conn.execute("INSERT INTO user_sessions (user_id, npc_id, conversation_id) VALUES ('old_user_0', 'npc_di_prova', ?)", (old[0],))
+            # Messaggi di una conversazione che non esiste più
+            conn.execute("INSERT INTO messages (conversation_id, sender, content) VALUES (9999, 'user', 'orfano')")
+            conn.execute("INSERT INTO messages (conversation_id, sender, content) VALUES (9998, 'user', 'orfano')")
+            conn.execute("INSERT INTO messages (conversation_id, sender, content) VALUES (9997, 'user', 'orfano')")
+            # Conversazione di un NPC eliminato
+            conn.execute("INSERT INTO conversations (npc_id, user_id) VALUES ('fantasma', 'ghost_user')")
+        
+        # Batch da 2: tre transazioni per le cinque conversazioni vecchie
+        report = run_maintenance(db, retention_days=30, batch_size=2, pause=0, vacuum_pages=100)
+        assert report["old_conversations"] == {"messages": 10, "user_sessions": 1, "archived_blocks": 0, "conversations": 5}
+        # Tre conversazioni mancanti (due batch) e quella dell'NPC eliminato
+        assert report["orphans"] == {"messages": 3, "user_sessions": 0, "archived_blocks": 0, "conversations": 1}
+        assert report["vacuumed_pages"] >= 0
+        
+        with db.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 2
+            assert conn.execute("SELECT COUNT(*) FROM user_sessions").fetchone()[0] == 0
+            assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert db.get_conversation_stats()['total_conversations'] == 1
+        assert db.cleanup_old_conversations(30) == 0
+        db.close()
+    
+    print("✅ Manutenzione database OK")
+
+def test_archive():
+    print("🧪 Test Archivio messaggi")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "archive.db"))
+        
+        conversation_id = db.get_or_create_conversation("aedryan", "archive_user")
+        ids = [db.add_message(conversation_id, "user" if i % 2 == 0 else "npc", f"Messaggio {i}") for i in range(10)]
+        active = db.record_turn("npc_di_prova", "archive_user", "Ciao", "Salve")
+        with db.connection() as conn:
+            conn.execute("UPDATE conversations SET updated_at = '2000-01-01 00:00:00' WHERE id = ?", (conversation_id,))
+        
+        archived = db.archive_idle_conversations(30, batch_size=1, pause=0)
+        assert archived['conversations'] == 1 and archived['messages'] == 10
+        assert os.listdir(os.path.join(tmp, "archive_archive")) == ["segment-000001.z"]
+        with db.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()[0] == 0
+        # La conversazione resta, con contatori e anteprima
+        assert db.get_conversation_stats()['total_messages'] == 12
+        assert db.get_user_conversations("archive_user")[1]['last_message'] == "Messaggio 9"
+        
+        # Le letture ricompongono archivio e messaggi nuovi
+        new_id = db.add_message(conversation_id, "user", "Sono tornato")
+        history = db.get_conversation_history(conversation_id)
+        assert [m['content'] for m in history] == [f"Messaggio {i}" for i in range(10)] + ["Sono tornato"]
+        page = db.get_message_page(conversation_id, limit=4)
+        assert [m['id'] for m in page['messages']] == ids[-3:] + [new_id] and page['has_more']
+        older = db.get_message_page(conversation_id, limit=4, before_id=ids[-3])
+        assert [m['id'] for m in older['messages']] == ids[3:7] and older['has_more']
+        newer = db.get_message_page(conversation_id, limit=20, after_id=ids[7])
+        assert [m['id'] for m in newer['messages']] == ids[8:] + [new_id] and not newer['has_more']
+        recent = db.get_recent_messages(conversation_id, limit=3)
+        assert [m['content'] for m in recent] == ["Messaggio 8", "Messaggio 9", "Sono tornato"]
+        assert [m['id'] for m in db.get_messages_after(conversation_id, ids[5], limit=3)] == ids[6:9]
+        assert len(db.get_recent_messages(active)) == 2
+        
+        # Eliminare la conversazione rimuove anche i riferimenti all'archivio
+        db.delete_conversation(conversation_id)
+        with db.connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM archive_index").fetchone()[0] == 0
+        db.close()
+    
+    print("✅ Archivio messaggi OK")
+
+def test_search():
+    print("🧪 Test Ricerca nei messaggi")
+    from shared import split_search_terms
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "search.db"))
+        assert db.search_enabled
+        
+        db.record_turn("aedryan", "gm", "Chi è il Sussurro Pallido?", "Il Sussurro Pallido è un'ombra antica, viandante.")
+        db.record_turn("npc_di_prova", "gm", "Conosci il Sussurro Pallido?", "Non pronunciare quel nome nella città.")
+        other = db.record_turn("aedryan", "player", "Parlami del regno", "Il regno è in pace.")
+        
+        search = lambda text, **filters: db.search_messages(split_search_terms(text), **filters)
+        found = search('"sussurro pallido"')
+        assert len(found['results']) == 3 and not found['has_more']
+        assert "[Sussurro Pallido]" in found['results'][0]['snippet']
+        
+        by_npc = search("sussurro", npc_id="aedryan")
+        assert {r['npc_id'] for r in by_npc['results']} == {"aedryan"} and len(by_npc['results']) == 2
+        assert [r['sender'] for r in search("citta")['results']] == ["npc"]  # senza accenti
+        assert len(search("sussu*", user_id="gm")['results']) == 3
+        assert not found['truncated']
+        assert search("regno", user_id="gm")['results'] == []
+        
+        page = search("sussurro", limit=2)
+        assert len(page['results']) == 2 and page['has_more']
+        assert len(search("sussurro", limit=2, offset=2)['results']) == 1
+        
+        # Caratteri speciali trattati come testo, non come sintassi FTS5
+        assert search('regno" OR (pace -')['results'] == []
+        try:
+            search('  ""  ')
+            assert False, "query vuota accettata"
+        except ValueError:
+            pass
+        
+        # Un termine non può uscire dalla colonna del testo né togliere i filtri
+        escape = 'sussurro) OR {content}: (regno'
+        assert db.search_messages([escape], user_id="player")['results'] == []
+        assert db.search_messages(["sussurro", ") OR (regno"], user_id="player")['results'] == []
+        assert db.search_messages(['regno"', "OR", '"pace'])['results'] == []
+        
+        # L'indice segue eliminazioni e ricostruzione
+        db.delete_conversation(other)
+        assert search("regno")['results'] == []
+        with db.connection() as conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('integrity-check', 1)")
+        db.rebuild_search_index()
+        assert len(search("sussurro")['results']) == 3
+        db.close()
+    
+    print("✅ Ricerca nei messaggi OK")
+
 if __name__ == "__main__":
-    test_database() 
\ No newline at end of file
+    test_database()
+    test_connection_pool()
+    test_record_turn()
+    test_write_behind()
+    test_npc_versions()
+    test_npc_name_cache()
+    test_npc_cache()
+    test_recent_messages() 
+    test_conversation_stats()
+    test_activity_rollups()
+    test_message_pages()
+    test_user_conversations()
+    test_migrations()
+    test_maintenance()
+    test_archive()
+    test_search()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Test per la memoria a lungo termine (embedding e ricerca per similarità)
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from database import ChatDatabase
+from fake_ollama import FakeOllama
+from memory import ConversationMemory, VectorStore, normalize
+from ollama_client import OllamaClient
+from prompt_builder import MEMORY_HEADER, build_prompt
+
+NPC = {"id": "aedryan", "name": "Re Aedryan", "prompt": "Sei Re Aedryan."}
+
+def test_vector_store():
+    print("🧪 Test Archivio dei vettori")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = VectorStore(os.path.join(tmp, "memory"))
+        vectors = normalize(np.eye(4)[[0, 1, 2, 3, 0]] + 0.1)
+        store.append(7, "test", [10, 20, 30], vectors[:3])
+        store.append(7, "test", [40, 50], vectors[3:])
+        assert store.count(7) == 5 and store.last_id(7, "test") == 50
+
+        hits = store.search(7, "test", vectors[0], 2)
+        assert [message_id for message_id, _ in hits] in ([10, 50], [50, 10])
+        assert hits[0][1] > 0.99
+        # Solo i messaggi precedenti a before_id
+        assert [message_id for message_id, _ in store.search(7, "test", vectors[0], 2, before_id=40)][0] == 10
+        assert store.search(7, "altro-modello", vectors[0], 2) == []
+
+        # Una riga di vettori senza id (scrittura interrotta) viene scartata
+        with open(store._path(7, "f32"), "ab") as f:
+            f.write(vectors[:1].tobytes())
+        store.append(7, "test", [60], vectors[1:2])
+        assert os.path.getsize(store._path(7, "f32")) == 6 * 4 * 4
+        assert store.search(7, "test", vectors[1], 1)[0][0] in (20, 60)
+
+        # Cambiando modello i vettori vengono ricalcolati da zero
+        assert store.last_id(7, "nuovo") == 0
+        store.append(8, "nuovo", [1], vectors[:1])
+        assert store.count(7) == 0 and store.conversation_ids() == [8]
+
+    print("✅ Archivio dei vettori OK")
+
+def test_recall():
+    print("🧪 Test Ricordi pertinenti")
+
+    fake = FakeOllama().start()
+    client = OllamaClient(url=fake.url, model="test", embed_model="embed-test")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = ChatDatabase(os.path.join(tmp, "memory.db"))
+            memory = ConversationMemory(db, client, top_k=2, min_score=0.3, batch_size=8)
+            conversation_id = db.get_or_create_conversation("aedryan", "memory_user")
+            db.add_message(conversation_id, "user", "Il fabbro Doran forgia spade nella valle")
+            db.add_message(conversation_id, "npc", "Doran è il miglior fabbro del regno")
+            for i in range(18):
+                db.add_message(conversation_id, "user" if i % 2 else "npc", f"Parliamo del tempo numero {i}")
+
+            # Nulla di indicizzato: nessun ricordo e nessuna richiesta a Ollama
+            assert memory.recall(conversation_id, [], "dove trovo il fabbro Doran") == []
+            assert fake.embed_requests == 0
+
+            # Un batch per richiesta di embedding
+            assert memory.index(conversation_id) == 8
+            assert memory.index(conversation_id) == 8
+            assert memory.index(conversation_id) == 4
+            assert memory.index(conversation_id) == 0
+            assert fake.embed_requests == 3
+
+            # La domanda è il nuovo messaggio (una sola richiesta), non gli ultimi messaggi sul tempo
+            history = db.get_recent_messages(conversation_id, 6)
+            memories = memory.recall(conversation_id, history, "dove trovo il fabbro Doran")
+            assert fake.embed_requests == 4
+            assert [m['content'] for m in memories][0].startswith("Il fabbro Doran")
+            assert all(m['score'] >= 0.3 and m['id'] < history[0]['id'] for m in memories)
+
+            prompt = build_prompt(NPC, "dove trovo il fabbro Doran", history, memories=memories)
+            assert MEMORY_HEADER in prompt and "miglior fabbro" in prompt
+            assert prompt.index(MEMORY_HEADER) < prompt.index("Avventuriero:")
+
+            # Se l'embedding della domanda fallisce si usa la media degli ultimi messaggi indicizzati
+            client.embed_url = fake.url.replace("/api/generate", "/api/inesistente")
+            fallback = memory.recall(conversation_id, history, "dove trovo il fabbro Doran")
+            assert fallback and all(m['content'].startswith("Parliamo del tempo") for m in fallback)
+            assert all(m['id'] < history[0]['id'] for m in fallback)
+
+            # Le conversazioni eliminate perdono anche i vettori
+            db.delete_conversation(conversation_id)
+            assert memory.prune() == 1 and memory.store.conversation_ids() == []
+            db.close()
+    finally:
+        client.close()
+        fake.stop()
+
+    print("✅ Ricordi pertinenti OK")
+
+def test_recall_write_behind():
+    print("🧪 Test Ricordi con scritture differite")
+
+    fake = FakeOllama().start()
+    client = OllamaClient(url=fake.url, model="test", embed_model="embed-test")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = ChatDatabase(os.path.join(tmp, "memory_wb.db"), write_behind=True)
+            memory = ConversationMemory(db, client, top_k=2, min_score=0.0)
+            conversation_id = db.record_turn("aedryan", "wb_user", "Il fabbro Doran", "Nella valle")
+            db.flush()
+            db.record_turn("aedryan", "wb_user", "Parliamo del fabbro Doran", "Volentieri",
+                           conversation_id=conversation_id)
+            db.flush()
+            assert memory.index(conversation_id) == 4
+
+            # Un turno arrivato prima che il batch sia scritto: lo storico inizia con messaggi senza id
+            db.writer.batch_seconds = 5
+            db.record_turn("aedryan", "wb_user", "Ancora Doran", "Sì", conversation_id=conversation_id)
+            history = db.get_recent_messages(conversation_id, 2)
+            assert [m['id'] for m in history] == [None, None]
+            memories = memory.recall(conversation_id, history)
+            assert [m['content'] for m in memories] == ["Il fabbro Doran", "Nella valle"]
+            db.close()
+    finally:
+        client.close()
+        fake.stop()
+
+    print("✅ Ricordi con scritture differite OK")
+
+if __name__ == "__main__":
+    test_vector_store()
+    test_recall()
+    test_recall_write_behind()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Test per la costruzione del prompt con budget di token
+"""
+
+from prompt_builder import build_prompt, can_reuse_context, estimate_tokens, prompt_hash, select_history
+
+NPC = {"id": "aedryan", "name": "Re Aedryan", "prompt": "Tu sei Re Aedryan."}
+
+def test_select_history_keeps_newest():
+    print("🧪 Test Selezione storico")
+    
+    history = [
+        {"sender": "user", "content": f"Messaggio {i}", "token_count": 10}
+        for i in range(10)
+    ]
+    # Ogni messaggio costa 10 token + overhead: ne entrano solo gli ultimi 3
+    selected = select_history(history, 45)
+    assert [m["content"] for m in selected] == ["Messaggio 7", "Messaggio 8", "Messaggio 9"]
+    
+    print("✅ Selezione storico OK")
+
+def test_build_prompt_respects_budget():
+    print("🧪 Test Budget del prompt")
+    
+    history = [
+        {"sender": "user" if i % 2 else "npc", "content": "x" * 300, "token_count": None}
+        for i in range(50)
+    ]
+    prompt = build_prompt(NPC, "Salute, maestà", history, num_ctx=1024, response_reserve=256)
+    
+    assert estimate_tokens(prompt) <= 1024 - 256
+    assert prompt.startswith(NPC["prompt"])
+    assert prompt.endswith("Avventuriero: Salute, maestà\nRe Aedryan:")
+    
+    # Senza storico resta solo il prompt base
+    assert build_prompt(NPC, "Ciao") == "Tu sei Re Aedryan.\n\nAvventuriero: Ciao\nRe Aedryan:"
+    
+    print("✅ Budget del prompt OK")
+
+def test_can_reuse_context():
+    print("🧪 Test Riuso del contesto di Ollama")
+    
+    llm_context = {"context": list(range(100)), "model": "test", "prompt_hash": prompt_hash(NPC)}
+    assert can_reuse_context(llm_context, NPC, "Ciao", "test", num_ctx=1024, response_reserve=256)
+    
+    # Nessun contesto salvato (o cancellato dopo un errore)
+    assert not can_reuse_context(None, NPC, "Ciao", "test")
+    assert not can_reuse_context({}, NPC, "Ciao", "test")
+    # Modello o prompt dell'NPC cambiati
+    assert not can_reuse_context(llm_context, NPC, "Ciao", "altro-modello")
+    changed = dict(NPC, prompt="Tu sei Re Aedryan, ora in esilio.")
+    assert not can_reuse_context(llm_context, changed, "Ciao", "test")
+    # Il contesto non lascia spazio per la battuta e la risposta
+    assert not can_reuse_context(llm_context, NPC, "Ciao", "test", num_ctx=300, response_reserve=256)
+    assert not can_reuse_context(llm_context, NPC, "x" * 3000, "test", num_ctx=1024, response_reserve=256)
+    
+    print("✅ Riuso del contesto di Ollama OK")
+
+if __name__ == "__main__":
+    test_select_history_keeps_newest()
+    test_build_prompt_respects_budget()
+    test_can_reuse_context()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Test per lo scheduler delle generazioni
+"""
+
+import asyncio
+import threading
+import time
+
+from scheduler import BACKGROUND_QUEUE, PRIORITY_BACKGROUND, LLMScheduler, SchedulerQueueFull
+
+# NPC fittizi: per lo scheduler l'id dell'NPC è solo la chiave della sua coda
+NPC_A, NPC_B, NPC_C = "npc_test_a", "npc_test_b", "npc_test_c"
+
+def test_fair_scheduling():
+    print("🧪 Test Scheduler equo")
+    
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=10, max_queue_per_user=5)
+        order = []
+        gate = asyncio.Event()
+        
+        async def request(npc_id, user_id, label):
+            async with scheduler.slot(npc_id, user_id):
+                order.append(label)
+                await gate.wait()
+        
+        first = asyncio.create_task(request(NPC_A, "a", "a0"))
+        await asyncio.sleep(0)
+        # L'utente "a" manda una raffica, "b" un solo messaggio allo stesso NPC, "c" a un altro NPC
+        tasks = [asyncio.create_task(request(NPC_A, "a", f"a{i}")) for i in range(1, 4)]
+        tasks.append(asyncio.create_task(request(NPC_A, "b", "b1")))
+        tasks.append(asyncio.create_task(request(NPC_B, "c", "c1")))
+        await asyncio.sleep(0)
+        assert scheduler.stats()["waiting"] == 5
+        
+        gate.set()
+        await asyncio.gather(first, *tasks)
+        return order, scheduler.stats()
+    
+    order, stats = asyncio.run(run())
+    # Dopo a0: a rotazione tra gli NPC (A, B, A, ...) e, dentro NPC_A, tra gli utenti (a, b, a, ...)
+    assert order == ["a0", "a1", "c1", "b1", "a2", "a3"], order
+    assert stats["served"] == 6 and stats["active"] == 0 and stats["waiting"] == 0
+    
+    print("✅ Scheduler equo OK")
+
+def test_fair_across_npcs():
+    print("🧪 Test Equità tra NPC")
+    
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=10, max_queue_per_user=5)
+        order = []
+        gate = asyncio.Event()
+        
+        async def request(npc_id, user_id, label):
+            async with scheduler.slot(npc_id, user_id):
+                order.append(label)
+                await gate.wait()
+        
+        first = asyncio.create_task(request(NPC_A, "a", "a0"))
+        await asyncio.sleep(0)
+        # Raffica verso NPC_A; due utenti parlano con NPC_B, uno con NPC_C
+        tasks = [asyncio.create_task(request(NPC_A, "a", f"a{i}")) for i in range(1, 4)]
+        tasks += [asyncio.create_task(request(NPC_B, user, f"{user}1")) for user in ("b", "c")]
+        tasks.append(asyncio.create_task(request(NPC_C, "d", "d1")))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(first, *tasks)
+        return order
+    
+    order = asyncio.run(run())
+    # La raffica verso NPC_A non passa davanti agli utenti degli altri NPC
+    assert order == ["a0", "a1", "b1", "d1", "a2", "c1", "a3"], order
+    
+    print("✅ Equità tra NPC OK")
+
+def test_background_priority():
+    print("🧪 Test Priorità e richieste dai thread")
+    
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=10, max_queue_per_user=5)
+        order = []
+        gate = asyncio.Event()
+        
+        def background(label):
+            with scheduler.slot_sync(BACKGROUND_QUEUE, "riassunti", PRIORITY_BACKGROUND):
+                order.append(label)
+        
+        async def request(user_id):
+            async with scheduler.slot(NPC_A, user_id):
+                order.append(user_id)
+                await gate.wait()
+        
+        first = asyncio.create_task(request("a"))
+        await asyncio.sleep(0)
+        # Un riassunto in coda da un thread, poi due turni di chat
+        thread = threading.Thread(target=background, args=("riassunto",))
+        thread.start()
+        while scheduler.stats()["waiting"] < 1:
+            time.sleep(0.001)
+        tasks = [asyncio.create_task(request(user)) for user in ("b", "c")]
+        await asyncio.sleep(0)
+        
+        gate.set()
+        await asyncio.gather(first, *tasks)
+        await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        return order, scheduler.stats()
+    
+    order, stats = asyncio.run(run())
+    # Il riassunto passa solo quando non ci sono più turni di chat in attesa
+    assert order == ["a", "b", "c", "riassunto"], order
+    assert stats["active"] == 0 and stats["waiting"] == 0 and stats["served"] == 4
+    
+    print("✅ Priorità e richieste dai thread OK")
+
+def test_queue_limits():
+    print("🧪 Test Limiti della coda")
+    
+    async def run():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue=3, max_queue_per_user=2)
+        gate = asyncio.Event()
+        
+        async def request(user_id):
+            async with scheduler.slot(NPC_A, user_id):
+                await gate.wait()
+        
+        tasks = [asyncio.create_task(request("a"))]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(request("a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        
+        # Troppi messaggi in attesa per lo stesso utente
+        try:
+            scheduler.check_capacity("a")
+            assert False, "Doveva essere rifiutato"
+        except SchedulerQueueFull as e:
+            assert e.retry_after >= 1
+        scheduler.check_capacity("b")
+        
+        tasks.append(asyncio.create_task(request("b")))
+        await asyncio.sleep(0)
+        # Coda globale piena
+        try:
+            scheduler.check_capacity("c")
+            assert False, "Doveva essere rifiutato"
+        except SchedulerQueueFull:
+            pass
+        
+        # Una richiesta annullata libera il suo posto in coda
+        tasks[-1].cancel()
+        await asyncio.sleep(0)
+        assert scheduler.stats()["waiting"] == 2
+        
+        gate.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return scheduler.stats()
+    
+    stats = asyncio.run(run())
+    assert stats["rejected"] == 2 and stats["active"] == 0
+    
+    print("✅ Limiti della coda OK")
+
+if __name__ == "__main__":
+    test_fair_scheduling()
+    test_fair_across_npcs()
+    test_background_priority()
+    test_queue_limits()
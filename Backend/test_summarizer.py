@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test per il riassunto incrementale delle conversazioni
+"""
+
+import os
+import tempfile
+
+from database import ChatDatabase
+from prompt_builder import estimate_tokens
+from summarizer import SUMMARY_RESPONSE_RESERVE, ConversationSummarizer
+
+class RecordingClient:
+    """Sostituto di Ollama che registra i prompt ricevuti"""
+    
+    def __init__(self):
+        self.prompts = []
+    
+    def generate(self, prompt, **options):
+        self.prompts.append(prompt)
+        return {"response": f"Riassunto {len(self.prompts)}"}
+
+def test_incremental_summary():
+    print("🧪 Test Riassunto incrementale")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "summary.db"))
+        client = RecordingClient()
+        summarizer = ConversationSummarizer(db, client, threshold=10, keep_recent=4, batch_messages=8)
+        
+        conversation_id = db.get_or_create_conversation("aedryan", "summary_user")
+        for i in range(12):
+            db.add_message(conversation_id, "user", f"Messaggio {i}")
+        
+        # Sotto la soglia (10 + 4 recenti) non si riassume nulla
+        assert summarizer.summarize(conversation_id, "Re Aedryan") is False
+        
+        for i in range(12, 20):
+            db.add_message(conversation_id, "user", f"Messaggio {i}")
+        
+        assert summarizer.summarize(conversation_id, "Re Aedryan") is True
+        state = db.get_summary(conversation_id)
+        assert state['summary'] == "Riassunto 1"
+        assert "Messaggio 7" in client.prompts[0] and "Messaggio 8" not in client.prompts[0]
+        
+        # Restano 12 messaggi non riassunti: sotto la soglia
+        assert summarizer.summarize(conversation_id, "Re Aedryan") is False
+        recent = db.get_recent_messages(conversation_id, 50, after_id=state['upto_id'])
+        assert recent[0]['content'] == "Messaggio 8"
+        db.close()
+    
+    print("✅ Riassunto incrementale OK")
+
+def test_summary_budget():
+    print("🧪 Test Budget del riassunto")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ChatDatabase(os.path.join(tmp, "summary_budget.db"))
+        client = RecordingClient()
+        num_ctx = SUMMARY_RESPONSE_RESERVE + 400
+        summarizer = ConversationSummarizer(db, client, threshold=10, keep_recent=4, batch_messages=8,
+                                            num_ctx=num_ctx)
+        
+        # Messaggi lunghi: gli 8 del batch non stanno nella finestra, se ne riassumono meno
+        conversation_id = db.get_or_create_conversation("aedryan", "budget_user")
+        ids = [db.add_message(conversation_id, "user", f"Messaggio {i} " + "x" * 300) for i in range(20)]
+        assert summarizer.summarize(conversation_id, "Re Aedryan") is True
+        assert estimate_tokens(client.prompts[0]) <= num_ctx - SUMMARY_RESPONSE_RESERVE
+        upto_id = db.get_summary(conversation_id)['upto_id']
+        assert ids[0] <= upto_id < ids[7]
+        # Il passaggio successivo riparte dai messaggi esclusi
+        assert summarizer.summarize(conversation_id, "Re Aedryan") is True
+        assert f"Messaggio {ids.index(upto_id) + 1} " in client.prompts[1]
+        
+        # Un messaggio più lungo dell'intera finestra viene accorciato, non blocca i riassunti
+        other = db.get_or_create_conversation("aedryan", "budget_user_2")
+        db.add_message(other, "user", "Enorme " + "y" * 20000)
+        for i in range(13):
+            db.add_message(other, "user", f"Breve {i}")
+        assert summarizer.summarize(other, "Re Aedryan") is True
+        assert estimate_tokens(client.prompts[2]) <= num_ctx - SUMMARY_RESPONSE_RESERVE
+        assert "Enorme" in client.prompts[2] and "Breve 0" not in client.prompts[2]
+        db.close()
+    
+    print("✅ Budget del riassunto OK")
+
+if __name__ == "__main__":
+    test_incremental_summary()
+    test_summary_budget()
@@ -8,6 +8,10 @@ export default function Chat() {
   const [selectedChat, setSelectedChat] = useState("aedryan");
   const [sidebarOpen, setSidebarOpen] = useState(true);
   const [conversationHistory, setConversationHistory] = useState({});
+  // Cursore per caricare i messaggi più vecchi (id del primo messaggio mostrato)
+  const [olderCursor, setOlderCursor] = useState(null);
+  const [hasOlder, setHasOlder] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
 
   // Carica lo storico della conversazione quando cambia la chat selezionata
   useEffect(() => {
@@ -16,21 +20,25 @@ export default function Chat() {
     }
   }, [selectedChat]);
 
+  // Converti lo storico in formato compatibile con il frontend
+  const formatHistory = (history) => history.map(msg => ({
+    sender: msg.sender === 'user' ? 'user' : 'bot',
+    text: msg.content,
+    timestamp: msg.timestamp
+  }));
+
   const loadConversationHistory = async (npcId) => {
     try {
+      // Ultimi 50 messaggi; i precedenti si caricano a richiesta
       const response = await fetch(`http://localhost:8000/api/conversation/${npcId}/history?user_id=default_user&limit=50`);
       if (response.ok) {
         const data = await response.json();
-        
-        // Converti lo storico in formato compatibile con il frontend
-        const formattedMessages = data.history.map(msg => ({
-          sender: msg.sender === 'user' ? 'user' : 'bot',
-          text: msg.content,
-          timestamp: msg.timestamp
-        }));
+        const formattedMessages = formatHistory(data.history);
 
         // Imposta i messaggi (anche se vuoto, non mostra messaggio di benvenuto)
         setMessages(formattedMessages);
+        setOlderCursor(data.next_before);
+        setHasOlder(data.has_more);
 
         // Salva lo storico nel cache locale
         setConversationHistory(prev => ({
@@ -40,10 +48,32 @@ export default function Chat() {
       } else {
         console.error('Errore nel caricamento dello storico:', response.statusText);
         setMessages([]);
+        setHasOlder(false);
       }
     } catch (error) {
       console.error('Errore nel caricamento dello storico:', error);
       setMessages([]);
+      setHasOlder(false);
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (!hasOlder || loadingOlder) return;
+    setLoadingOlder(true);
+    try {
+      const response = await fetch(`http://localhost:8000/api/conversation/${selectedChat}/history?user_id=default_user&limit=50&before=${olderCursor}`);
+      if (response.ok) {
+        const data = await response.json();
+        setMessages(prev => [...formatHistory(data.history), ...prev]);
+        setOlderCursor(data.next_before);
+        setHasOlder(data.has_more);
+      } else {
+        console.error('Errore nel caricamento dei messaggi precedenti:', response.statusText);
+      }
+    } catch (error) {
+      console.error('Errore nel caricamento dei messaggi precedenti:', error);
+    } finally {
+      setLoadingOlder(false);
     }
   };
 
@@ -55,8 +85,17 @@ export default function Chat() {
     setInputText("");
     setLoading(true);
 
+    // Aggiorna il testo dell'ultimo messaggio del bot (quello in streaming)
+    const updateBotMessage = (text) => {
+      setMessages(prev => {
+        const updated = [...prev];
+        updated[updated.length - 1] = { ...updated[updated.length - 1], text };
+        return updated;
+      });
+    };
+
     try {
-      const response = await fetch(`http://localhost:8000/api/${selectedChat}`, {
+      const response = await fetch(`http://localhost:8000/api/${selectedChat}/stream`, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -68,13 +107,49 @@ export default function Chat() {
         }),
       });
 
-      if (response.ok) {
-        const data = await response.json();
-        const botMessage = { sender: "bot", text: data.reply };
-        setMessages(prev => [...prev, botMessage]);
-      } else {
+      if (!response.ok || !response.body) {
         const errorMessage = { sender: "bot", text: "Errore nella comunicazione con il server." };
         setMessages(prev => [...prev, errorMessage]);
+        return;
+      }
+
+      // Legge gli eventi SSE man mano che arrivano i token
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let replyText = "";
+      let started = false;
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+
+        for (const rawEvent of events) {
+          const dataLine = rawEvent.split("\n").find(line => line.startsWith("data: "));
+          if (!dataLine) continue;
+          const event = JSON.parse(dataLine.slice(6));
+
+          if (event.type === "token") {
+            replyText += event.token;
+          } else if (event.type === "done") {
+            replyText = event.reply;
+          } else if (event.type === "error") {
+            replyText = event.error;
+          }
+
+          if (!started) {
+            // Al primo token sostituisce l'indicatore di caricamento con il messaggio
+            started = true;
+            setLoading(false);
+            setMessages(prev => [...prev, { sender: "bot", text: replyText }]);
+          } else {
+            updateBotMessage(replyText);
+          }
+        }
       }
     } catch (error) {
       console.error("Errore:", error);
@@ -185,6 +260,26 @@ export default function Chat() {
             </div>
           )}
           
+          {hasOlder && (
+            <div style={{ display: 'flex', justifyContent: 'center', marginBottom: '12px' }}>
+              <button
+                onClick={loadOlderMessages}
+                disabled={loadingOlder}
+                style={{
+                  background: 'none',
+                  border: '1px solid #334155',
+                  borderRadius: '16px',
+                  color: '#94a3b8',
+                  padding: '6px 14px',
+                  fontSize: '13px',
+                  cursor: loadingOlder ? 'default' : 'pointer'
+                }}
+              >
+                {loadingOlder ? 'Caricamento...' : 'Carica messaggi precedenti'}
+              </button>
+            </div>
+          )}
+
           {messages.map((message, index) => (
             <div
               key={index}